@@ -1,33 +1,57 @@
+import asyncio
+import functools
+import itertools
 import logging
-import os
 import sys
 from argparse import ArgumentParser
 from datetime import datetime
 from typing import Annotated, List, Union, Optional
 from urllib.parse import unquote
 
-import datashader as dsh
+import anyio
+import anyio.to_thread
 import numpy as np
 import pandas as pd
 import uvicorn
-from cftime import date2num, num2pydate
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 
 from . import get_data
+from .formats import (ENCODERS, FILE_ENDINGS, FORMATS, MEDIA_TYPES,
+                      to_arrow, to_arrow_table, to_binary, to_csv,
+                      to_csv_table)
+from .resample import check_reduction, resample, resample_series
 from .storage import Storage
 
 logger = logging.getLogger(__name__)
 
 SubdirType = Annotated[Union[List[str], None], Query()]
+NamesType = Annotated[List[str], Query()]
 InventoryReturnType = Union[list, dict]
 
 
 class TonikAPI:
 
-    def __init__(self, rootdir) -> None:
+    def __init__(self, rootdir, block_size=2**18, max_workers=8,
+                 timeout=300., chunked_nbytes=2**26) -> None:
         self.rootdir = rootdir
+        # maximum number of values read and encoded at once when
+        # streaming a feature
+        self.block_size = block_size
+        # spectrograms larger than this many bytes are aggregated chunk
+        # by chunk, smaller ones are read through the caches
+        self.chunked_nbytes = chunked_nbytes
+        # file access and aggregation run in worker threads, at most
+        # `max_workers` at a time, so they don't block the event loop
+        self.limiter = anyio.CapacityLimiter(max_workers)
+        # seconds after which a request is answered with 504
+        self.timeout = timeout
+        # requests in progress and counters of how many requests were
+        # answered by joining an identical request in progress
+        self._inflight = {}
+        self.nrequests = 0
+        self.ncoalesced = 0
         self.app = FastAPI()
 
         # -- allow any origin to query API
@@ -35,9 +59,96 @@ class TonikAPI:
                                 allow_origins=["*"])
 
         self.app.get("/", response_class=HTMLResponse)(self.root)
-        self.app.get("/feature")(self.feature)
-        self.app.get("/inventory")(self.inventory)
-        self.app.get("/labels")(self.labels)
+        self.app.get("/feature")(self.offload(self.feature))
+        self.app.get("/features")(self.offload(self.features))
+        self.app.get("/query")(self.offload(self.query))
+        self.app.get("/inventory")(self.offload(self.inventory))
+        self.app.get("/labels")(self.offload(self.labels))
+        self.app.get("/metadata")(self.offload(self.metadata))
+        self.app.get("/stats")(self.stats)
+
+    def offload(self, func):
+        """
+        Turn a blocking endpoint into a coroutine that runs it in a
+        worker thread.
+
+        Identical requests that arrive while one is in progress wait for
+        its result instead of repeating the work. Streamed responses can
+        only be sent once, so requests joining a streamed response are
+        run again.
+        """
+        @functools.wraps(func)
+        async def endpoint(**kwargs):
+            self.nrequests += 1
+            key = (func.__name__, _freeze(kwargs))
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                try:
+                    result = await asyncio.shield(inflight)
+                except asyncio.CancelledError:
+                    if not inflight.cancelled():
+                        raise
+                else:
+                    if not isinstance(result, StreamingResponse):
+                        self.ncoalesced += 1
+                        return result
+                return await self.run(func, **kwargs)
+            inflight = asyncio.get_running_loop().create_future()
+            self._inflight[key] = inflight
+            try:
+                result = await self.run(func, **kwargs)
+            except asyncio.CancelledError:
+                inflight.cancel()
+                raise
+            except Exception as e:
+                inflight.set_exception(e)
+                # mark the exception as retrieved if nobody else waits
+                inflight.exception()
+                raise
+            else:
+                inflight.set_result(result)
+                return result
+            finally:
+                del self._inflight[key]
+        return endpoint
+
+    async def stats(self):
+        """
+        Return the number of data requests, how many of them were
+        answered with the result of an identical request in progress,
+        and the number of requests in progress.
+        """
+        return dict(requests=self.nrequests, coalesced=self.ncoalesced,
+                    inflight=len(self._inflight))
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run `func` in a worker thread, waiting at most `self.timeout`
+        seconds for the result.
+
+        Threads can't be interrupted, so a call that times out still
+        runs to completion in the background but no longer holds up the
+        request.
+        """
+        try:
+            with anyio.fail_after(self.timeout):
+                return await anyio.to_thread.run_sync(
+                    functools.partial(func, *args, **kwargs),
+                    abandon_on_cancel=True, limiter=self.limiter)
+        except TimeoutError:
+            msg = f"Request did not finish within {self.timeout} seconds"
+            raise HTTPException(status_code=504, detail=msg)
+
+    async def iterate(self, iterator):
+        """
+        Produce the items of a blocking iterator in worker threads.
+        """
+        done = object()
+        while True:
+            item = await self.run(next, iterator, done)
+            if item is done:
+                return
+            yield item
 
     def root(self):
         with open(get_data("package_data/index.html"), "r", encoding="utf-8") as file:
@@ -58,16 +169,38 @@ class TonikAPI:
         dt = dt.replace(tzinfo=None)
         return dt
 
-    async def feature(self,
-                      group: str,
-                      name: str,
-                      starttime: Union[str, None],
-                      endtime: Union[str, None],
-                      subdir: SubdirType = None,
-                      resolution: str = 'full',
-                      verticalres: int = 10,
-                      log: bool = False,
-                      normalise: bool = False):
+    def feature(self,
+                group: str,
+                name: str,
+                starttime: Union[str, None],
+                endtime: Union[str, None],
+                subdir: SubdirType = None,
+                resolution: str = 'full',
+                verticalres: int = 10,
+                log: bool = False,
+                normalise: bool = False,
+                agg: Union[str, None] = None,
+                format: str = 'csv'):
+        """
+        Return a feature as CSV (default), Arrow IPC stream ('arrow') or
+        the binary layout described in :mod:`tonik.formats` ('binary').
+        Features are aggregated to `resolution` with the reduction `agg`,
+        one of 'mean', 'median', 'min', 'max' or a percentile such as
+        'p90'. The default is 'mean' for 2D and 'median' for 1D features.
+
+        Identical requests in progress at the same time share one
+        response, except for full resolution windows of more than
+        `block_size` values, which are streamed and read for every
+        request, see :meth:`offload`.
+        """
+        if format not in FORMATS:
+            msg = f"Unknown format {format}; choose one of {FORMATS}"
+            raise HTTPException(status_code=400, detail=msg)
+        if agg is not None:
+            try:
+                check_reduction(agg)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
         _st = self.preprocess_datetime(starttime)
         _et = self.preprocess_datetime(endtime)
         g = Storage(group, rootdir=self.rootdir,
@@ -76,8 +209,27 @@ class TonikAPI:
         c = g
         if subdir:
             c = g.get_substore(*subdir)
+        if resolution == 'full':
+            return self.stream_feature(c, name, format, log, normalise)
         try:
-            feat = c(name)
+            shape = c.shape(name)
+            if agg is None:
+                agg = 'mean' if len(shape) > 1 else 'median'
+            # pyramid levels are only read if they were aggregated with
+            # `agg`
+            if (len(shape) > 1 and
+                    c.nbytes(name, resolution=resolution, method=agg) >
+                    self.chunked_nbytes):
+                # long windows of spectrograms are read and aggregated
+                # chunk by chunk so memory use doesn't depend on the
+                # length of the window
+                nrows = np.prod([size for dim, size in shape.items()
+                                 if dim != 'datetime'])
+                chunks = {'datetime': max(self.block_size // nrows, 1)}
+                feat = c(name, resolution=resolution, method=agg,
+                         chunks=chunks)
+            else:
+                feat = c(name, resolution=resolution, method=agg)
         except ValueError as e:
             msg = f"Feature {name} not found in directory {c.path}:"
             msg += f"{e}"
@@ -86,85 +238,261 @@ class TonikAPI:
             # assume first dimension is frequency
             nfreqs = feat.shape[0]
             dates = feat.coords[feat.dims[1]].values
-            if resolution != 'full':
-                freq, dates, spec = self.aggregate_feature(
-                    resolution, verticalres, feat, nfreqs, dates)
-            else:
-                spec = feat.values
-                freq = feat.coords[feat.dims[0]].values
-            vals = spec.ravel(order='C')
+            freq, dates, spec = self.aggregate_feature(
+                resolution, verticalres, feat, nfreqs, dates, agg)
+            vals = spec
             if log and feat.name != 'sonogram':
                 vals = 10*np.log10(vals)
             if normalise:
                 vals = (vals - np.nanmin(vals)) / \
                     (np.nanmax(vals) - np.nanmin(vals))
-            freqs = freq.repeat(dates.size)
-            dates = np.tile(dates, freq.size)
-            df = pd.DataFrame(
-                {'dates': dates, 'freqs': freqs, 'feature': vals})
-            df['dates'] = pd.to_datetime(df.dates.values).strftime(
-                '%Y-%m-%dT%H:%M:%SZ')
-            output = df.to_csv(index=False,
-                               columns=['dates', 'freqs', 'feature'])
+            dates = pd.to_datetime(dates).values
         else:
-            df = pd.DataFrame(data=feat.to_pandas(), columns=[feat.name])
-            df['dates'] = df.index
-            if resolution != 'full':
-                try:
-                    current_resolution = pd.Timedelta(
-                        df['dates'].diff().mean())
-                    if current_resolution < pd.Timedelta(resolution):
-                        df = df.resample(pd.Timedelta(resolution)).median()
-                except ValueError:
-                    logger.warning(
-                        f"Cannot resample {feat.name} to {resolution}: e")
-            df.rename(columns={feat.name: 'feature'}, inplace=True)
-            df['dates'] = df['dates'].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-            output = df.to_csv(index=False, columns=['dates', 'feature'])
-        return StreamingResponse(iter([output]),
-                                 media_type='text/csv',
-                                 headers={"Content-Disposition":
-                                          "attachment;filename=<tonik_feature>.csv",
-                                          'Content-Length': str(len(output))})
-
-    def aggregate_feature(self, resolution, verticalres, feat, nfreqs, dates):
-        resolution = np.timedelta64(
-            pd.Timedelta(resolution), 'ms').astype(float)
-        ndays = np.timedelta64(dates[-1] - dates[0], 'ms').astype(float)
-        canvas_x = int(ndays/resolution)
+            dates = feat['datetime'].values
+            vals = feat.values
+            try:
+                if dates.size > 1 and ((dates[-1] - dates[0]) /
+                                       (dates.size - 1) <
+                                       pd.Timedelta(resolution)):
+                    dates, vals = resample_series(dates, vals, resolution,
+                                                  agg)
+            except ValueError as e:
+                logger.warning(
+                    f"Cannot resample {feat.name} to {resolution}: {e}")
+            freq = None
+        try:
+            if format == 'arrow':
+                output = to_arrow(dates, vals, freq)
+            elif format == 'binary':
+                output = to_binary(dates, vals, freq)
+            else:
+                output = to_csv(dates, vals, freq)
+        except ImportError as e:
+            msg = f"Format {format} is not available: {e}"
+            raise HTTPException(status_code=400, detail=msg)
+        filename = f"<tonik_feature>.{FILE_ENDINGS[format]}"
+        # a complete response can be sent to several clients, see
+        # `offload`
+        return Response(output, media_type=MEDIA_TYPES[format],
+                        headers={"Content-Disposition":
+                                 f"attachment;filename={filename}"})
+
+    def features(self,
+                 group: str,
+                 name: NamesType,
+                 starttime: Union[str, None],
+                 endtime: Union[str, None],
+                 subdir: SubdirType = None,
+                 resolution: str = 'full',
+                 format: str = 'csv'):
+        """
+        Return several features as one table aligned on time, either as
+        CSV (default) or Arrow IPC stream ('arrow'). 1D features become
+        one column each and 2D features one column per frequency, named
+        '<feature>_<frequency>'. Time steps that are missing for some of
+        the features are empty.
+        """
+        if format not in ('csv', 'arrow'):
+            msg = f"Unknown format {format}; choose one of ('csv', 'arrow')"
+            raise HTTPException(status_code=400, detail=msg)
+        _st = self.preprocess_datetime(starttime)
+        _et = self.preprocess_datetime(endtime)
+        g = Storage(group, rootdir=self.rootdir,
+                    starttime=_st, endtime=_et,
+                    create=False)
+        c = g
+        if subdir:
+            c = g.get_substore(*subdir)
+        try:
+            # table_response aggregates with the median
+            xds = c.load_many(name, resolution=None if resolution == 'full'
+                              else resolution, method='median')
+        except (ValueError, FileNotFoundError) as e:
+            msg = f"Features {name} not found in directory {c.path}:"
+            msg += f"{e}"
+            raise HTTPException(status_code=404, detail=msg)
+        return self.table_response([(f, xds[f]) for f in name], resolution,
+                                   format, 'tonik_features')
+
+    def query(self,
+              group: str,
+              name: str,
+              starttime: Union[str, None],
+              endtime: Union[str, None],
+              selector: str = '*',
+              resolution: str = 'full',
+              format: str = 'csv'):
+        """
+        Return a feature for all channels matching `selector`, e.g.
+        'WIZ.*.HHZ', as one table aligned on time with one column per
+        channel, or per channel and frequency for 2D features. See
+        :meth:`tonik.Storage.query`.
+        """
+        if format not in ('csv', 'arrow'):
+            msg = f"Unknown format {format}; choose one of ('csv', 'arrow')"
+            raise HTTPException(status_code=400, detail=msg)
+        _st = self.preprocess_datetime(starttime)
+        _et = self.preprocess_datetime(endtime)
+        try:
+            g = Storage(group, rootdir=self.rootdir,
+                        starttime=_st, endtime=_et,
+                        create=False)
+            xda = g.query(name, selector,
+                          resolution=None if resolution == 'full'
+                          else resolution, method='median')
+        except (ValueError, FileNotFoundError) as e:
+            msg = f"Feature {name} not found for {selector} in group {group}:"
+            msg += f"{e}"
+            raise HTTPException(status_code=404, detail=msg)
+        return self.table_response(
+            [(str(ch), xda.sel(channel=ch)) for ch in xda.channel.values],
+            resolution, format, 'tonik_query')
+
+    def table_response(self, arrays, resolution, format, filename):
+        """
+        Encode (name, DataArray) pairs that share the same time axis as
+        one table. 2D arrays contribute one column per frequency, named
+        '<name>_<frequency>'.
+        """
+        columns = {}
+        dates = None
+        for label, xda in arrays:
+            dates = xda['datetime'].values
+            if xda.ndim > 1:
+                # assume first dimension is frequency
+                for freq, row in zip(xda.coords[xda.dims[0]].values,
+                                     xda.values):
+                    columns[f"{label}_{freq}"] = row
+            else:
+                columns[label] = xda.values
+        df = pd.DataFrame(columns, index=dates)
+        if resolution != 'full' and len(df) > 1:
+            try:
+                current_resolution = pd.Timedelta(
+                    df.index.to_series().diff().mean())
+                if current_resolution < pd.Timedelta(resolution):
+                    df = df.resample(pd.Timedelta(resolution)).median()
+            except ValueError:
+                logger.warning(
+                    f"Cannot resample {filename} to {resolution}")
+        columns = {col: df[col].values for col in df.columns}
+        try:
+            if format == 'arrow':
+                output = to_arrow_table(df.index.values, columns)
+            else:
+                output = to_csv_table(df.index.values, columns)
+        except ImportError as e:
+            msg = f"Format {format} is not available: {e}"
+            raise HTTPException(status_code=400, detail=msg)
+        filename = f"<{filename}>.{FILE_ENDINGS[format]}"
+        # a complete response can be sent to several clients, see
+        # `offload`
+        return Response(output, media_type=MEDIA_TYPES[format],
+                        headers={"Content-Disposition":
+                                 f"attachment;filename={filename}"})
+
+    def stream_feature(self, c, name, format, log, normalise):
+        """
+        Stream a feature at full resolution.
+
+        The feature is read and encoded in blocks of at most
+        `self.block_size` values so memory use does not depend on the
+        length of the requested window. As the length of the response
+        is not known in advance it is sent with chunked transfer
+        encoding. Windows that fit into a single block are sent as one
+        complete response instead.
+        """
+        order = 'time' if format == 'binary' else 'frequency'
+        raw = self.feature_blocks(c, name, log, normalise, order)
+        try:
+            head = list(itertools.islice(raw, 2))
+            blocks = ENCODERS[format](itertools.chain(head, raw))
+            first = next(blocks)
+            if len(head) < 2:
+                parts = [first, *blocks]
+        except ValueError as e:
+            msg = f"Feature {name} not found in directory {c.path}:"
+            msg += f"{e}"
+            raise HTTPException(status_code=404, detail=msg)
+        except ImportError as e:
+            msg = f"Format {format} is not available: {e}"
+            raise HTTPException(status_code=400, detail=msg)
+        filename = f"<tonik_feature>.{FILE_ENDINGS[format]}"
+        headers = {"Content-Disposition": f"attachment;filename={filename}"}
+        if len(head) < 2:
+            # the window fits into a single block, so the response is
+            # sent complete, which identical requests can share, see
+            # `offload`
+            output = ('' if isinstance(first, str) else b'').join(parts)
+            return Response(output, media_type=MEDIA_TYPES[format],
+                            headers=headers)
+        return StreamingResponse(self.iterate(itertools.chain([first], blocks)),
+                                 media_type=MEDIA_TYPES[format],
+                                 headers=headers)
+
+    def feature_blocks(self, c, name, log, normalise, order='frequency'):
+        """
+        Yield (dates, values, freqs) blocks of a feature at full
+        resolution. `log` and `normalise` only apply to 2D features.
+        Normalising requires a first pass over the data to find the
+        value range.
+        """
+        def transform(block):
+            vals = block.values
+            if log and name != 'sonogram':
+                vals = 10*np.log10(vals)
+            return vals
+
+        vmin, vmax = np.inf, -np.inf
+        if normalise:
+            for block in c.iter_blocks(name, maxvalues=self.block_size,
+                                       order=order):
+                if block.ndim > 1:
+                    vals = transform(block)
+                    vmin = min(vmin, np.nanmin(vals, initial=np.inf))
+                    vmax = max(vmax, np.nanmax(vals, initial=-np.inf))
+        for block in c.iter_blocks(name, maxvalues=self.block_size,
+                                   order=order):
+            dates = block.coords['datetime'].values
+            if block.ndim > 1:
+                vals = transform(block)
+                if normalise:
+                    vals = (vals - vmin) / (vmax - vmin)
+                yield dates, vals, block.coords[block.dims[0]].values
+            else:
+                yield dates, block.values, None
+
+    def aggregate_feature(self, resolution, verticalres, feat, nfreqs, dates,
+                          agg='mean'):
+        """
+        Resample a 2D feature to about one value per `resolution` and at
+        most `verticalres` frequencies, see :func:`tonik.resample.resample`.
+        """
+        resolution = pd.Timedelta(resolution).to_timedelta64()
+        canvas_x = max(int((dates[-1] - dates[0]) / resolution), 1)
         canvas_y = min(nfreqs, verticalres)
-        dates = date2num(dates.astype('datetime64[us]').astype(datetime),
-                         units='hours since 1970-01-01 00:00:00.0',
-                         calendar='gregorian')
-        feat = feat.assign_coords({'datetime': dates})
-        cvs = dsh.Canvas(plot_width=canvas_x,
-                         plot_height=canvas_y)
-        agg = cvs.raster(source=feat)
-        freq_dim = feat.dims[0]
-        freq, d, spec = agg.coords[freq_dim].values, agg.coords['datetime'].values, agg.data
-        dates = num2pydate(
-            d, units='hours since 1970-01-01 00:00:00.0', calendar='gregorian')
+        # milliseconds since 1970 are exact as float64
+        epoch_ms = dates.astype('datetime64[ms]').astype(np.int64)
+        feat = feat.assign_coords({'datetime': epoch_ms.astype(float)})
+        spec, freq, d = resample(feat, canvas_x, canvas_y, agg,
+                                 self.block_size)
+        dates = np.round(d).astype(np.int64).astype('datetime64[ms]')
         return freq, dates, spec
 
-    async def inventory(self, group: str, subdir: SubdirType = None, tree: bool = True) -> InventoryReturnType:
+    def inventory(self, group: str, subdir: SubdirType = None, tree: bool = True,
+                  refresh: bool = False) -> InventoryReturnType:
         sg = Storage(group, rootdir=self.rootdir, create=False)
         try:
-            c = sg.get_substore(*subdir)
+            sg.get_substore(*subdir)
         except TypeError:
-            c = sg
+            subdir = []
         except FileNotFoundError:
             msg = "Directory {} not found.".format(
                 '/'.join([sg.path] + subdir))
             raise HTTPException(status_code=404, detail=msg)
-        if tree and not subdir:
-            return sg.to_dict()
-        else:
-            dir_contents = os.listdir(c.path)
-            if 'labels.json' in dir_contents:
-                dir_contents.remove('labels.json')
-            return [fn.replace('.nc', '').replace('.zarr', '') for fn in dir_contents]
+        return sg.inventory(*subdir, tree=tree, refresh=refresh)
 
-    async def labels(self, group: str, subdir: SubdirType = None, starttime: Optional[str] = None, endtime: Optional[str] = None):
+    def labels(self, group: str, subdir: SubdirType = None, starttime: Optional[str] = None, endtime: Optional[str] = None):
         _st = self.preprocess_datetime(starttime)
         _et = self.preprocess_datetime(endtime)
         sg = Storage(group, rootdir=self.rootdir,
@@ -179,14 +507,50 @@ class TonikAPI:
             raise HTTPException(status_code=404, detail=msg)
         return c.get_labels()
 
+    def metadata(self, group: str, subdir: SubdirType = None,
+                 name: Annotated[Union[List[str], None], Query()] = None):
+        """
+        Return the time extent, sizes, resolution, dtype and modification
+        time of the features of a store without reading the data, see
+        :meth:`tonik.Path.metadata`.
+        """
+        sg = Storage(group, rootdir=self.rootdir, create=False)
+        try:
+            c = sg.get_substore(*subdir)
+        except TypeError:
+            c = sg
+        except FileNotFoundError:
+            msg = "Directory {} not found.".format(
+                '/'.join([sg.path] + subdir))
+            raise HTTPException(status_code=404, detail=msg)
+        try:
+            return c.metadata(name)
+        except (FileNotFoundError, KeyError) as e:
+            msg = f"Feature {name} not found in directory {c.path}: {e}"
+            raise HTTPException(status_code=404, detail=msg)
+
+
+def _freeze(value):
+    # hashable version of request parameters
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
 
 def main(argv=None):
     parser = ArgumentParser()
     parser.add_argument("--rootdir", default='/tmp')
     parser.add_argument("-p", "--port", default=8003, type=int)
     parser.add_argument("--host", default='0.0.0.0')
+    parser.add_argument("--max-workers", default=8, type=int,
+                        help="Maximum number of requests reading data at once")
+    parser.add_argument("--timeout", default=300., type=float,
+                        help="Request timeout in seconds")
     args = parser.parse_args(argv)
-    ta = TonikAPI(args.rootdir)
+    ta = TonikAPI(args.rootdir, max_workers=args.max_workers,
+                  timeout=args.timeout)
     uvicorn.run(ta.app, host=args.host, port=args.port)
 
 
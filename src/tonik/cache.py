@@ -0,0 +1,386 @@
+import atexit
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def _open_dataset(filename, group, engine):
+    """
+    Open a dataset without holding an HDF5 file lock.
+
+    A cached handle stays open for a long time, so for netCDF files we
+    disable HDF5 file locking; otherwise a reader would block writers in
+    other processes.
+    """
+    if engine == 'h5raw':
+        # the file itself, for reads that bypass xarray
+        import h5py
+        return h5py.File(filename, 'r', locking=False)
+    if engine == 'h5netcdf':
+        import h5netcdf
+        from xarray.backends import H5NetCDFStore
+        h5f = h5netcdf.File(filename, 'r', locking=False)
+        try:
+            return xr.open_dataset(H5NetCDFStore(h5f, group=group))
+        except Exception:
+            h5f.close()
+            raise
+    return xr.open_dataset(filename, group=group, engine=engine)
+
+
+# file managers of datasets opened with `open_chunked`, by file name
+_chunked_files = {}
+_chunked_lock = threading.Lock()
+
+
+def open_chunked(filename, group, engine, chunks):
+    """
+    Open a dataset backed by dask arrays with the given `chunks`, see
+    :func:`xarray.open_dataset`. Chunk sizes given per dimension are
+    rounded up to whole chunks of the file as reading parts of a stored
+    chunk several times is slow.
+
+    The dataset isn't cached. Its file is closed by :func:`invalidate`
+    like cached handles and is reopened by xarray when the data is read
+    again.
+    """
+    kwargs = {}
+    if engine == 'h5netcdf':
+        kwargs['driver_kwds'] = dict(locking=False)
+    ds = xr.open_dataset(filename, group=group, engine=engine, **kwargs)
+    manager = getattr(getattr(ds._close, '__self__', None), '_manager', None)
+    if manager is not None:
+        with _chunked_lock:
+            _chunked_files.setdefault(os.path.abspath(filename),
+                                      weakref.WeakSet()).add(manager)
+    if isinstance(chunks, dict):
+        chunks = dict(chunks)
+        for var in ds.data_vars.values():
+            stored = var.encoding.get('preferred_chunks', {})
+            for dim, size in stored.items():
+                if isinstance(chunks.get(dim), int) and chunks[dim] > 0:
+                    chunks[dim] = -(-chunks[dim] // size) * size
+    return ds.chunk(chunks)
+
+
+def _close_chunked(filename):
+    with _chunked_lock:
+        managers = list(_chunked_files.pop(os.path.abspath(filename), []))
+    for manager in managers:
+        manager.close()
+
+
+def file_mtime(filename, group=None):
+    """
+    Return a token that changes whenever the file is modified.
+
+    For zarr stores, which are directories, the metadata files of the
+    root, the group and the time coordinate are checked as these are
+    rewritten on every append.
+    """
+    candidates = [filename]
+    if os.path.isdir(filename):
+        for subdir in ['', group or '', os.path.join(group or '', 'datetime')]:
+            for meta in ['zarr.json', '.zmetadata', '.zarray']:
+                candidates.append(os.path.join(filename, subdir, meta))
+    token = (0, 0)
+    for _c in candidates:
+        try:
+            st = os.stat(_c)
+        except FileNotFoundError:
+            continue
+        token = max(token, (st.st_mtime_ns, st.st_size))
+    return token
+
+
+class _Entry(object):
+    def __init__(self, dataset, mtime):
+        self.dataset = dataset
+        self.mtime = mtime
+        self.refcount = 0
+        self.evicted = False
+
+    def close(self):
+        self.evicted = True
+        if self.refcount == 0:
+            self.dataset.close()
+
+
+class DatasetCache(object):
+    """
+    Process-wide LRU cache of open datasets.
+
+    Datasets are keyed by (filename, group, engine) and are reopened
+    if the file's modification time changed since it was opened.
+    Entries that are evicted while in use are closed once the last
+    user releases them.
+
+    :param maxsize: Maximum number of open datasets.
+    :type maxsize: int
+
+    >>> cache = DatasetCache(maxsize=16)
+    >>> with cache.open('/tmp/rsam.nc', 'original', 'h5netcdf') as ds:
+    ...     rsam = ds['rsam'].load()
+    >>> cache.info()
+    CacheInfo(hits=0, misses=1, maxsize=16, currsize=1)
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def open(self, filename, group, engine):
+        """
+        Return an open dataset, reusing a cached handle if possible.
+        """
+        entry = self._acquire(filename, group, engine)
+        try:
+            yield entry.dataset
+        finally:
+            with self._lock:
+                entry.refcount -= 1
+                if entry.evicted and entry.refcount == 0:
+                    entry.dataset.close()
+
+    def _acquire(self, filename, group, engine):
+        key = (os.path.abspath(filename), group, engine)
+        mtime = file_mtime(filename, group)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.mtime == mtime:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                entry.refcount += 1
+                return entry
+            if entry is not None:
+                del self._entries[key]
+                entry.close()
+            self.misses += 1
+        # open outside of the lock so slow opens don't serialise readers
+        entry = _Entry(_open_dataset(filename, group, engine), mtime)
+        entry.refcount += 1
+        with self._lock:
+            if self.maxsize > 0:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    old.close()
+                self._entries[key] = entry
+                while len(self._entries) > self.maxsize:
+                    _, old = self._entries.popitem(last=False)
+                    old.close()
+            else:
+                entry.evicted = True
+        return entry
+
+    def invalidate(self, filename=None):
+        """
+        Close and drop cached datasets for `filename` or all datasets
+        if `filename` is None.
+        """
+        path = None if filename is None else os.path.abspath(filename)
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if path is None or key[0] == path:
+                    self._entries.pop(key).close()
+
+    def clear(self):
+        """
+        Drop all cached datasets and reset the counters.
+        """
+        self.invalidate()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Return cache statistics.
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._entries))
+
+
+SliceCacheInfo = namedtuple('SliceCacheInfo', ['hits', 'misses', 'refreshes',
+                                               'maxbytes', 'currbytes'])
+
+
+class _SliceEntry(object):
+    def __init__(self, data, mtime, created):
+        self.data = data
+        self.mtime = mtime
+        self.created = created
+        self.nbytes = data.nbytes
+
+
+class SliceCache(object):
+    """
+    Memory bounded LRU cache of decoded feature slices.
+
+    Requested time windows are widened to multiples of `bucket` so
+    that windows relative to 'now', which shift by a few seconds on
+    every dashboard refresh, map onto the same cache entry. If the file
+    was modified since an entry was read, only the trailing bucket of
+    the entry is re-read and spliced onto the cached data. Entries
+    older than `ttl` seconds are read again in full, which bounds how
+    long backfilled data can stay hidden.
+
+    :param maxbytes: Maximum size of all cached arrays in bytes.
+    :type maxbytes: int
+    :param ttl: Time-to-live of an entry in seconds.
+    :type ttl: float
+    :param bucket: Granularity of cached time windows.
+    :type bucket: str
+    """
+
+    def __init__(self, maxbytes=256 * 2**20, ttl=300., bucket='1h'):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.bucket = bucket
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.currbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _window(self, starttime, endtime):
+        bstart = bend = None
+        if starttime is not None:
+            bstart = pd.Timestamp(starttime).floor(self.bucket)
+        if endtime is not None:
+            bend = pd.Timestamp(endtime).ceil(self.bucket)
+        return bstart, bend
+
+    def read(self, filename, group, feature, starttime, endtime, reader):
+        """
+        Return the slice of `feature` between `starttime` and `endtime`.
+
+        `reader(starttime, endtime)` is called to load missing data and
+        has to return a :class:`xarray.DataArray` with a 'datetime'
+        dimension.
+        """
+        if self.maxbytes <= 0:
+            return reader(starttime, endtime)
+        bstart, bend = self._window(starttime, endtime)
+        key = (os.path.abspath(filename), group, feature, bstart, bend)
+        mtime = file_mtime(filename, group)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.created > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is not None and entry.mtime == mtime:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                data = entry.data
+            else:
+                data = None
+        if data is None:
+            if entry is not None:
+                data = self._refresh(entry, bstart, bend, reader)
+                created = entry.created
+                with self._lock:
+                    self.refreshes += 1
+            else:
+                data = reader(bstart, bend)
+                created = now
+                with self._lock:
+                    self.misses += 1
+            self._insert(key, _SliceEntry(data, mtime, created))
+        xd_index = dict(datetime=slice(starttime, endtime))
+        return data.loc[xd_index].copy(deep=True)
+
+    def _refresh(self, entry, bstart, bend, reader):
+        cached = entry.data
+        times = cached['datetime'].values
+        if times.size == 0:
+            return reader(bstart, bend)
+        tail_start = pd.Timestamp(times[-1]).floor(self.bucket)
+        if bstart is not None:
+            tail_start = max(tail_start, bstart)
+        idx = np.searchsorted(times, np.datetime64(tail_start))
+        tail = reader(tail_start, bend)
+        data = xr.concat([cached.isel(datetime=slice(0, idx)), tail],
+                         dim='datetime')
+        data.attrs = tail.attrs
+        return data
+
+    def _insert(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if entry.nbytes > self.maxbytes:
+                return
+            self._entries[key] = entry
+            self.currbytes += entry.nbytes
+            while self.currbytes > self.maxbytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.currbytes -= entry.nbytes
+
+    def invalidate(self, filename=None):
+        """
+        Drop cached slices read from `filename` or all slices if
+        `filename` is None.
+        """
+        path = None if filename is None else os.path.abspath(filename)
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if path is None or key[0] == path:
+                    self._remove(key)
+
+    def clear(self):
+        """
+        Drop all cached slices and reset the counters.
+        """
+        self.invalidate()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.refreshes = 0
+
+    def info(self):
+        """
+        Return cache statistics.
+        """
+        with self._lock:
+            return SliceCacheInfo(self.hits, self.misses, self.refreshes,
+                                  self.maxbytes, self.currbytes)
+
+
+# Open dataset handles and decoded slices shared by all stores in this
+# process
+dataset_cache = DatasetCache(maxsize=128)
+slice_cache = SliceCache(maxbytes=256 * 2**20, ttl=300., bucket='1h')
+# close handles before h5py is torn down at interpreter exit
+atexit.register(dataset_cache.invalidate)
+
+
+def invalidate(filename):
+    """
+    Drop all cached handles and slices of `filename`.
+
+    Writers have to call this before and after modifying a file as HDF5
+    refuses to write to a file that is still open for reading in the
+    same process.
+    """
+    dataset_cache.invalidate(filename)
+    slice_cache.invalidate(filename)
+    _close_chunked(filename)
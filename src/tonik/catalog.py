@@ -0,0 +1,246 @@
+"""
+Metadata catalog of the features of a store.
+
+Every store keeps a JSON file next to its feature files that lists for
+each feature the first and last time with data, the sizes as stored,
+the resolution in hours, dtype and the time the file was last
+modified::
+
+    {"rsam": {"starttime": "2023-01-01T00:00:00",
+              "endtime": "2023-01-10T23:50:00",
+              "sizes": {"datetime": 1440},
+              "resolution": 0.16666666666666666,
+              "dtype": "float64",
+              "modified": "2023-01-11T00:05:12.123456"}}
+
+When features are saved, their entries are extended by the time steps
+that were written, so the cost of a save doesn't depend on the length
+of the archive. Entries are recomputed from the feature file when the
+modification time of the file no longer matches the catalog, e.g. after
+the file was written by another process, so reading the metadata of a
+feature normally does not touch its data file. Writers of the catalog
+hold its lock, see :mod:`tonik.locking`.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from .cache import _open_dataset, file_mtime
+from .h5read import _attr, dimensions
+from .inventory import write_json
+from .locking import file_lock, retry_read
+from .xarray2zarr import _open_lazy
+
+CATALOG_FILE = '.tonik_catalog.json'
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def catalog_path(path):
+    return os.path.join(path, CATALOG_FILE)
+
+
+def _timestamp(value):
+    return pd.Timestamp(value).round('1ms').isoformat()
+
+
+def _data_extent(xda, blocksize=2**20):
+    """
+    Return the indices of the first and last time step with data.
+
+    Archives can have long stretches without data at the start, so the
+    data is scanned in blocks from both ends.
+    """
+    axis = xda.get_axis_num('datetime')
+    ntimes = xda.shape[axis]
+    step = max(blocksize // max(xda.size // max(ntimes, 1), 1), 1)
+
+    def valid(start, stop):
+        values = xda.isel(datetime=slice(start, stop)).values
+        other = tuple(i for i in range(values.ndim) if i != axis)
+        return np.flatnonzero(np.any(~np.isnan(values), axis=other))
+
+    first = last = None
+    for start in range(0, ntimes, step):
+        idx = valid(start, start + step)
+        if idx.size:
+            first = start + idx[0]
+            break
+    if first is None:
+        return None, None
+    for stop in range(ntimes, first, -step):
+        idx = valid(max(stop - step, first), stop)
+        if idx.size:
+            last = max(stop - step, first) + idx[-1]
+            break
+    return first, last
+
+
+def feature_metadata(filename, feature, engine):
+    """
+    Read the metadata of a feature from its file.
+    """
+    return retry_read(lambda: _feature_metadata(filename, feature, engine),
+                      filename, 'original')
+
+
+def _feature_metadata(filename, feature, engine):
+    # don't keep the file open in the dataset cache of the writer
+    with _open_dataset(filename, 'original', engine) as ds:
+        xda = ds[feature]
+        times = ds.indexes['datetime']
+        resolution = ds.attrs.get('resolution')
+        if resolution is None and times.size > 1:
+            resolution = (times[-1] - times[-2]) / pd.Timedelta(1, 'h')
+        first, last = _data_extent(xda)
+        meta = dict(
+            starttime=None if first is None else _timestamp(times[first]),
+            endtime=None if last is None else _timestamp(times[last]),
+            sizes={dim: int(size) for dim, size in xda.sizes.items()},
+            resolution=None if resolution is None else float(resolution),
+            dtype=np.dtype(xda.dtype).name)
+    meta['modified'] = _modified(file_mtime(filename))
+    return meta
+
+
+def _modified(token):
+    return datetime.fromtimestamp(token[0] / 1e9).isoformat()
+
+
+def _stored(filename, feature, engine):
+    # sizes and resolution attribute of a feature, read without decoding
+    # its time axis
+    if engine == 'h5netcdf':
+        with _open_dataset(filename, None, 'h5raw') as h5f:
+            group = h5f['original']
+            var = group[feature]
+            sizes = dict(zip(dimensions(var), var.shape))
+            resolution = _attr(group, 'resolution')
+    else:
+        with _open_lazy(filename, 'original') as ds:
+            sizes = dict(ds[feature].sizes)
+            resolution = ds.attrs.get('resolution')
+    return ({dim: int(size) for dim, size in sizes.items()},
+            None if resolution is None else float(resolution))
+
+
+def _extend(entry, filename, feature, engine, xda):
+    """
+    Return `entry` updated after `xda` was written to `filename`, or
+    None if it has to be recomputed.
+    """
+    entry = dict(entry)
+    axis = xda.get_axis_num('datetime')
+    other = tuple(i for i in range(xda.ndim) if i != axis)
+    valid = xda['datetime'].values[
+        np.any(~np.isnan(xda.values), axis=other)]
+    if valid.size:
+        for key, value, pick in [('starttime', valid[0], min),
+                                 ('endtime', valid[-1], max)]:
+            value = pd.Timestamp(value)
+            if entry[key] is not None:
+                value = pick(value, pd.Timestamp(entry[key]))
+            entry[key] = _timestamp(value)
+    entry['sizes'], resolution = _stored(filename, feature, engine)
+    if entry['resolution'] is None:
+        if resolution is None and entry['sizes']['datetime'] > 1:
+            # stores without a resolution attribute
+            return None
+        entry['resolution'] = resolution
+    token = file_mtime(filename)
+    entry['modified'] = _modified(token)
+    entry['token'] = list(token)
+    return entry
+
+
+def _read(path):
+    filename = catalog_path(path)
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return {}
+    # the file is replaced as a whole, so the inode changes on every write
+    token = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _lock:
+        cached = _cache.get(filename)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+    try:
+        with open(filename) as f:
+            catalog = json.load(f)
+    except ValueError:
+        return {}
+    with _lock:
+        _cache[filename] = (token, catalog)
+    return catalog
+
+
+def load_metadata(path, filenames, engine, refresh=False):
+    """
+    Return the metadata of the features in `filenames`, a dictionary of
+    feature name to file name, updating the catalog of the store at
+    `path` where it is out of date. With `refresh` all entries are read
+    from the feature files.
+    """
+    catalog = dict(_read(path))
+    changed = False
+    for feature, filename in filenames.items():
+        token = list(file_mtime(filename))
+        entry = catalog.get(feature)
+        if refresh or entry is None or entry.get('token') != token:
+            entry = feature_metadata(filename, feature, engine)
+            entry['token'] = token
+            catalog[feature] = entry
+            changed = True
+    if changed:
+        try:
+            with file_lock(catalog_path(path)):
+                # keep entries other processes added in the meantime
+                _write(path, dict(_read(path), **{
+                    feature: catalog[feature] for feature in filenames}))
+        except OSError:
+            # read-only archive, e.g. served by the API
+            pass
+    return {feature: {key: value for key, value in catalog[feature].items()
+                      if key != 'token'}
+            for feature in filenames}
+
+
+def update_metadata(path, filenames, engine, data, tokens):
+    """
+    Update the catalog of the store at `path` after `data` was written
+    to the features in `filenames`, a dictionary of feature name to file
+    name. `tokens` are the modification tokens of the files before the
+    write, see :func:`tonik.cache.file_mtime`.
+
+    Entries that were up to date before the write are extended by the
+    time steps of `data` with data, without reading the time axis or the
+    data of the files. Time steps overwritten with NaN don't shrink the
+    extent. All other entries, and all entries if `data` is None, are
+    recomputed when they are requested next.
+    """
+    with file_lock(catalog_path(path)):
+        catalog = dict(_read(path))
+        for feature, filename in filenames.items():
+            entry = catalog.pop(feature, None)
+            if (data is None or entry is None or
+                    entry.get('token') != list(tokens[feature])):
+                continue
+            try:
+                entry = _extend(entry, filename, feature, engine,
+                                data[feature])
+            except (OSError, KeyError, ValueError):
+                # e.g. the file was replaced in the meantime
+                continue
+            if entry is not None:
+                catalog[feature] = entry
+        _write(path, catalog)
+
+
+def _write(path, catalog):
+    write_json(catalog_path(path), catalog)
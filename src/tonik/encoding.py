@@ -0,0 +1,192 @@
+"""
+Storage encoding of feature files.
+
+An encoding is a dictionary with the following, optional, keys:
+
+dtype : str
+    Data type of the stored values, e.g. 'float32'.
+chunks : dict
+    Chunk size per dimension, e.g. {'datetime': 4096, 'frequency': 32}.
+    Dimensions that are not listed are stored in a single chunk, except
+    for 'datetime' for which the backend default is used.
+compression : str
+    One of 'gzip', 'lzf', 'zstd', 'blosc' or 'lz4'. For netCDF files
+    'zstd', 'blosc' and 'lz4' require the hdf5plugin package.
+compression_level : int
+    Compression level, by default the compressor's default.
+shuffle : bool
+    Apply the byte shuffle filter before compression.
+
+The encoding is recorded in the 'encoding' attribute of the group it was
+created with and is reused for all groups that are created later, e.g.
+pyramid levels, and when a group is rewritten.
+"""
+import json
+
+import numpy as np
+
+ENCODING_KEYS = ('dtype', 'chunks', 'compression', 'compression_level',
+                 'shuffle')
+
+COMPRESSORS = ('gzip', 'lzf', 'zstd', 'blosc', 'lz4')
+
+
+def normalize_encoding(encoding):
+    """
+    Validate an encoding and return it as a plain dictionary.
+    """
+    if encoding is None:
+        return None
+    if isinstance(encoding, str):
+        encoding = json.loads(encoding)
+    unknown = set(encoding) - set(ENCODING_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown encoding options {sorted(unknown)}")
+    encoding = dict(encoding)
+    if 'dtype' in encoding:
+        encoding['dtype'] = np.dtype(encoding['dtype']).name
+    if encoding.get('compression') not in (None,) + COMPRESSORS:
+        raise ValueError(
+            f"Unknown compression {encoding['compression']}")
+    if 'chunks' in encoding:
+        encoding['chunks'] = {dim: int(size)
+                              for dim, size in encoding['chunks'].items()}
+    return encoding
+
+
+def feature_encoding(encoding, feature):
+    """
+    Return the encoding of `feature` from either a single encoding for
+    all features or a dictionary of encodings keyed by feature name.
+    """
+    if encoding is None:
+        return None
+    if feature in encoding and isinstance(encoding[feature], dict):
+        return normalize_encoding(encoding[feature])
+    if set(encoding) <= set(ENCODING_KEYS):
+        return normalize_encoding(encoding)
+    return None
+
+
+def dumps(encoding):
+    return json.dumps(encoding, sort_keys=True)
+
+
+def _chunks(encoding, dims, shape, default_time):
+    chunks = encoding.get('chunks')
+    if not chunks:
+        return None
+    sizes = []
+    for dim, size in zip(dims, shape):
+        if dim in chunks:
+            sizes.append(chunks[dim])
+        elif dim == 'datetime':
+            sizes.append(default_time)
+        else:
+            sizes.append(size)
+    return tuple(max(int(s), 1) for s in sizes)
+
+
+def _hdf5plugin(name, level, shuffle):
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError(
+            f"Compression '{name}' for netCDF files requires hdf5plugin")
+    if name == 'zstd':
+        kwargs = {} if level is None else dict(clevel=level)
+        return dict(hdf5plugin.Zstd(**kwargs))
+    if name == 'lz4':
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=level or 5,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE
+                                     if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    return dict(hdf5plugin.Blosc(cname='zstd', clevel=level or 5,
+                                 shuffle=hdf5plugin.Blosc.SHUFFLE
+                                 if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+
+
+def h5_encoding(encoding, dims, shape):
+    """
+    Return keyword arguments for :meth:`h5netcdf.Group.create_variable`.
+    """
+    kwargs = {}
+    if not encoding:
+        return kwargs
+    chunks = _chunks(encoding, dims, shape, default_time=1024)
+    if chunks is not None:
+        kwargs['chunks'] = chunks
+    name = encoding.get('compression')
+    level = encoding.get('compression_level')
+    shuffle = encoding.get('shuffle', False)
+    if name in ('gzip', 'lzf'):
+        kwargs['compression'] = name
+        if name == 'gzip' and level is not None:
+            kwargs['compression_opts'] = level
+        kwargs['shuffle'] = shuffle
+    elif name is not None:
+        kwargs.update(_hdf5plugin(name, level, shuffle))
+        # blosc shuffles internally
+        if name == 'zstd':
+            kwargs['shuffle'] = shuffle
+    elif shuffle:
+        kwargs['shuffle'] = True
+    return kwargs
+
+
+def netcdf_encoding(encoding, dims, shape):
+    """
+    Return a variable encoding for :meth:`xarray.Dataset.to_netcdf`.
+    """
+    kwargs = h5_encoding(encoding, dims, shape)
+    if 'chunks' in kwargs:
+        kwargs['chunksizes'] = kwargs.pop('chunks')
+    if encoding and 'dtype' in encoding:
+        kwargs['dtype'] = encoding['dtype']
+    return kwargs
+
+
+def _zarr_compressor(name, level, shuffle):
+    import zarr
+    if int(zarr.__version__.split('.')[0]) < 3:
+        import numcodecs
+        shuffle = numcodecs.Blosc.SHUFFLE if shuffle \
+            else numcodecs.Blosc.NOSHUFFLE
+        if name == 'gzip':
+            return 'compressor', numcodecs.GZip(level=level or 1)
+        if name == 'zstd':
+            return 'compressor', numcodecs.Zstd(level=level or 0)
+        cname = 'lz4' if name == 'lz4' else 'zstd'
+        return 'compressor', numcodecs.Blosc(cname=cname, clevel=level or 5,
+                                             shuffle=shuffle)
+    from zarr.codecs import BloscCodec, GzipCodec, ZstdCodec
+    if name == 'gzip':
+        return 'compressors', (GzipCodec(level=level or 1),)
+    if name == 'zstd':
+        return 'compressors', (ZstdCodec(level=level or 0),)
+    cname = 'lz4' if name == 'lz4' else 'zstd'
+    return 'compressors', (BloscCodec(cname=cname, clevel=level or 5,
+                                      shuffle='shuffle' if shuffle
+                                      else 'noshuffle'),)
+
+
+def zarr_encoding(encoding, dims, shape):
+    """
+    Return a variable encoding for :meth:`xarray.Dataset.to_zarr`.
+    """
+    kwargs = {}
+    if not encoding:
+        return kwargs
+    if 'dtype' in encoding:
+        kwargs['dtype'] = encoding['dtype']
+    chunks = _chunks(encoding, dims, shape, default_time=shape[
+        list(dims).index('datetime')] if 'datetime' in dims else 1)
+    if chunks is not None:
+        kwargs['chunks'] = chunks
+    name = encoding.get('compression')
+    if name == 'lzf':
+        raise ValueError("Compression 'lzf' is not supported by zarr")
+    if name is not None:
+        key, value = _zarr_compressor(name, encoding.get('compression_level'),
+                                      encoding.get('shuffle', False))
+        kwargs[key] = value
+    return kwargs
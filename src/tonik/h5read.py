@@ -0,0 +1,179 @@
+"""
+Direct reads of features from netCDF files written by tonik.
+
+The netCDF backend stores features on a regular time grid, so the index
+range of a time window can be computed from the first time stamp and
+the resolution of the archive. The values are then read with a single
+hyperslab selection, bypassing xarray's decoding of the whole time
+coordinate.
+"""
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.coding.times import decode_cf_datetime
+
+CALENDARS = ('standard', 'gregorian', 'proleptic_gregorian')
+
+HIDDEN_ATTRS = ('CLASS', 'NAME', 'DIMENSION_LIST', 'REFERENCE_LIST')
+
+
+@lru_cache(maxsize=64)
+def _reference(units):
+    # origin of a numerical time axis with units 'hours since ...'
+    return np.datetime64(pd.Timestamp(units.split('since', 1)[1].strip())
+                         .tz_localize(None), 'ns')
+
+
+def _hours(time, units):
+    # convert times to the numerical time axis of the file
+    return ((np.asarray(time, dtype='datetime64[ns]') - _reference(units)) /
+            np.timedelta64(1, 'h'))
+
+
+def _attr(obj, name, default=None):
+    value = obj.attrs.get(name, default)
+    # netCDF stores scalar attributes as arrays of length one
+    if isinstance(value, np.ndarray) and value.shape == (1,):
+        value = value[0]
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def dimensions(dataset):
+    # names of the dimension scales attached to a dataset
+    return tuple(dim[0].name.rsplit('/', 1)[-1] for dim in dataset.dims)
+
+
+def group_attrs(group):
+    """
+    Return the attributes of a group without the ones used internally
+    by netCDF and HDF5.
+    """
+    return {key: _attr(group, key) for key in group.attrs
+            if not key.startswith('_') and key not in HIDDEN_ATTRS}
+
+
+def time_slice(group, starttime, endtime, timedim='datetime'):
+    """
+    Return the index range [start, stop) of the time steps between
+    `starttime` and `endtime`, both inclusive, or None if the group is
+    not stored on a regular grid.
+
+    The result is the same as a label based selection on the decoded
+    time coordinate.
+    """
+    times = group[timedim]
+    units = _attr(times, 'units', '')
+    calendar = _attr(times, 'calendar', 'standard')
+    resolution = _attr(group, 'resolution')
+    if (resolution is None or not units.startswith('hours since') or
+            calendar not in CALENDARS):
+        return None
+    ntimes = times.shape[0]
+    if ntimes == 0:
+        return 0, 0
+    t0 = float(times[0])
+
+    def index(time, side):
+        if time is None:
+            return 0 if side == 'left' else ntimes
+        # find a small window around the grid point and compare the
+        # decoded times like a label based selection would
+        i = int(np.floor((_hours(time, units) - t0) / resolution))
+        lo = min(max(i - 1, 0), ntimes)
+        hi = min(max(i + 3, 0), ntimes)
+        if lo == hi:
+            return lo
+        decoded = decode_cf_datetime(times[lo:hi], units, calendar)
+        return lo + int(np.searchsorted(decoded, np.datetime64(time, 'ns'),
+                                        side=side))
+
+    start = index(starttime, 'left')
+    stop = max(index(endtime, 'right'), start)
+    return start, stop
+
+
+def mappable(var):
+    """
+    Return True if the values of a :class:`h5py.Dataset` can be memory
+    mapped, i.e. they are stored contiguously without filters.
+    """
+    if var.chunks is not None or var.dtype.kind not in 'iuf':
+        return False
+    if 'scale_factor' in var.attrs or 'add_offset' in var.attrs:
+        return False
+    # None for external or compact datasets and if no space has been
+    # allocated yet
+    return var.id.get_offset() is not None
+
+
+def _memmap(var):
+    return np.memmap(var.file.filename, dtype=var.dtype, mode='r',
+                     offset=var.id.get_offset(), shape=var.shape)
+
+
+def _grid_start(group, timedim):
+    # first time stamp of a regular time axis; the last time stamp
+    # doesn't fit the grid while a time step is appended or the archive
+    # is shifted for a backfill, see tonik.xarray2netcdf
+    times = group[timedim]
+    ntimes = times.shape[0]
+    resolution = _attr(group, 'resolution')
+    if ntimes == 0 or resolution is None:
+        return None
+    first, last = float(times[0]), float(times[ntimes - 1])
+    resolution = float(resolution)
+    if not abs(last - first - (ntimes - 1) * resolution) < resolution / 2:
+        raise ValueError(f'Time axis of {group.name} is being written.')
+    return first
+
+
+def read_feature(group, feature, starttime, endtime, timedim='datetime',
+                 mmap=False):
+    """
+    Read a feature between `starttime` and `endtime` from an open
+    :class:`h5py.Group` of a netCDF file.
+
+    With `mmap` the values of features that are stored contiguously and
+    uncompressed are returned as a read-only memory-mapped view of the
+    file instead of being copied. Views are only returned if the window
+    doesn't contain fill values, other features are read normally.
+
+    Returns None if the group is not stored on a regular grid. Raises a
+    ValueError if the read overlapped with a write.
+    """
+    first = _grid_start(group, timedim)
+    tslice = time_slice(group, starttime, endtime, timedim)
+    if tslice is None:
+        return None
+    start, stop = tslice
+    var = group[feature]
+    dims = dimensions(var)
+    axis = dims.index(timedim)
+    index = [slice(None)] * len(dims)
+    index[axis] = slice(start, stop)
+    index = tuple(index)
+    fillvalue = var.attrs.get('_FillValue')
+    values = None
+    if mmap and mappable(var):
+        values = _memmap(var)[index]
+        if (fillvalue is not None and not np.isnan(fillvalue) and
+                np.any(values == fillvalue)):
+            values = None
+    if values is None:
+        values = var[index]
+        if fillvalue is not None and np.issubdtype(values.dtype, np.floating):
+            values[values == fillvalue] = np.nan
+    times = group[timedim]
+    coords = {timedim: decode_cf_datetime(
+        times[start:stop], _attr(times, 'units'),
+        _attr(times, 'calendar', 'standard'))}
+    for dim in dims:
+        if dim != timedim and dim in group:
+            coords[dim] = group[dim][:]
+    if _grid_start(group, timedim) != first:
+        raise ValueError(f'Time axis of {group.name} was shifted.')
+    return xr.DataArray(values, coords=coords, dims=dims, name=feature)
@@ -0,0 +1,284 @@
+"""
+Inventory index of a storage group.
+
+The index is a JSON file at the root of the group that lists the
+entries of every directory below the root that holds features, and the
+modification time of each directory when it was listed::
+
+    {"version": 2,
+     "dirs": {"": ["MDR", "WIZ"],
+              "MDR": ["00"],
+              "MDR/00": ["BHZ"],
+              "MDR/00/BHZ": ["rsam.nc", "ssam.nc"]},
+     "mtimes": {"": 1700000000000000000, ...}}
+
+It is updated whenever features are saved and rebuilt from the
+directory tree if it is missing. Adding, removing or renaming an entry
+changes the modification time of its directory, so every read of the
+index only checks the directories with a stat and lists again those
+that changed, e.g. because files were written with
+:func:`tonik.xarray2netcdf.xarray2netcdf` directly or deleted.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .locking import file_lock
+
+INVENTORY_FILE = '.tonik_inventory.json'
+INVENTORY_VERSION = 2
+# a directory modified less than this many nanoseconds before it is
+# listed can change again without a new modification time, so it is
+# listed again on the next read
+RECENT = 10**9
+FEATURE_ENDINGS = ('.nc', '.zarr')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def is_feature(name):
+    return name.endswith(FEATURE_ENDINGS)
+
+
+def feature_name(name):
+    for ending in FEATURE_ENDINGS:
+        if name.endswith(ending):
+            return name[:-len(ending)]
+    return name
+
+
+def is_hidden(name):
+    """
+    Return True for files that are not part of the inventory.
+    """
+    return name.startswith('.') or name == 'labels.json'
+
+
+def inventory_path(root):
+    return os.path.join(root, INVENTORY_FILE)
+
+
+def scan_inventory(root):
+    """
+    Build the index by walking the directory tree below `root`.
+    """
+    dirs, mtimes = {}, {}
+    _scan(root, '', dirs, mtimes)
+    return dict(version=INVENTORY_VERSION, dirs=dirs, mtimes=mtimes)
+
+
+def _scan(root, rel, dirs, mtimes):
+    # add directory `rel` and all directories below it to the index
+    subdirs = _list(root, rel, dirs, mtimes)
+    for name in subdirs:
+        _scan(root, _join(rel, name), dirs, mtimes)
+
+
+def _list(root, rel, dirs, mtimes):
+    # list the entries of directory `rel` and return its subdirectories
+    # that are stores
+    path = _abspath(root, rel)
+    # taken before listing, so later changes are found on the next read
+    mtimes[rel] = _mtime(path)
+    names = [n for n in os.listdir(path) if not is_hidden(n)]
+    # zarr stores are directories but are features, not stores
+    subdirs = sorted(n for n in names if not is_feature(n) and
+                     os.path.isdir(os.path.join(path, n)))
+    dirs[rel] = sorted(subdirs + [n for n in names if is_feature(n)])
+    return subdirs
+
+
+def _mtime(path):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if time.time_ns() - mtime < RECENT:
+        return None
+    return mtime
+
+
+def _join(rel, name):
+    return name if rel == '' else f"{rel}/{name}"
+
+
+def _abspath(root, rel):
+    return os.path.join(root, *rel.split('/')) if rel else root
+
+
+def _relpath(path, root):
+    rel = os.path.relpath(path, root)
+    return '' if rel == '.' else rel.replace(os.sep, '/')
+
+
+def revalidate(root, inventory):
+    """
+    Return the index with the entries of the directories that changed
+    since they were listed updated.
+    """
+    dirs = dict(inventory['dirs'])
+    mtimes = dict(inventory.get('mtimes', {}))
+    # parents first, so directories that were removed with their
+    # parent are skipped
+    for rel in sorted(dirs, key=lambda rel: rel.count('/') + bool(rel)):
+        if rel not in dirs:
+            continue
+        mtime = mtimes.get(rel)
+        path = _abspath(root, rel)
+        if mtime is not None and _mtime(path) == mtime:
+            continue
+        old = dirs[rel]
+        if not os.path.isdir(path):
+            _drop(rel, dirs, mtimes)
+            continue
+        subdirs = _list(root, rel, dirs, mtimes)
+        for name in old:
+            if not is_feature(name) and name not in subdirs:
+                _drop(_join(rel, name), dirs, mtimes)
+        for name in subdirs:
+            if name not in old:
+                _scan(root, _join(rel, name), dirs, mtimes)
+    return dict(version=INVENTORY_VERSION, dirs=dirs, mtimes=mtimes)
+
+
+def _drop(rel, dirs, mtimes):
+    # remove directory `rel` and all directories below it
+    for key in list(dirs):
+        if key == rel or key.startswith(rel + '/'):
+            del dirs[key]
+            mtimes.pop(key, None)
+
+
+def write_json(filename, data):
+    """
+    Write `data` to a temporary file first and move it into place so
+    readers never see a partial file.
+    """
+    dirname, basename = os.path.split(filename)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + basename)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _write(root, inventory):
+    write_json(inventory_path(root), inventory)
+
+
+def _read(root):
+    filename = inventory_path(root)
+    st = os.stat(filename)
+    # the file is replaced as a whole, so the inode changes on every write
+    token = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _lock:
+        cached = _cache.get(filename)
+        if cached is not None and cached[0] == token:
+            return token, cached[1]
+    with open(filename) as f:
+        inventory = json.load(f)
+    if inventory.get('version') != INVENTORY_VERSION:
+        raise ValueError(f"Unsupported inventory version in {filename}")
+    with _lock:
+        _cache[filename] = (token, inventory)
+    return token, inventory
+
+
+def load_inventory(root, refresh=False):
+    """
+    Return the index of the group at `root`, building it if it doesn't
+    exist yet or if `refresh` is True, and listing the directories that
+    changed since they were listed again.
+    """
+    inventory = None
+    if not refresh:
+        try:
+            token, stored = _read(root)
+        except (FileNotFoundError, ValueError):
+            pass
+        else:
+            inventory = revalidate(root, stored)
+            if inventory['dirs'] == stored['dirs']:
+                # only modification times changed, e.g. because features
+                # were appended to; keep them in memory instead of
+                # rewriting the file
+                filename = inventory_path(root)
+                with _lock:
+                    if _cache.get(filename, (None,))[0] == token:
+                        _cache[filename] = (token, inventory)
+                return inventory
+    if inventory is None:
+        inventory = scan_inventory(root)
+    try:
+        _write(root, inventory)
+    except OSError:
+        # read-only archive, e.g. served by the API
+        pass
+    return inventory
+
+
+def update_inventory(root, path, filenames):
+    """
+    Add the feature files `filenames` in directory `path` to the index
+    of the group at `root`.
+    """
+    # several writers may add features at the same time, don't lose
+    # their changes
+    with file_lock(inventory_path(root)):
+        _update(root, path, filenames)
+
+
+def _update(root, path, filenames):
+    try:
+        _, inventory = _read(root)
+    except (FileNotFoundError, ValueError):
+        # the new files are already on disk
+        load_inventory(root, refresh=True)
+        return
+    dirs = {key: list(value) for key, value in inventory['dirs'].items()}
+    rel = _relpath(path, root)
+    entries = [os.path.basename(f) for f in filenames]
+    changed = False
+    while True:
+        current = dirs.setdefault(rel, [])
+        new = [e for e in entries if e not in current]
+        if new:
+            dirs[rel] = sorted(current + new)
+            changed = True
+        if rel == '':
+            break
+        rel, _, entry = rel.rpartition('/')
+        entries = [entry]
+    if changed:
+        # directories without a modification time are listed again on
+        # the next read
+        _write(root, dict(version=INVENTORY_VERSION, dirs=dirs,
+                          mtimes=inventory.get('mtimes', {})))
+
+
+def inventory_tree(inventory, name, rel=''):
+    """
+    Return the index in the nested format of
+    :meth:`tonik.Storage.to_dict`.
+    """
+    children = []
+    for entry in inventory['dirs'].get(rel, []):
+        if is_feature(entry):
+            children.append(feature_name(entry))
+        else:
+            child = entry if rel == '' else f"{rel}/{entry}"
+            children.append(inventory_tree(inventory, entry, child))
+    return {name: children}
+
+
+def inventory_list(inventory, rel=''):
+    """
+    Return the names of the stores and features in directory `rel`.
+    """
+    return [feature_name(entry) for entry in inventory['dirs'].get(rel, [])]
@@ -0,0 +1,206 @@
+"""
+Coordination of concurrent writers and readers of a storage group.
+
+Writers of a feature hold an exclusive lock on a hidden lock file next
+to the feature file, e.g. ``.rsam.nc.lock`` for ``rsam.nc``, so several
+ingest processes can write to the same store. The lock is taken with
+:func:`fcntl.flock`, which also excludes other threads of the same
+process, and released when the process dies.
+
+Readers never take the lock. Files that are created or rewritten as a
+whole are written to a temporary file next to the final file first and
+then moved into place, so readers see either the old or the new file,
+never a partial one. Readers that still have the old file open keep
+reading it until they reopen the file. Appends and shifting backfills
+modify netCDF files in place, so a read that overlaps with one can fail
+or find the time axis half updated; readers retry in that case, see
+:func:`retry_read`.
+"""
+import os
+import shutil
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+from .cache import dataset_cache, file_mtime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# number of times a read that overlaps with a write is repeated
+READ_RETRIES = 5
+
+
+def lock_path(filename):
+    """
+    Return the name of the lock file of `filename`.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    return os.path.join(dirname, '.' + basename.lstrip('.') + '.lock')
+
+
+def _acquire(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            time.sleep(0.01)
+
+
+def _release(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(filename):
+    """
+    Hold an exclusive lock for writing `filename`, waiting until other
+    writers in this or other processes release it.
+    """
+    fd = os.open(lock_path(filename), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        _acquire(fd)
+        try:
+            yield
+        finally:
+            _release(fd)
+    finally:
+        os.close(fd)
+
+
+def is_locked(filename):
+    """
+    Return True if a writer holds the lock of `filename`. Never waits
+    for the lock.
+    """
+    try:
+        fd = os.open(lock_path(filename), os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        if fcntl is None:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return False
+    finally:
+        os.close(fd)
+
+
+def retry_read(read, filename, group=None, retries=READ_RETRIES):
+    """
+    Return the result of `read()`, repeating the call if it failed while
+    a writer modified `filename`. Other errors are raised after the
+    second attempt.
+    """
+    for attempt in range(retries + 1):
+        token = file_mtime(filename, group)
+        try:
+            return read()
+        except (OSError, KeyError, ValueError, RuntimeError):
+            # the first attempt may have used a handle that was opened
+            # during a write that finished within the resolution of the
+            # modification time, so it is always repeated once
+            if attempt == retries or (
+                    attempt > 0 and file_mtime(filename, group) == token
+                    and not is_locked(filename)):
+                raise
+            dataset_cache.invalidate(filename)
+            time.sleep(0.01 * 2 ** attempt)
+
+
+def temp_path(filename, dirname=None):
+    """
+    Return an unused hidden path next to `filename`, or in `dirname`,
+    for writing a replacement of `filename`.
+    """
+    parent, basename = os.path.split(os.path.abspath(filename))
+    return os.path.join(dirname or parent,
+                        f".{basename.lstrip('.')}.{uuid.uuid4().hex}.tmp")
+
+
+@contextmanager
+def atomic_file(filename):
+    """
+    Yield a temporary path that is moved to `filename` if the block
+    succeeds and removed otherwise.
+    """
+    tmp = temp_path(filename)
+    try:
+        yield tmp
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp, ignore_errors=True)
+        elif os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _exchange(src, dst):
+    # swap two paths in one step, only available on Linux
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, 'renameat2', None)
+    if renameat2 is None:
+        return False
+    at_fdcwd, rename_exchange = -100, 2
+    if renameat2(at_fdcwd, os.fsencode(src), at_fdcwd, os.fsencode(dst),
+                 rename_exchange) != 0:
+        # e.g. not supported by the file system
+        return False
+    return True
+
+
+def replace_dir(src, dst):
+    """
+    Replace the directory `dst` with the directory `src` and remove the
+    old directory.
+
+    On Linux both directories are swapped in one step. Elsewhere `dst`
+    is missing for the short time between two renames.
+    """
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+    if sys.platform.startswith('linux') and _exchange(src, dst):
+        shutil.rmtree(src)
+        return
+    old = temp_path(dst)
+    os.rename(dst, old)
+    os.rename(src, dst)
+    shutil.rmtree(old)
+
+
+@contextmanager
+def atomic_dir(dirname, tmpdir=None):
+    """
+    Yield a temporary path that replaces the directory `dirname` if the
+    block succeeds and is removed otherwise.
+
+    The temporary path is created next to `dirname` or in `tmpdir`,
+    which has to be on the same file system.
+    """
+    tmp = temp_path(dirname, tmpdir)
+    try:
+        yield tmp
+        replace_dir(tmp, dirname)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
@@ -0,0 +1,409 @@
+"""
+Resampling of features for display.
+
+:func:`resample` reduces a spectrogram to a grid of output cells. The
+data is processed in blocks along the time axis, so it works on
+dask-backed arrays without ever holding the whole array in memory.
+
+With 'mean' each output cell is the mean of the input cells it
+overlaps, weighted by the overlap, ignoring NaN. This is the same as
+datashader's raster aggregation. The weights factorise into one weight
+along time and one along frequency, so the weighted sums and the sums of
+the weights can be accumulated block by block.
+
+The other reductions assign every input cell to the output cell that
+contains its start and reduce the cells of each output cell with
+:func:`numpy.ufunc.reduceat` or, for the median, by sorting them.
+
+If more output cells than input cells are requested along time, the
+values are interpolated linearly between neighbouring input cells.
+
+:func:`resample_series` reduces 1D features to time bins of a fixed
+length with the same bins as :meth:`pandas.DataFrame.resample`.
+
+Besides the reductions in :data:`REDUCTIONS`, percentiles can be
+requested as 'p' followed by the percentile, e.g. 'p90'. Medians and
+percentiles are computed from sorted values and interpolated linearly
+like :func:`numpy.nanquantile`.
+"""
+import numpy as np
+import pandas as pd
+
+REDUCTIONS = ('mean', 'median', 'min', 'max')
+
+# same tolerance as datashader
+EPS = 1e-10
+
+
+def quantile(agg):
+    """
+    Return the quantile computed by the reduction `agg`, 0.5 for
+    'median' and e.g. 0.9 for 'p90', or None if `agg` is neither.
+    """
+    if agg == 'median':
+        return 0.5
+    if agg.startswith('p'):
+        try:
+            q = float(agg[1:]) / 100.
+        except ValueError:
+            return None
+        if 0. <= q <= 1.:
+            return q
+    return None
+
+
+def check_reduction(agg):
+    """
+    Raise a ValueError if `agg` is not a supported reduction.
+    """
+    if agg not in REDUCTIONS and quantile(agg) is None:
+        raise ValueError(f"Unknown reduction {agg}; choose one of "
+                         f"{REDUCTIONS} or a percentile such as 'p90'")
+
+
+def axis_weights(nsrc, nout):
+    """
+    Return the overlap of `nsrc` input cells with `nout` output cells,
+    `nout` <= `nsrc`, as arrays of input indices, output indices and
+    weights sorted by input index.
+    """
+    scale = nsrc / nout
+    out = np.arange(nout)
+    f0 = scale * out
+    f1 = f0 + scale
+    i0 = f0.astype(int)
+    i1 = f1.astype(int)
+    w0 = 1.0 - (f0 - i0)
+    w1 = f1 - i1
+    # an output cell that ends exactly on an input cell boundary doesn't
+    # overlap the next input cell
+    edge = w1 < EPS
+    w1[edge] = 1.0
+    i1[edge & (i1 > i0)] -= 1
+    counts = i1 - i0 + 1
+    first = np.cumsum(counts) - counts
+    src = np.arange(counts.sum()) - np.repeat(first - i0, counts)
+    weights = np.ones(src.size)
+    weights[first + counts - 1] = w1
+    weights[first] = w0
+    return src, np.repeat(out, counts), weights
+
+
+def _weight_matrix(nsrc, nout):
+    src, out, weights = axis_weights(nsrc, nout)
+    matrix = np.zeros((nout, nsrc))
+    matrix[out, src] = weights
+    return matrix
+
+
+def pixel_centres(coords, nout):
+    """
+    Return the centres of `nout` output cells covering the cells of the
+    regularly spaced input coordinates `coords`.
+    """
+    coords = np.asarray(coords, dtype=float)
+    if coords.size == nout:
+        return coords
+    res = (coords[-1] - coords[0]) / (coords.size - 1)
+    start = coords[0] - res / 2.
+    end = coords[0] + coords.size * res - res / 2.
+    scale = nout / (end - start)
+    return (np.arange(nout) + 0.5 + start * scale) / scale
+
+
+def _block_sums(values, wy, idx, offsets, wx):
+    # weighted sums of one block of input columns and the sums of the
+    # weights per output cell
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    vsum = wy @ np.where(valid, values, 0.)
+    wsum = wy @ valid
+    # contributions are ordered by output cell, so they are summed per
+    # output cell with reduceat
+    return (np.add.reduceat(vsum[:, idx] * wx, offsets, axis=1),
+            np.add.reduceat(wsum[:, idx] * wx, offsets, axis=1))
+
+
+def downsample_mean(xda, width, height, blocksize=2**20):
+    """
+    Downsample a 2D :class:`xarray.DataArray` with increasing,
+    regularly spaced coordinates to `height` x `width` cells.
+
+    The array is read in blocks of about `blocksize` values along its
+    last dimension. For dask-backed arrays the blocks follow the dask
+    chunks and are processed by the dask scheduler; only the sums per
+    output cell of each block are kept in memory.
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Array of shape (`height`, `width`).
+    ycoords, xcoords : numpy.ndarray
+        Cell centres.
+    """
+    nrows, ncols = xda.shape
+    if not (0 < width <= ncols and 0 < height <= nrows):
+        raise ValueError("Output can't be larger than the input")
+    wy = _weight_matrix(nrows, height)
+    src, out, wx = axis_weights(ncols, width)
+    if xda.chunks is not None:
+        bounds = np.cumsum((0,) + xda.chunks[1])
+    else:
+        step = max(blocksize // max(nrows, 1), 1)
+        bounds = np.append(np.arange(0, ncols, step), ncols)
+    blocks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        lo, hi = np.searchsorted(src, [start, stop])
+        if lo == hi:
+            continue
+        cells, offsets = np.unique(out[lo:hi], return_index=True)
+        blocks.append((start, stop, src[lo:hi] - start, cells, offsets,
+                       wx[lo:hi]))
+    if xda.chunks is not None:
+        import dask
+        sums = dask.compute(*[
+            dask.delayed(_block_sums)(xda.data[:, start:stop], wy, idx,
+                                      offsets, weights)
+            for start, stop, idx, _, offsets, weights in blocks])
+    else:
+        sums = [_block_sums(xda[:, start:stop].values, wy, idx, offsets,
+                            weights)
+                for start, stop, idx, _, offsets, weights in blocks]
+    numerator = np.zeros((height, width))
+    denominator = np.zeros((height, width))
+    for (vsum, wsum), block in zip(sums, blocks):
+        cells = block[3]
+        numerator[:, cells] += vsum
+        denominator[:, cells] += wsum
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = np.where(denominator < EPS, np.nan,
+                          numerator / denominator)
+    ydim, xdim = xda.dims
+    return (values.astype(xda.dtype, copy=False),
+            pixel_centres(xda[ydim].values, height),
+            pixel_centres(xda[xdim].values, width))
+
+
+def bin_edges(nsrc, nout):
+    """
+    Return the index of the first of the `nsrc` input cells in each of
+    `nout` <= `nsrc` output cells, followed by `nsrc`.
+    """
+    return -(-np.arange(nout + 1) * nsrc // nout)
+
+
+def sorted_quantile(values, q, axis=-1):
+    """
+    Return the `q`-th quantile along `axis` ignoring NaN, interpolating
+    linearly like :func:`numpy.nanquantile`. The values are sorted in
+    one vectorised call instead of one call per slice.
+    """
+    values = np.sort(values, axis=axis)
+    count = np.sum(~np.isnan(values), axis=axis, keepdims=True)
+    pos = q * np.maximum(count - 1, 0)
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    vlo = np.take_along_axis(values, lo, axis=axis)
+    vhi = np.take_along_axis(values, hi, axis=axis)
+    result = vlo + (vhi - vlo) * (pos - lo)
+    result[count == 0] = np.nan
+    return np.squeeze(result, axis=axis)
+
+
+def _reduce_bins(values, redges, cedges, agg):
+    # reduce blocks of rows and columns given by the bin edges
+    if agg in ('min', 'max'):
+        func = np.fmin if agg == 'min' else np.fmax
+        with np.errstate(invalid='ignore'):
+            values = func.reduceat(values, cedges[:-1], axis=1)
+            return func.reduceat(values, redges[:-1], axis=0)
+    # pad the bins along time to the same length so the median of all
+    # bins is computed at once
+    sizes = np.diff(cedges)
+    index = cedges[:-1, None] + np.arange(sizes.max())
+    pad = index >= cedges[1:, None]
+    index[pad] = 0
+    result = np.empty((redges.size - 1, cedges.size - 1))
+    for row, (r0, r1) in enumerate(zip(redges[:-1], redges[1:])):
+        block = values[r0:r1][:, index]
+        block[:, pad] = np.nan
+        block = block.transpose(1, 0, 2).reshape(cedges.size - 1, -1)
+        result[row] = sorted_quantile(block, quantile(agg))
+    return result
+
+
+def downsample_binned(xda, width, height, agg, blocksize=2**20):
+    """
+    Downsample a 2D :class:`xarray.DataArray` to `height` x `width`
+    cells with the reduction `agg`, 'min', 'max', 'median' or a
+    percentile.
+
+    The array is read in blocks of whole output cells of about
+    `blocksize` values.
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Array of shape (`height`, `width`).
+    ycoords, xcoords : numpy.ndarray
+        Cell centres.
+    """
+    if agg not in ('min', 'max') and quantile(agg) is None:
+        raise ValueError(f"Unknown reduction {agg}")
+    nrows, ncols = xda.shape
+    if not (0 < width <= ncols and 0 < height <= nrows):
+        raise ValueError("Output can't be larger than the input")
+    redges = bin_edges(nrows, height)
+    cedges = bin_edges(ncols, width)
+    step = max(blocksize // max(nrows, 1), 1)
+    bounds = np.unique(np.append(
+        np.searchsorted(cedges, np.arange(0, ncols, step), side='right') - 1,
+        width))
+    values = np.empty((height, width))
+    for b0, b1 in zip(bounds[:-1], bounds[1:]):
+        start, stop = cedges[b0], cedges[b1]
+        block = np.asarray(xda[:, start:stop].values, dtype=float)
+        values[:, b0:b1] = _reduce_bins(block, redges,
+                                        cedges[b0:b1 + 1] - start, agg)
+    ydim, xdim = xda.dims
+    return (values.astype(xda.dtype, copy=False),
+            pixel_centres(xda[ydim].values, height),
+            pixel_centres(xda[xdim].values, width))
+
+
+def upsample_linear(values, width):
+    """
+    Interpolate the columns of a 2D array linearly to `width` columns.
+
+    Like datashader's linear upsampling, the nearest value is used
+    instead if any of the neighbouring values in the same or the next
+    row is NaN.
+    """
+    values = np.asarray(values)
+    nrows, ncols = values.shape
+    scale = (ncols - 1.0) / ((width - 1.0) if width > 1 else 1.0)
+    xf = scale * np.arange(width)
+    x0 = xf.astype(int)
+    wx = xf - x0
+    x1 = np.minimum(x0 + 1, ncols - 1)
+    v0 = values[:, x0]
+    v1 = values[:, x1]
+    valid = np.isfinite(v0) & np.isfinite(v1)
+    valid &= valid[np.minimum(np.arange(nrows) + 1, nrows - 1)]
+    with np.errstate(invalid='ignore'):
+        linear = v0 + wx * (v1 - v0)
+    return np.where(valid, linear, np.where(wx < 0.5, v0, v1))
+
+
+def resample(xda, width, height, agg='mean', blocksize=2**20):
+    """
+    Resample a 2D :class:`xarray.DataArray` with increasing, regularly
+    spaced coordinates to `height` x `width` cells, `height` not larger
+    than the number of rows.
+
+    :param agg: One of 'mean', 'median', 'min', 'max' or a percentile
+        such as 'p90'.
+    :type agg: str
+    :param blocksize: Approximate number of values read at once.
+    :type blocksize: int
+    :returns: Values of shape (`height`, `width`) and the cell centres
+        along both dimensions.
+    """
+    check_reduction(agg)
+    nrows, ncols = xda.shape
+    if width <= ncols:
+        if agg == 'mean':
+            return downsample_mean(xda, width, height, blocksize)
+        return downsample_binned(xda, width, height, agg, blocksize)
+    # few input cells, so everything is read at once
+    if agg == 'mean':
+        values, ycoords, _ = downsample_mean(xda, ncols, height, blocksize)
+    else:
+        values, ycoords, _ = downsample_binned(xda, ncols, height, agg,
+                                               blocksize)
+    xdim = xda.dims[1]
+    return (upsample_linear(values, width).astype(xda.dtype, copy=False),
+            ycoords, pixel_centres(xda[xdim].values, width))
+
+
+def resample_series(times, values, freq, agg='median'):
+    """
+    Reduce a 1D feature to time bins of length `freq`.
+
+    The bins are the same as the ones of
+    :meth:`pandas.DataFrame.resample`, i.e. aligned to midnight of the
+    first day and labelled by their start. `times` have to be sorted.
+    Like resampling a data frame with the times as an additional column,
+    each bin is returned with the median of the times of its samples,
+    and bins without samples with NaT and NaN.
+
+    :param times: Times of the samples.
+    :type times: numpy.ndarray
+    :param values: Values of the samples.
+    :type values: numpy.ndarray
+    :param freq: Length of the bins, e.g. '1h'.
+    :type freq: str or pandas.Timedelta
+    :param agg: One of 'mean', 'median', 'min', 'max' or a percentile
+        such as 'p90'.
+    :type agg: str
+    :returns: Times and values of the bins.
+    """
+    check_reduction(agg)
+    times = np.asarray(times)
+    values = np.asarray(values)
+    dtype = values.dtype if values.dtype.kind == 'f' else np.dtype(float)
+    if times.size == 0:
+        return times, values.astype(dtype)
+    unit = times.dtype
+    ticks = times.astype('datetime64[ns]').view('i8')
+    step = pd.Timedelta(freq).value
+    day = pd.Timedelta(1, 'D').value
+    origin = ticks[0] // day * day
+    first = origin + (ticks[0] - origin) // step * step
+    bins = (ticks - first) // step
+    # bins are contiguous as the times are sorted
+    starts = np.flatnonzero(np.diff(bins, prepend=-1))
+    counts = np.diff(np.append(starts, ticks.size))
+    lo = ticks[starts + (counts - 1) // 2]
+    hi = ticks[starts + counts // 2]
+    middle = lo + (hi - lo) // 2
+
+    values = values.astype(float)
+    valid = ~np.isnan(values)
+    nvalid = np.add.reduceat(valid, starts)
+    q = quantile(agg)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if agg == 'mean':
+            reduced = (np.add.reduceat(np.where(valid, values, 0.), starts) /
+                       nvalid)
+        elif agg in ('min', 'max'):
+            func = np.fmin if agg == 'min' else np.fmax
+            reduced = func.reduceat(values, starts)
+        elif counts.max() * counts.size <= 4 * counts.sum():
+            # pad the bins to the same length so all of them are sorted
+            # at once
+            index = starts[:, None] + np.arange(counts.max())
+            pad = index >= (starts + counts)[:, None]
+            index[pad] = 0
+            block = values[index]
+            block[pad] = np.nan
+            reduced = sorted_quantile(block, q)
+        else:
+            # bins of very different sizes, sort the values of all bins
+            # at once by bin and value, NaN sort last
+            svalues = values[np.lexsort((values, bins))]
+            pos = starts + q * np.maximum(nvalid - 1, 0)
+            i0 = np.floor(pos).astype(int)
+            i1 = np.ceil(pos).astype(int)
+            v0 = svalues[i0]
+            reduced = np.where(i1 > i0, v0 + (svalues[i1] - v0) * (pos - i0),
+                               v0)
+            reduced[nvalid == 0] = np.nan
+
+    nbins = bins[-1] + 1
+    otimes = np.full(nbins, np.iinfo(np.int64).min)
+    otimes[bins[starts]] = middle
+    ovalues = np.full(nbins, np.nan)
+    ovalues[bins[starts]] = reduced
+    return (otimes.view('datetime64[ns]').astype(unit),
+            ovalues.astype(dtype))
@@ -1,10 +1,23 @@
+import fnmatch
 import json
 import logging
 import logging.config
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import pandas as pd
 import xarray as xr
 
+from .cache import dataset_cache, file_mtime, open_chunked, slice_cache
+from .catalog import load_metadata, update_metadata
+from .h5read import (dimensions, group_attrs, mappable, read_feature,
+                     time_slice)
+from .inventory import (inventory_list, inventory_tree, is_hidden,
+                        load_inventory, update_inventory)
+from .locking import retry_read
+from .utils import select_pyramid_level
+from .writer import BufferedWriter
 from .xarray2netcdf import xarray2netcdf
 from .xarray2zarr import xarray2zarr
 
@@ -71,12 +84,15 @@ logger = logging.getLogger("__name__")
 
 
 class Path(object):
-    def __init__(self, name, parentdir, create=True, backend='zarr'):
+    def __init__(self, name, parentdir, create=True, backend='zarr',
+                 root=None):
         self.name = name
         self.create = create
         self.backend = backend
         self.engine = 'h5netcdf' if self.backend == 'netcdf' else self.backend
         self.path = os.path.join(parentdir, name)
+        # directory of the storage group this store belongs to
+        self.root = self.path if root is None else root
         if create:
             try:
                 os.makedirs(self.path, exist_ok=True)
@@ -97,44 +113,265 @@ class Path(object):
             return self.children[key]
         except KeyError:
             self.children[key] = Path(
-                key, self.path, self.create, self.backend)
+                key, self.path, self.create, self.backend, self.root)
             return self.children[key]
 
-    def feature_path(self, feature):
-
+    def _feature_filename(self, feature):
         if self.backend == 'netcdf':
             file_ending = '.nc'
         elif self.backend == 'zarr':
             file_ending = '.zarr'
-        _feature_path = os.path.join(self.path, feature + file_ending)
+        return os.path.join(self.path, feature + file_ending)
+
+    def feature_path(self, feature):
+        _feature_path = self._feature_filename(feature)
         if not os.path.exists(_feature_path):
             raise FileNotFoundError(f"File {_feature_path} not found")
-            self.children[feature] = Path(feature + file_ending, self.path)
         return _feature_path
 
-    def __call__(self, feature, group='original'):
+    def __call__(self, feature, group='original', resolution=None,
+                 method='mean', mmap=False, chunks=None):
         """
         Request a particular feature
 
         :param feature: Feature name
         :type feature: str
+        :param group: Group to read the feature from.
+        :type group: str
+        :param resolution: Coarsest acceptable time resolution, e.g. '1D'.
+            If given, the feature is read from a pyramid level that can
+            be aggregated to `resolution` with `method`, see
+            :func:`tonik.utils.select_pyramid_level`.
+        :type resolution: str
+        :param method: Aggregation the caller applies to the data, one
+            of 'mean', 'median', 'max' or 'min'. Only pyramid levels
+            computed with the same method are read.
+        :type method: str
+        :param mmap: Return the values of netCDF features that are stored
+            contiguously and uncompressed as a read-only memory-mapped
+            view of the file instead of copying them. Other features are
+            read normally. The view reflects later changes to the file.
+        :type mmap: bool
+        :param chunks: If given, don't read the data but return a
+            dask-backed array with these chunks, e.g.
+            ``{'datetime': 4096}``, see :func:`xarray.open_dataset`.
+        :type chunks: dict, int or str
 
         """
         if self.endtime < self.starttime:
             raise ValueError('Startime has to be smaller than endtime.')
+        if mmap and chunks is not None:
+            raise ValueError('mmap and chunks are mutually exclusive.')
+        return self._load(feature, self.feature_path(feature), group,
+                          resolution, method, mmap, chunks)
 
-        filename = self.feature_path(feature)
+    def _load(self, feature, filename, group, resolution, method='mean',
+              mmap=False, chunks=None):
+        group = self._level(feature, group, resolution, method)
 
         logger.debug(
             f"Reading feature {feature} between {self.starttime} and {self.endtime}")
 
-        xd_index = dict(datetime=slice(self.starttime, self.endtime))
-        with xr.open_dataset(filename, group=group, engine=self.engine) as ds:
+        def reader(starttime, endtime):
+            return self._read(filename, feature, group, starttime, endtime)
+
+        if chunks is not None:
+            ds = open_chunked(filename, group, self.engine, chunks)
+            rq = ds[feature].loc[dict(datetime=slice(self.starttime,
+                                                     self.endtime))]
+            rq.attrs = dict(ds.attrs)
+            return rq
+        if mmap and self.engine == 'h5netcdf':
+            with dataset_cache.open(filename, None, 'h5raw') as h5f:
+                mapped = group in h5f and mappable(h5f[group][feature])
+            if mapped:
+                # views are cheap to create and must not be handed out
+                # for copied reads, so they bypass the slice cache
+                return self._read(filename, feature, group, self.starttime,
+                                  self.endtime, mmap=True)
+        return slice_cache.read(filename, group, feature, self.starttime,
+                                self.endtime, reader)
+
+    def load_many(self, features, group='original', resolution=None,
+                  method='mean', max_workers=8):
+        """
+        Request several features at once.
+
+        The features are read concurrently and returned as one dataset
+        aligned on 'datetime'. Time steps that are missing for some of
+        the features are filled with NaN.
+
+        :param features: Feature names
+        :type features: list of str
+        :param group: Group to read the features from.
+        :type group: str
+        :param resolution: Coarsest acceptable time resolution, see
+            :meth:`__call__`.
+        :type resolution: str
+        :param method: Aggregation the caller applies to the data, see
+            :meth:`__call__`.
+        :type method: str
+        :param max_workers: Maximum number of features read at once.
+        :type max_workers: int
+        :rtype: :class:`xarray.Dataset`
+        """
+        if self.endtime < self.starttime:
+            raise ValueError('Startime has to be smaller than endtime.')
+        filenames = [self.feature_path(feature) for feature in features]
+        if not features:
+            return xr.Dataset()
+        with ThreadPoolExecutor(
+                max_workers=max(min(max_workers, len(features)), 1)) as pool:
+            results = list(pool.map(
+                lambda args: self._load(*args, group, resolution, method),
+                zip(features, filenames)))
+        data = {}
+        for feature, xda in zip(features, results):
+            if self.backend == 'netcdf':
+                # times decoded from netCDF files can differ by a few
+                # nanoseconds between files
+                xda = xda.assign_coords(
+                    datetime=xda.datetime.dt.round('1ms'))
+            data[feature] = xda
+        return xr.Dataset(data)
+
+    def _read(self, filename, feature, group, starttime, endtime,
+              mmap=False):
+        # readers don't wait for writers, so a read that overlaps with an
+        # append can fail and is repeated
+        return retry_read(
+            lambda: self._read_once(filename, feature, group, starttime,
+                                    endtime, mmap),
+            filename, group)
+
+    def _read_once(self, filename, feature, group, starttime, endtime,
+                   mmap):
+        if self.engine == 'h5netcdf':
+            # files on a regular time grid are read without xarray
+            with dataset_cache.open(filename, None, 'h5raw') as h5f:
+                rq = read_feature(h5f[group], feature, starttime, endtime,
+                                  mmap=mmap)
+                if rq is not None:
+                    rq.attrs = group_attrs(h5f[group])
+                    return rq
+        xd_index = dict(datetime=slice(starttime, endtime))
+        with dataset_cache.open(filename, group, self.engine) as ds:
             rq = ds[feature].loc[xd_index].load()
-            rq.attrs = ds.attrs
-
+            rq.attrs = dict(ds.attrs)
         return rq
 
+    def pyramid_levels(self, feature):
+        """
+        Return the downsampled resolutions stored for a feature.
+        """
+        return self._pyramid(feature)[0]
+
+    def _pyramid(self, feature):
+        # levels and aggregation method of the pyramid of a feature
+        filename = self.feature_path(feature)
+        if self.engine == 'h5netcdf':
+            # doesn't decode the time axis
+            with dataset_cache.open(filename, None, 'h5raw') as h5f:
+                attrs = group_attrs(h5f['original'])
+        else:
+            with dataset_cache.open(filename, 'original', self.engine) as ds:
+                attrs = dict(ds.attrs)
+        levels = attrs.get('pyramid_levels')
+        return ((levels.split(',') if levels else []),
+                attrs.get('pyramid_method', 'mean'))
+
+    def _level(self, feature, group, resolution, method):
+        # group to read a feature from, see select_pyramid_level
+        if resolution is None or group != 'original':
+            return group
+        levels, pyramid_method = self._pyramid(feature)
+        return select_pyramid_level(levels, resolution, method,
+                                    pyramid_method) or group
+
+    def nbytes(self, feature, group='original', resolution=None,
+               method='mean'):
+        """
+        Return the size in bytes of the data :meth:`__call__` returns for
+        the same arguments without reading the data.
+        """
+        filename = self.feature_path(feature)
+        group = self._level(feature, group, resolution, method)
+        if self.engine == 'h5netcdf':
+            with dataset_cache.open(filename, None, 'h5raw') as h5f:
+                tslice = time_slice(h5f[group], self.starttime,
+                                    self.endtime)
+                if tslice is not None:
+                    var = h5f[group][feature]
+                    shape = dict(zip(dimensions(var), var.shape))
+                    shape['datetime'] = tslice[1] - tslice[0]
+                    return int(np.prod(list(shape.values())) *
+                               var.dtype.itemsize)
+        with dataset_cache.open(filename, group, self.engine) as ds:
+            xda = ds[feature]
+            start, stop, _ = ds.indexes['datetime'].slice_indexer(
+                self.starttime, self.endtime).indices(xda.sizes['datetime'])
+            nrows = xda.size // max(xda.sizes['datetime'], 1)
+            return max(stop - start, 0) * nrows * xda.dtype.itemsize
+
+    def iter_blocks(self, feature, group='original', maxvalues=2**20,
+                    order='time'):
+        """
+        Read a feature in blocks of at most `maxvalues` values.
+
+        With `order='time'` each block holds consecutive time steps of
+        all frequencies. With `order='frequency'` blocks hold consecutive
+        frequency rows over the whole time window, or parts of a single
+        row if one row exceeds `maxvalues`, so that concatenating the
+        blocks in order yields the rows in C order. Windows that fit into
+        a single block are read through the slice cache.
+
+        :param feature: Feature name
+        :type feature: str
+        :param maxvalues: Maximum number of values per block.
+        :type maxvalues: int
+        :param order: 'time' or 'frequency'
+        :type order: str
+        """
+        if self.endtime < self.starttime:
+            raise ValueError('Startime has to be smaller than endtime.')
+
+        filename = self.feature_path(feature)
+        with dataset_cache.open(filename, group, self.engine) as ds:
+            xda = ds[feature]
+            tslice = ds.indexes['datetime'].slice_indexer(
+                self.starttime, self.endtime)
+            tstart, tstop, _ = tslice.indices(xda.sizes['datetime'])
+            ntimes = max(tstop - tstart, 0)
+            nrows = 1
+            if xda.ndim > 1:
+                nrows = xda.shape[0]
+            if nrows * ntimes <= maxvalues:
+                blocks = None
+            elif order == 'frequency' and xda.ndim > 1:
+                if ntimes <= maxvalues:
+                    step = maxvalues // ntimes
+                    blocks = [(slice(i, i + step), slice(tstart, tstop))
+                              for i in range(0, nrows, step)]
+                else:
+                    blocks = [(slice(i, i + 1), slice(t, min(t + maxvalues, tstop)))
+                              for i in range(nrows)
+                              for t in range(tstart, tstop, maxvalues)]
+            else:
+                step = max(maxvalues // nrows, 1)
+                blocks = [(slice(None), slice(t, min(t + step, tstop)))
+                          for t in range(tstart, tstop, step)]
+            if blocks is not None:
+                attrs = dict(ds.attrs)
+                for rows, times in blocks:
+                    index = dict(datetime=times)
+                    if xda.ndim > 1:
+                        index[xda.dims[0]] = rows
+                    block = xda.isel(index).load()
+                    block.attrs = attrs
+                    yield block
+                return
+        yield self(feature, group=group)
+
     def load(self, *args, **kwargs):
         """
         Load a feature from disk
@@ -145,18 +382,95 @@ class Path(object):
         """
         Save a feature to disk
         """
+        filenames = {feature: self._feature_filename(feature)
+                     for feature in data.data_vars}
+        tokens = {feature: file_mtime(filename)
+                  for feature, filename in filenames.items()}
         if self.backend == 'netcdf':
             xarray2netcdf(data, self.path, **kwargs)
         elif self.backend == 'zarr':
             xarray2zarr(data, self.path, **kwargs)
+        update_inventory(self.root, self.path, list(filenames.values()))
+        # entries can only be extended if the data was added to the
+        # original group
+        appended = (kwargs.get('group', 'original') == 'original' and
+                    kwargs.get('mode', 'a') == 'a')
+        update_metadata(self.path, filenames, self.engine,
+                        data if appended else None, tokens)
+
+    def writer(self, max_rows=144, max_age=3600., log=None, **kwargs):
+        """
+        Return a writer that collects appends to this store and its
+        substores and saves them in batches, see
+        :class:`tonik.writer.BufferedWriter`.
+
+        :param max_rows: Number of time steps to collect before saving.
+        :type max_rows: int
+        :param max_age: Maximum time in seconds an append is kept in
+            memory.
+        :type max_age: float
+        :param log: Name of the append log.
+        :type log: str
+        :param kwargs: Arguments passed on to :meth:`save`.
+        :rtype: :class:`tonik.writer.BufferedWriter`
+        """
+        return BufferedWriter(self, max_rows, max_age, log, **kwargs)
+
+    def features(self):
+        """
+        Return the names of the features in this store.
+        """
+        ending = '.nc' if self.backend == 'netcdf' else '.zarr'
+        return sorted(fn[:-len(ending)] for fn in os.listdir(self.path)
+                      if fn.endswith(ending) and not is_hidden(fn))
+
+    def metadata(self, feature=None, refresh=False):
+        """
+        Return the time extent, sizes, resolution in hours, dtype and
+        modification time of features from the catalog of this store,
+        see :mod:`tonik.catalog`.
+
+        :param feature: Feature name or list of names. If None, all
+            features of the store are listed.
+        :type feature: str or list of str
+        :param refresh: Read the metadata from the feature files even if
+            the catalog is up to date.
+        :type refresh: bool
+        :rtype: dict
+        """
+        if feature is None:
+            features = self.features()
+        elif isinstance(feature, str):
+            features = [feature]
+        else:
+            features = list(feature)
+        meta = load_metadata(self.path,
+                             {f: self.feature_path(f) for f in features},
+                             self.engine, refresh=refresh)
+        if isinstance(feature, str):
+            return meta[feature]
+        return meta
 
     def shape(self, feature):
         """
         Get shape of a feature on disk
         """
         filename = self.feature_path(feature)
-        with xr.open_dataset(filename, group='original', engine=self.engine) as ds:
-            return ds[feature].sizes
+        if self.engine == 'h5netcdf':
+            with dataset_cache.open(filename, None, 'h5raw') as h5f:
+                var = h5f['original'][feature]
+                return dict(zip(dimensions(var), var.shape))
+        with dataset_cache.open(filename, 'original', self.engine) as ds:
+            return dict(ds[feature].sizes)
+
+    @staticmethod
+    def cache_info():
+        """
+        Return hit/miss statistics of the open dataset and the decoded
+        slice caches.
+        """
+        return dict(datasets=dataset_cache.info(),
+                    slices=slice_cache.info())
 
     def save_labels(self, labels):
         """
@@ -237,6 +551,93 @@ class Storage(Path):
         self.stores.add(st)
         return st
 
+    def channels(self, feature, selector='*'):
+        """
+        Return the stores below this group that hold `feature` and match
+        `selector`.
+
+        :param feature: Feature name
+        :type feature: str
+        :param selector: Glob-style pattern 'site.sensor.channel', e.g.
+            'WIZ.*.HHZ'. Missing trailing parts match everything.
+        :type selector: str
+        :rtype: dict of channel id to :class:`Path`
+        """
+        patterns = selector.split('.')
+        if len(patterns) > 3:
+            raise ValueError(f"Invalid selector {selector}")
+        patterns += ['*'] * (3 - len(patterns))
+
+        def subdirs(path, pattern):
+            try:
+                names = sorted(os.listdir(path))
+            except FileNotFoundError:
+                return []
+            return [n for n in names if not n.startswith('.') and
+                    fnmatch.fnmatchcase(n, pattern) and
+                    os.path.isdir(os.path.join(path, n)) and
+                    os.path.splitext(n)[1] not in ('.nc', '.zarr')]
+
+        stores = {}
+        for site in subdirs(self.path, patterns[0]):
+            sitedir = os.path.join(self.path, site)
+            for sensor in subdirs(sitedir, patterns[1]):
+                sensordir = os.path.join(sitedir, sensor)
+                for channel in subdirs(sensordir, patterns[2]):
+                    st = self.get_substore(site, sensor, channel)
+                    if os.path.exists(st._feature_filename(feature)):
+                        stores['.'.join([site, sensor, channel])] = st
+        return stores
+
+    def query(self, feature, selector='*', group='original', resolution=None,
+              method='mean', max_workers=8):
+        """
+        Request a feature for all channels matching `selector`.
+
+        The channels are read concurrently and stacked along a new
+        'channel' dimension labelled 'site.sensor.channel'. Time steps
+        that are missing for some of the channels are filled with NaN.
+
+        :param feature: Feature name
+        :type feature: str
+        :param selector: Glob-style pattern 'site.sensor.channel', e.g.
+            'WIZ.*.HHZ'. Missing trailing parts match everything.
+        :type selector: str
+        :param group: Group to read the feature from.
+        :type group: str
+        :param resolution: Coarsest acceptable time resolution, see
+            :meth:`Path.__call__`.
+        :type resolution: str
+        :param method: Aggregation the caller applies to the data, see
+            :meth:`Path.__call__`.
+        :type method: str
+        :param max_workers: Maximum number of channels read at once.
+        :type max_workers: int
+        :rtype: :class:`xarray.DataArray`
+
+        >>> g = Storage('Whakaari', '/tmp', starttime=start, endtime=end)
+        >>> rsam = g.query('rsam', 'WI*.*.HHZ')
+        """
+        if self.endtime < self.starttime:
+            raise ValueError('Startime has to be smaller than endtime.')
+        stores = self.channels(feature, selector)
+        if not stores:
+            raise FileNotFoundError(
+                f"No channel matching {selector} holds feature {feature}")
+        with ThreadPoolExecutor(
+                max_workers=max(min(max_workers, len(stores)), 1)) as pool:
+            results = list(pool.map(
+                lambda st: st._load(feature, st._feature_filename(feature),
+                                    group, resolution, method),
+                stores.values()))
+        if self.backend == 'netcdf':
+            # times decoded from netCDF files can differ by a few
+            # nanoseconds between files
+            results = [xda.assign_coords(datetime=xda.datetime.dt.round('1ms'))
+                       for xda in results]
+        return xr.concat(results, dim=pd.Index(list(stores), name='channel'),
+                         join='outer', combine_attrs='drop_conflicts')
+
     def from_directory(self):
         """
         Construct the storage group from the root directory
@@ -263,9 +664,8 @@ class Storage(Path):
         if name.endswith('.zarr'):
             return name.replace('.zarr', '')
         elif os.path.isdir(path):
-            dir_contents = os.listdir(path)
-            if 'labels.json' in dir_contents:
-                dir_contents.remove('labels.json')
+            dir_contents = [fn for fn in os.listdir(path)
+                            if not is_hidden(fn)]
             return {name: [Storage.directory_tree_to_dict(os.path.join(path, child)) for child in sorted(dir_contents)]}
         else:
             if name.endswith('.nc'):
@@ -279,6 +679,31 @@ class Storage(Path):
         """
         return Storage.directory_tree_to_dict(self.path)
 
+    def inventory(self, *subdirs, tree=True, refresh=False):
+        """
+        List the stores and features of the group from its inventory
+        index, see :mod:`tonik.inventory`.
+
+        :param subdirs: Site, sensor and channel to list the contents of.
+        :param tree: Return the nested tree of the whole group in the
+            format of :meth:`to_dict` instead of a flat list of the
+            contents of `subdirs`.
+        :type tree: bool
+        :param refresh: Rebuild the whole index from the directory tree
+            instead of listing only the directories that changed.
+        :type refresh: bool
+        """
+        inventory = load_inventory(self.path, refresh=refresh)
+        if tree and not subdirs:
+            return inventory_tree(inventory, self.name)
+        rel = '/'.join(subdirs)
+        if rel not in inventory['dirs']:
+            # directory without features
+            path = os.path.join(self.path, *subdirs)
+            return sorted(fn.replace('.nc', '').replace('.zarr', '')
+                          for fn in os.listdir(path) if not is_hidden(fn))
+        return inventory_list(inventory, rel)
+
     def get_starttime(self):
         return self.__starttime
 
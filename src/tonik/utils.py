@@ -60,10 +60,17 @@ def generate_test_data(dim=1, ndays=30, nfreqs=10,
 
 
 def merge_arrays(xds_old: xr.DataArray, xds_new: xr.DataArray,
-                 resolution: float = None) -> xr.DataArray:
+                 resolution: float = None,
+                 blocksize: int = 2**20) -> xr.DataArray:
     """
     Merge two xarray datasets with the same datetime index.
 
+    New values take precedence over old ones unless they are NaN. If
+    both arrays are sampled regularly on the same time grid, the values
+    are copied into a single output array, reading the old array in
+    blocks of about `blocksize` values. Otherwise the arrays are
+    aligned with xarray.
+
     Parameters
     ----------
     xds_old : xr.DataArray
@@ -71,13 +78,19 @@ def merge_arrays(xds_old: xr.DataArray, xds_new: xr.DataArray,
     xds_new : xr.DataArray
         New array.
     resolution : float
-        Time resolution in hours.
+        Time resolution in hours. If given, the result covers every
+        time step between the first and the last time.
+    blocksize : int
+        Number of values of the old array copied at a time.
 
     Returns
     -------
     xr.DataArray
         Merged array.
     """
+    merged = _merge_regular(xds_old, xds_new, resolution, blocksize)
+    if merged is not None:
+        return merged
     xda_old = xds_old.drop_duplicates(
         'datetime', keep='last')
     xda_new = xds_new.drop_duplicates(
@@ -92,6 +105,154 @@ def merge_arrays(xds_old: xr.DataArray, xds_new: xr.DataArray,
     return xda_new
 
 
+def _time_step(times, resolution=None):
+    """
+    Return the common time step of the arrays in `times` or None if
+    they are not sampled regularly with the same step.
+    """
+    steps = set()
+    for _t in times:
+        if _t.size > 1:
+            diffs = np.diff(_t)
+            if diffs[0] <= np.timedelta64(0) or (diffs != diffs[0]).any():
+                return None
+            steps.add(diffs[0])
+    if len(steps) != 1:
+        return None
+    step = steps.pop()
+    if resolution is not None and abs(
+            step - np.timedelta64(int(round(resolution * 3600e9)), 'ns')) \
+            > np.timedelta64(1, 'us'):
+        return None
+    return step
+
+
+def _merge_regular(xda_old, xda_new, resolution, blocksize):
+    # Returns None if the arrays can't be merged on a regular grid.
+    if (xda_old.dims != xda_new.dims or
+            not np.issubdtype(xda_old.dtype, np.floating) or
+            not np.issubdtype(xda_new.dtype, np.floating)):
+        return None
+    for xda in (xda_old, xda_new):
+        if set(xda.coords) - set(xda.dims):
+            return None
+    for dim in xda_new.dims:
+        if dim == 'datetime':
+            continue
+        if xda_old.sizes[dim] != xda_new.sizes[dim] or \
+                (dim in xda_old.coords) != (dim in xda_new.coords) or \
+                (dim in xda_new.coords and not np.array_equal(
+                    xda_old[dim].values, xda_new[dim].values)):
+            return None
+    t_old = np.asarray(xda_old['datetime'].values, dtype='datetime64[ns]')
+    t_new = np.asarray(xda_new['datetime'].values, dtype='datetime64[ns]')
+    if t_old.size == 0 or t_new.size == 0:
+        return None
+    step = _time_step([t_old, t_new], resolution)
+    if step is None or (t_new[0] - t_old[0]) % step:
+        return None
+    if resolution is None and (t_new[0] > t_old[-1] + step or
+                               t_old[0] > t_new[-1] + step):
+        # without a resolution the gap between the arrays is kept out
+        # of the result
+        return None
+
+    start = min(t_old[0], t_new[0])
+    ntimes = (max(t_old[-1], t_new[-1]) - start) // step + 1
+    axis = xda_new.get_axis_num('datetime')
+    shape = list(xda_new.shape)
+    shape[axis] = ntimes
+    values = np.full(shape, np.nan,
+                     dtype=np.result_type(xda_old.dtype, xda_new.dtype))
+
+    def _index(first, stop):
+        return (slice(None),) * axis + (slice(first, stop),)
+
+    offset = (t_old[0] - start) // step
+    nrows = max(xda_old.size // t_old.size, 1)
+    nblock = max(blocksize // nrows, 1)
+    for first in range(0, t_old.size, nblock):
+        stop = min(first + nblock, t_old.size)
+        values[_index(offset + first, offset + stop)] = xda_old.isel(
+            datetime=slice(first, stop)).values
+    offset = (t_new[0] - start) // step
+    new = xda_new.values
+    np.copyto(values[_index(offset, offset + t_new.size)], new,
+              where=~np.isnan(new))
+    coords = {dim: xda_new.coords[dim] for dim in xda_new.dims
+              if dim != 'datetime' and dim in xda_new.coords}
+    coords['datetime'] = start + np.arange(ntimes) * step
+    return xr.DataArray(values, coords=coords, dims=xda_new.dims,
+                        name=xda_new.name, attrs=xda_new.attrs)
+
+
+PYRAMID_METHODS = ('mean', 'median', 'max', 'min')
+
+
+def downsample(xda: xr.DataArray, level: str,
+               method: str = 'mean') -> xr.DataArray:
+    """
+    Aggregate a feature to a coarser time resolution.
+
+    Parameters
+    ----------
+    xda : xr.DataArray
+        Feature with a 'datetime' dimension.
+    level : str
+        Target resolution, e.g. '1h' or '1D'.
+    method : str
+        One of 'mean', 'median', 'max' or 'min'.
+
+    Returns
+    -------
+    xr.DataArray
+        Aggregated feature labelled by the start of each bin.
+    """
+    if method not in PYRAMID_METHODS:
+        raise ValueError(f"Unknown aggregation method {method}")
+    # times decoded from netCDF can be off by a few nanoseconds which
+    # would put samples on a bin edge into the wrong bin
+    xda = xda.assign_coords(datetime=xda['datetime'].dt.round('1ms'))
+    return getattr(xda.resample(datetime=level), method)()
+
+
+def pyramid_window(starttime, endtime, level: str):
+    """
+    Return the time window covering all bins of `level` that contain
+    samples between `starttime` and `endtime`.
+    """
+    start = pd.Timestamp(starttime).floor(level)
+    end = pd.Timestamp(endtime).floor(level) + pd.Timedelta(level) - \
+        pd.Timedelta(1, 'us')
+    return start, end
+
+
+def select_pyramid_level(levels: List[str], resolution: str,
+                         method: str = 'mean',
+                         pyramid_method: str = 'mean') -> str:
+    """
+    Return the pyramid level to read a feature from that is aggregated
+    to `resolution` with `method`, or None if the original data has to
+    be read.
+
+    Levels are only used if they were aggregated with the same method.
+    Max and min of a finer level are the same as of the original data,
+    so the coarsest level that is not coarser than `resolution` is
+    returned for them. Means and medians can't be aggregated further
+    and only the level matching `resolution` is returned.
+    """
+    if method != pyramid_method:
+        return None
+    resolution = pd.Timedelta(resolution)
+    if method in ('max', 'min'):
+        candidates = [_l for _l in levels if pd.Timedelta(_l) <= resolution]
+    else:
+        candidates = [_l for _l in levels if pd.Timedelta(_l) == resolution]
+    if not candidates:
+        return None
+    return max(candidates, key=pd.Timedelta)
+
+
 def extract_consecutive_integers(nums: List[int]) -> List[List[int]]:
     """
     Extract consecutive integers from a list of integers.
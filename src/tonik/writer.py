@@ -0,0 +1,252 @@
+"""
+Buffered writing of small appends.
+
+Real-time ingest typically saves a few time steps of every feature at a
+time and pays for opening and updating the feature files on every call.
+:class:`BufferedWriter` keeps appends in memory and saves them in
+batches instead, once enough time steps have been collected or the
+oldest append has waited long enough.
+
+Every append is written to an append log before it is buffered. Appends
+that were never saved, e.g. because the process died, are saved when a
+writer is opened on the same log again. The log is a sequence of
+records::
+
+    uint64   length of the payload
+    uint32   CRC32 of the payload
+    payload  JSON header with the store directories below the writer's
+             store, the attributes and the dimensions of the variables,
+             a newline and the values of the variables in .npy format
+
+A record that was only partly written is discarded. The log is emptied
+after all buffered appends have been saved. Saving an append twice
+gives the same files, so appends saved just before a crash can be
+replayed safely.
+"""
+import io
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from contextlib import ExitStack
+
+import numpy as np
+import xarray as xr
+
+from .locking import file_lock
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = '.tonik_append.log'
+
+_HEADER = struct.Struct('<QI')
+
+
+def _json_default(value):
+    # attributes read from files are often numpy scalars or arrays
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Can't store attribute {value!r} in the append log")
+
+
+def encode_record(subdirs, data):
+    """
+    Return the log record of an append of `data` to the store below
+    `subdirs`.
+    """
+    # much faster than writing the data as netCDF for the few values of
+    # a typical append
+    variables = {}
+    values = io.BytesIO()
+    for name, var in data.variables.items():
+        variables[name] = dict(dims=list(var.dims), attrs=var.attrs,
+                               coord=name in data.coords)
+        np.lib.format.write_array(values, np.asarray(var.values),
+                                  allow_pickle=False)
+    header = json.dumps(dict(subdirs=list(subdirs), attrs=data.attrs,
+                             variables=variables), default=_json_default)
+    payload = header.encode() + b'\n' + values.getvalue()
+    return _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_record(payload):
+    """
+    Return the store directories and data of a log record.
+    """
+    header, _, values = payload.partition(b'\n')
+    header = json.loads(header)
+    values = io.BytesIO(values)
+    data_vars, coords = {}, {}
+    for name, var in header['variables'].items():
+        array = np.lib.format.read_array(values, allow_pickle=False)
+        target = coords if var['coord'] else data_vars
+        target[name] = xr.Variable(var['dims'], array, var['attrs'])
+    return header['subdirs'], xr.Dataset(data_vars, coords,
+                                         header['attrs'])
+
+
+def read_records(f):
+    """
+    Yield the store directories and data of the complete records in
+    the log `f` and leave `f` at the end of the last complete record.
+    """
+    while True:
+        start = f.tell()
+        header = f.read(_HEADER.size)
+        if len(header) == _HEADER.size:
+            length, crc = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) == length and zlib.crc32(payload) == crc:
+                yield decode_record(payload)
+                continue
+        f.seek(start)
+        return
+
+
+def _batches(datasets):
+    # consecutive appends of the same features are saved together;
+    # later appends win where they overlap
+    batch = []
+    for xds in datasets:
+        if batch and set(xds.data_vars) != set(batch[-1].data_vars):
+            yield _concat(batch)
+            batch = []
+        batch.append(xds)
+    if batch:
+        yield _concat(batch)
+
+
+def _concat(datasets):
+    if len(datasets) == 1:
+        return datasets[0]
+    xds = xr.concat(datasets, dim='datetime', combine_attrs='override')
+    xds = xds.drop_duplicates('datetime', keep='last').sortby('datetime')
+    xds.attrs = dict(datasets[-1].attrs)
+    return xds
+
+
+class BufferedWriter(object):
+    """
+    Save appends to a store and its substores in batches.
+
+    :param store: Store to write to.
+    :type store: :class:`tonik.Path`
+    :param max_rows: Save the buffered appends once they hold this many
+        time steps.
+    :type max_rows: int
+    :param max_age: Save the buffered appends once the oldest has waited
+        this many seconds. Checked on every append and by
+        :meth:`poll`.
+    :type max_age: float
+    :param log: Name of the append log. Defaults to a hidden file in
+        the directory of `store`. Only one writer can use a log at a
+        time; others wait until it is closed.
+    :type log: str
+    :param fsync: Make sure every record of the log is on disk before
+        :meth:`save` returns.
+    :type fsync: bool
+    :param kwargs: Arguments passed on to :meth:`tonik.Path.save`.
+        With the netCDF backend these have to include the `resolution`
+        as a batch can hold a single time step.
+
+    >>> with g.writer(max_rows=144) as w:
+    ...     w.save(xds, 'MDR', '00', 'HHZ')
+    """
+
+    def __init__(self, store, max_rows=144, max_age=3600., log=None,
+                 fsync=True, **kwargs):
+        self.store = store
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.fsync = fsync
+        self.kwargs = kwargs
+        self.log = log or os.path.join(store.path, LOG_FILE)
+        self._buffers = {}
+        self._rows = 0
+        self._since = None
+        self._stack = ExitStack()
+        try:
+            self._stack.enter_context(file_lock(self.log))
+            self._file = self._stack.enter_context(open(self.log, 'a+b'))
+            self._replay()
+        except BaseException:
+            self._stack.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _replay(self):
+        self._file.seek(0)
+        nrecords = 0
+        for subdirs, xds in read_records(self._file):
+            self._buffers.setdefault(tuple(subdirs), []).append(xds)
+            nrecords += 1
+        # drop a partly written record at the end
+        self._file.truncate()
+        if nrecords:
+            logger.info(f"Saving {nrecords} appends from {self.log}")
+            self.flush()
+
+    def _substore(self, subdirs):
+        store = self.store
+        for name in subdirs:
+            store = store[name]
+        return store
+
+    def save(self, data, *subdirs):
+        """
+        Append `data` to the store below `subdirs`, see
+        :meth:`tonik.Storage.get_substore`.
+        """
+        self._file.write(encode_record(subdirs, data))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._buffers.setdefault(tuple(subdirs), []).append(data)
+        self._rows += data.sizes['datetime']
+        if self._since is None:
+            self._since = time.monotonic()
+        self.poll()
+
+    def poll(self):
+        """
+        Save the buffered appends if there are enough of them or the
+        oldest has waited long enough.
+        """
+        if self._since is None:
+            return
+        if (self._rows >= self.max_rows or
+                time.monotonic() - self._since >= self.max_age):
+            self.flush()
+
+    def flush(self):
+        """
+        Save all buffered appends and empty the log.
+        """
+        for subdirs in list(self._buffers):
+            store = self._substore(subdirs)
+            for xds in _batches(self._buffers[subdirs]):
+                store.save(xds, **self.kwargs)
+            del self._buffers[subdirs]
+        self._rows = 0
+        self._since = None
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Save the buffered appends and release the log.
+        """
+        try:
+            self.flush()
+        finally:
+            self._stack.close()
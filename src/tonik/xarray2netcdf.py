@@ -5,15 +5,25 @@ from warnings import filterwarnings
 
 import h5netcdf
 import numpy as np
+import pandas as pd
 import xarray as xr
 from cftime import date2num, num2date
 
-from .utils import merge_arrays
+from .cache import invalidate
+from .encoding import (dumps, feature_encoding, h5_encoding,
+                       netcdf_encoding, normalize_encoding)
+from .h5read import CALENDARS, _hours
+from .locking import atomic_file, file_lock
+from .utils import downsample, merge_arrays, pyramid_window
+
+TIME_UNITS = 'hours since 1970-01-01 00:00:00.0'
+TIME_CALENDAR = 'gregorian'
 
 
 def xarray2netcdf(xArray, fdir, group="original", timedim="datetime",
                   archive_starttime=datetime(2000, 1, 1), resolution=None,
-                  mode='a'):
+                  mode='a', backfill='shift', encoding=None, pyramid=None,
+                  pyramid_method='mean'):
     """
     Store an xarray dataset as an HDF5 file.
 
@@ -29,10 +39,32 @@ def xarray2netcdf(xArray, fdir, group="original", timedim="datetime",
         Name of time dimension.
     archive_starttime : datetime
         Start time of archive. If the start time of the data is before this
-        time, the data start time is used.
+        time, the data start time is used. Only used when the file is
+        created; data is always placed relative to the start time recorded
+        in the file.
     resolution : float
         Time resolution of the data in hours. If None, the resolution is
         determined from the data.
+    mode : str
+        'a' to add the data to an existing file, 'w' to overwrite it.
+    backfill : str
+        How to store data that starts before the start of the archive.
+        'shift' moves the existing data back in place, block by block, to
+        make room at the start of the time dimension. 'rewrite' merges the
+        existing and the new data in memory and rewrites the file.
+    encoding : dict
+        Storage options, i.e. dtype, chunks, compression,
+        compression_level and shuffle, either for all features or keyed
+        by feature name; see :mod:`tonik.encoding`. The options are
+        applied when a file is created and kept for all later writes.
+    pyramid : list of str
+        Time resolutions, e.g. ['1h', '6h', '1D'], of downsampled copies
+        of the data to maintain in groups of the same name. The levels
+        are recorded in the file and updated on every following write.
+        Only supported for the 'original' group.
+    pyramid_method : str
+        Aggregation used for the downsampled copies; one of 'mean',
+        'median', 'max' or 'min'.
     """
     filterwarnings(action='ignore', category=DeprecationWarning,
                    message='`np.bool` is a deprecated alias')
@@ -42,67 +74,220 @@ def xarray2netcdf(xArray, fdir, group="original", timedim="datetime",
     starttime = min(data_starttime, archive_starttime)
     if resolution is None:
         resolution = (np.diff(xArray[timedim])/np.timedelta64(1, 'h'))[0]
+    if backfill not in ('shift', 'rewrite'):
+        raise ValueError(f"Unknown backfill mode {backfill}")
+    if pyramid is not None:
+        if group != 'original':
+            raise ValueError(
+                "Pyramid levels can only be maintained for group 'original'")
+        xArray = xArray.copy()
+        xArray.attrs['pyramid_levels'] = ','.join(pyramid)
+        xArray.attrs['pyramid_method'] = pyramid_method
+
+    # all features share the time axis, so it is only converted once
+    new_time = encode_times(xArray[timedim].values, TIME_UNITS,
+                            TIME_CALENDAR)
 
     for featureName in list(xArray.data_vars.keys()):
         h5file = os.path.join(fdir, featureName + '.nc')
-        _mode = 'w'
-        if os.path.isfile(h5file) and mode == 'a':
-            if archive_starttime > data_starttime:
-                xds_existing = xr.open_dataset(
-                    h5file, group=group, engine='h5netcdf')
-                xda_new = merge_arrays(
-                    xds_existing[featureName], xArray[featureName],
-                    resolution=resolution)
-                xds_existing.close()
-                xda_new.to_netcdf(h5file, group=group,
-                                  mode='w', engine='h5netcdf')
+        # one writer per feature at a time, see tonik.locking
+        with file_lock(h5file):
+            invalidate(h5file)
+            try:
+                levels = _write_feature(
+                    xArray, featureName, h5file, group, timedim,
+                    archive_starttime, data_starttime, starttime,
+                    resolution, mode, backfill,
+                    feature_encoding(encoding, featureName), new_time)
+                if group == 'original' and levels:
+                    _update_pyramid(xArray, featureName, h5file, timedim,
+                                    archive_starttime, resolution, backfill)
+            finally:
+                invalidate(h5file)
+
+
+def encode_times(times, units, calendar):
+    """
+    Convert datetime64 values to the numerical time axis of a file.
+    """
+    if units.startswith('hours since') and calendar in CALENDARS:
+        return _hours(times, units)
+    return date2num(np.asarray(times).astype('datetime64[us]')
+                    .astype(datetime), units=units, calendar=calendar)
+
+
+def _update_pyramid(xArray, featureName, h5file, timedim, archive_starttime,
+                    resolution, backfill='shift'):
+    """
+    Recompute all bins of the pyramid levels that contain new data.
+    """
+    with xr.open_dataset(h5file, group='original', engine='h5netcdf') as ds:
+        levels = ds.attrs.get('pyramid_levels')
+        if not levels:
+            return
+        method = ds.attrs.get('pyramid_method', 'mean')
+        downsampled = []
+        for level in levels.split(','):
+            level_resolution = pd.Timedelta(level) / pd.Timedelta(1, 'h')
+            if level_resolution <= resolution:
                 continue
-            _mode = 'a'
+            start, end = pyramid_window(xArray[timedim].values[0],
+                                        xArray[timedim].values[-1], level)
+            xda = ds[featureName].loc[{timedim: slice(start, end)}].load()
+            xds = downsample(xda, level, method).to_dataset(name=featureName)
+            xds.attrs = {key: value for key, value in xArray.attrs.items()
+                         if not key.startswith('pyramid_')}
+            downsampled.append((level, level_resolution, xds))
+    for level, level_resolution, xds in downsampled:
+        level_starttime = pd.Timestamp(archive_starttime).floor(
+            level).to_pydatetime()
+        data_starttime = xds[timedim].values[0].astype(
+            'datetime64[us]').astype(datetime)
+        _write_feature(xds, featureName, h5file, level, timedim,
+                       level_starttime, data_starttime,
+                       min(data_starttime, level_starttime),
+                       level_resolution, 'a', backfill)
 
-        with h5netcdf.File(h5file, _mode) as h5f:
-            try:
-                rootGrp = _create_h5_Structure(group, featureName,
-                                               h5f, xArray, starttime, timedim)
-            except ValueError:  # group already exists, append
-                rootGrp = h5f[group]
-
-            # determine indices
-            new_time = date2num(xArray[timedim].values.astype('datetime64[us]').astype(datetime),
-                                units=rootGrp[timedim].attrs['units'],
-                                calendar=rootGrp[timedim].attrs['calendar'])
-            t0 = date2num(starttime,
-                          units=rootGrp[timedim].attrs['units'],
-                          calendar=rootGrp[timedim].attrs['calendar'])
-            indices = np.rint((new_time - t0)/resolution).astype(int)
-            if not np.all(indices >= 0):
-                raise ValueError("Data starts before the archive start time")
-            times = rootGrp[timedim]
-            newsize = indices[-1] + 1
-            if newsize > times.shape[0]:
-                rootGrp.resize_dimension(timedim, newsize)
-            times[:] = t0 + np.arange(times.shape[0]) * resolution
-            data = rootGrp[featureName]
-            if len(data.shape) > 1:
-                data[:, indices] = xArray[featureName].values
-            else:
-                data[indices] = xArray[featureName].values
-            rootGrp.attrs['endtime'] = str(num2date(times[-1], units=rootGrp[timedim].attrs['units'],
-                                                    calendar=rootGrp[timedim].attrs['calendar']))
-            rootGrp.attrs['resolution'] = resolution
-            rootGrp.attrs['resolution_units'] = 'h'
-            try:
-                _setMetaInfo(featureName, rootGrp, xArray)
-            except KeyError as e:
-                logging.warning(
-                    f"Could not set all meta info for {featureName}: {e}")
+
+def _write_feature(xArray, featureName, h5file, group, timedim,
+                   archive_starttime, data_starttime, starttime, resolution,
+                   mode, backfill='shift', encoding=None, new_time=None):
+    # Returns the pyramid levels recorded in the group, so callers don't
+    # have to open the file again to find out whether there are any.
+    _mode = 'w'
+    if os.path.isfile(h5file) and mode == 'a':
+        if backfill == 'rewrite' and archive_starttime > data_starttime:
+            xds_existing = xr.open_dataset(
+                h5file, group=group, engine='h5netcdf')
+            xda_new = merge_arrays(
+                xds_existing[featureName], xArray[featureName],
+                resolution=resolution)
+            encoding = normalize_encoding(
+                xds_existing.attrs.get('encoding'))
+            levels = xds_existing.attrs.get('pyramid_levels')
+            xds_existing.close()
+            with atomic_file(h5file) as tmp:
+                xda_new.to_netcdf(tmp, group=group,
+                                  mode='w', engine='h5netcdf',
+                                  encoding={featureName: netcdf_encoding(
+                                      encoding, xda_new.dims,
+                                      xda_new.shape)})
+            return levels
+        _mode = 'a'
+
+    args = (xArray, featureName, group, timedim, starttime, resolution,
+            backfill, encoding, new_time)
+    if _mode == 'w':
+        # new files are written next to their final place and moved
+        # there when complete, so readers never see a partial file
+        with atomic_file(h5file) as tmp:
+            with h5netcdf.File(tmp, 'w') as h5f:
+                return _write_group(h5f, *args)
+    with h5netcdf.File(h5file, 'a') as h5f:
+        return _write_group(h5f, *args)
+
+
+def _write_group(h5f, xArray, featureName, group, timedim, starttime,
+                 resolution, backfill, encoding, new_time):
+    try:
+        rootGrp = _create_h5_Structure(group, featureName,
+                                       h5f, xArray, starttime, timedim,
+                                       encoding)
+    except ValueError:  # group already exists, append
+        rootGrp = h5f[group]
+
+    # determine indices
+    times = rootGrp[timedim]
+    units = times.attrs['units']
+    calendar = times.attrs['calendar']
+    if new_time is None or (units, calendar) != (TIME_UNITS,
+                                                 TIME_CALENDAR):
+        new_time = encode_times(xArray[timedim].values, units, calendar)
+    # looking up the size of a variable is comparatively slow with
+    # h5netcdf, so it is only done once
+    ntimes = times.shape[0]
+    if ntimes > 0:
+        # place data relative to the start of the existing archive
+        t0 = times[0]
+    else:
+        t0 = date2num(starttime, units=units, calendar=calendar)
+    indices = np.rint((new_time - t0)/resolution).astype(int)
+    # time stamps from this index on have to be written
+    first_new = ntimes
+    if indices[0] < 0:
+        if backfill != 'shift':
+            raise ValueError("Data starts before the archive start time")
+        nshift = -indices[0]
+        _shift(rootGrp, featureName, timedim, nshift)
+        t0 -= nshift * resolution
+        indices += nshift
+        ntimes += nshift
+        first_new = 0
+        rootGrp.attrs['archive_starttime'] = str(
+            num2date(t0, units=units, calendar=calendar))
+    newsize = indices[-1] + 1
+    if newsize > ntimes:
+        rootGrp.resize_dimension(timedim, newsize)
+        ntimes = newsize
+    if ntimes > first_new:
+        times[first_new:] = (t0 + np.arange(first_new, ntimes) *
+                             resolution)
+    data = rootGrp[featureName]
+    if np.all(np.diff(indices) == 1):
+        # a hyperslab is much faster to write than a list of indices
+        indices = slice(indices[0], indices[-1] + 1)
+    if len(data.dimensions) > 1:
+        data[:, indices] = xArray[featureName].values
+    else:
+        data[indices] = xArray[featureName].values
+    rootGrp.attrs['endtime'] = str(num2date(
+        t0 + (ntimes - 1) * resolution, units=units, calendar=calendar))
+    rootGrp.attrs['resolution'] = resolution
+    rootGrp.attrs['resolution_units'] = 'h'
+    try:
+        _setMetaInfo(featureName, rootGrp, xArray)
+    except KeyError as e:
+        logging.warning(
+            f"Could not set all meta info for {featureName}: {e}")
+    return rootGrp.attrs.get('pyramid_levels')
+
+
+def _shift(rootGrp, featureName, timedim, nshift, blocksize=2**20):
+    """
+    Move the data of a group `nshift` steps back along the time
+    dimension. Data is copied in place in blocks of about `blocksize`
+    values, starting from the end, so memory use does not depend on the
+    size of the archive.
+    """
+    data = rootGrp[featureName]
+    axis = data.dimensions.index(timedim)
+    ntimes = data.shape[axis]
+    rootGrp.resize_dimension(timedim, ntimes + nshift)
+    nrows = max(int(np.prod(data.shape)) // max(data.shape[axis], 1), 1)
+    step = max(blocksize // nrows, 1)
+
+    def _index(start, stop):
+        return (slice(None),) * axis + (slice(start, stop),)
+
+    for stop in range(ntimes, 0, -step):
+        start = max(stop - step, 0)
+        data[_index(start + nshift, stop + nshift)] = data[_index(start, stop)]
+    fillvalue = data.attrs.get('_FillValue', np.nan)
+    fill_shape = list(data.shape)
+    fill_shape[axis] = min(nshift, ntimes)
+    data[_index(0, fill_shape[axis])] = np.full(fill_shape, fillvalue)
 
 
-def _create_h5_Structure(defaultGroupName, featureName, h5f, xArray, starttime, timedim):
+def _create_h5_Structure(defaultGroupName, featureName, h5f, xArray, starttime, timedim,
+                         encoding=None):
+    if encoding is None and 'original' in h5f:
+        # new groups, e.g. pyramid levels, use the encoding of the data
+        encoding = normalize_encoding(h5f['original'].attrs.get('encoding'))
     rootGrp = h5f.create_group(defaultGroupName)
     rootGrp.dimensions[timedim] = None
     coordinates = rootGrp.create_variable(timedim, (timedim,), float)
-    coordinates.attrs['units'] = 'hours since 1970-01-01 00:00:00.0'
-    coordinates.attrs['calendar'] = 'gregorian'
+    coordinates.attrs['units'] = TIME_UNITS
+    coordinates.attrs['calendar'] = TIME_CALENDAR
     rootGrp.attrs['archive_starttime'] = str(starttime)
     for label, size in xArray.sizes.items():
         if not np.issubdtype(xArray[label].dtype, np.datetime64):
@@ -112,8 +297,14 @@ def _create_h5_Structure(defaultGroupName, featureName, h5f, xArray, starttime,
     # Note: xArray.dims returns a dictionary of dimensions that are not necesarily
     # in the right order; xArray[featureName].dims returns a tuple with dimension
     # names in the correct order
-    rootGrp.create_variable(featureName, tuple(
-        xArray[featureName].dims), dtype=float, fillvalue=0.)
+    dims = tuple(xArray[featureName].dims)
+    dtype = float
+    if encoding:
+        dtype = encoding.get('dtype', dtype)
+        rootGrp.attrs['encoding'] = dumps(encoding)
+    rootGrp.create_variable(featureName, dims, dtype=dtype, fillvalue=0.,
+                            **h5_encoding(encoding, dims,
+                                          xArray[featureName].shape))
     return rootGrp
 
 
@@ -1,22 +1,40 @@
 import logging
 import os
+import warnings
 
+import numpy as np
+import pandas as pd
 import xarray as xr
+from xarray.coding.times import encode_cf_datetime
+import zarr
 try:
     from zarr.errors import PathNotFoundError
 except ImportError:
     class PathNotFoundError(Exception):
         pass
 
-from .utils import merge_arrays
+from .cache import invalidate
+from .encoding import (dumps, feature_encoding, normalize_encoding,
+                       zarr_encoding)
+from .locking import atomic_dir, file_lock
+from .utils import downsample, merge_arrays, pyramid_window
 
 logger = logging.getLogger(__name__)
 
 
-def xarray2zarr(xds: xr.Dataset, path: str, mode: str = 'a', group='original'):
+def xarray2zarr(xds: xr.Dataset, path: str, mode: str = 'a', group='original',
+                archive_starttime=None, resolution=None, encoding=None,
+                pyramid=None, pyramid_method='mean'):
     """
     Write xarray dataset to zarr files.
 
+    By default only the timestamps of the data are stored. If
+    `archive_starttime` is given when a store is created, the data is
+    instead stored on a regular time grid starting at
+    `archive_starttime`, like the netCDF backend does. Data can then be
+    written to any part of the archive after `archive_starttime` by
+    overwriting only the affected index range.
+
     Parameters
     ----------
     xds : xr.Dataset
@@ -27,41 +45,340 @@ def xarray2zarr(xds: xr.Dataset, path: str, mode: str = 'a', group='original'):
         Write mode, by default 'a'.
     group : str, optional
         Group name, by default 'original'
+    archive_starttime : datetime, optional
+        Origin of the regular time grid of a new store. If the data
+        starts earlier, the start of the data is used.
+    resolution : float, optional
+        Time resolution of the regular time grid in hours. If None, the
+        resolution is determined from the data.
+    encoding : dict, optional
+        Storage options, i.e. dtype, chunks, compression,
+        compression_level and shuffle, either for all features or keyed
+        by feature name; see :mod:`tonik.encoding`. The options are
+        applied when a store is created and kept for all later writes.
+    pyramid : list of str, optional
+        Time resolutions, e.g. ['1h', '6h', '1D'], of downsampled copies
+        of the data to maintain in groups of the same name. The levels
+        are recorded in the store and updated on every following write.
+        Only supported for the 'original' group.
+    pyramid_method : str, optional
+        Aggregation used for the downsampled copies; one of 'mean',
+        'median', 'max' or 'min', by default 'mean'.
 
     Returns
     -------
     None
     """
+    if pyramid is not None and group != 'original':
+        raise ValueError(
+            "Pyramid levels can only be maintained for group 'original'")
     for feature in xds.data_vars.keys():
         fout = os.path.join(path, feature + '.zarr')
-        if not os.path.exists(fout) or mode == 'w':
-            xds[feature].to_zarr(
-                fout, group=group, mode='w')
-        else:
+        # one writer per feature at a time, see tonik.locking
+        with file_lock(fout):
+            invalidate(fout)
             try:
-                xds_existing = xr.open_zarr(fout, group=group)
-            except (PathNotFoundError, FileNotFoundError):
-                xds[feature].to_zarr(fout, group=group, mode='a')
-                continue
-            if xds_existing.datetime[0] > xds.datetime[0] or xds_existing.datetime[-1] > xds.datetime[-1]:
-                xda_new = merge_arrays(xds_existing[feature], xds[feature])
-                xda_new.to_zarr(fout, group=group, mode='w')
-            else:
-                try:
-                    overlap = xds_existing.datetime.where(
-                        xds_existing.datetime == xds.datetime)
-                    if overlap.size > 0:
-                        xds[feature].loc[dict(datetime=overlap)].to_zarr(
-                            fout, group=group, mode='r+', region='auto')
-                        xds[feature].drop_sel(datetime=overlap).to_zarr(
-                            fout, group=group, mode='a', append_dim="datetime")
-                    else:
-                        xds[feature].to_zarr(
-                            fout, group=group, append_dim='datetime')
-                except Exception as e:
-                    msg = f"Appending {feature} to {fout} failed: {e}\n"
-                    msg += "Attempting to merge the two datasets."
-                    logger.error(msg)
-                    # remove duplicate datetime entries
-                    xda_new = merge_arrays(xds_existing[feature], xds[feature])
-                    xda_new.to_zarr(fout, group=group, mode='w')
+                _write_feature(xds, feature, fout, mode, group,
+                               archive_starttime, resolution,
+                               feature_encoding(encoding, feature))
+                if pyramid is not None:
+                    attrs = zarr.open_group(fout, path=group,
+                                            mode='r+').attrs
+                    attrs['pyramid_levels'] = ','.join(pyramid)
+                    attrs['pyramid_method'] = pyramid_method
+                if group == 'original':
+                    _update_pyramid(xds, feature, fout)
+                # keep the consolidated metadata at the root of the store in
+                # sync, otherwise groups added later can't be opened
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', category=UserWarning)
+                    zarr.consolidate_metadata(fout)
+            finally:
+                invalidate(fout)
+
+
+def _update_pyramid(xds, feature, fout):
+    """
+    Recompute all bins of the pyramid levels that contain new data.
+    """
+    levels = _group_attrs(fout, 'original').get('pyramid_levels')
+    if not levels:
+        return
+    xds_existing = _open_lazy(fout, 'original', consolidated=False)
+    method = xds_existing.attrs.get('pyramid_method', 'mean')
+    resolution = pd.Timedelta(np.diff(
+        xds_existing.datetime[-2:].values)[0]) \
+        if xds_existing.sizes['datetime'] > 1 else None
+    for level in levels.split(','):
+        if resolution is not None and pd.Timedelta(level) <= resolution:
+            continue
+        start, end = pyramid_window(xds.datetime.values[0],
+                                    xds.datetime.values[-1], level)
+        # only the part of the time axis around the new data is read
+        times = xds_existing.datetime
+        istart = _search_tail(times, np.datetime64(start, 'ns'))
+        iend = _search_tail(times, np.datetime64(end, 'ns'), 'right')
+        xda = xds_existing[feature].isel(datetime=slice(istart, iend))
+        xda_level = downsample(xda.load(), level, method)
+        _write_feature(xda_level.to_dataset(name=feature), feature, fout,
+                       'a', level)
+
+
+def _open_lazy(fout, group, consolidated=None):
+    """
+    Open a group without reading its time axis, so the cost of an append
+    doesn't grow with the size of the store. The returned dataset has
+    no index; select time steps by position.
+    """
+    try:
+        return xr.open_zarr(fout, group=group, chunks=None,
+                            consolidated=consolidated,
+                            create_default_indexes=False)
+    except TypeError:
+        # xarray < 2025.07 always reads the index
+        return xr.open_zarr(fout, group=group, chunks=None,
+                            consolidated=consolidated)
+
+
+def _search_tail(times, value, side='left'):
+    """
+    Return the position of `value` in the sorted, lazily loaded time axis
+    `times` like :func:`numpy.searchsorted`. Chunks are read from the
+    end until the position is found, so finding times close to the end
+    is cheap.
+    """
+    ntimes = times.sizes['datetime']
+    step = times.encoding.get('chunks', (ntimes,))[0] or ntimes
+    stop = ntimes
+    while stop > 0:
+        start = max(stop - step, 0)
+        block = times[start:stop].values
+        if start == 0 or block[0] < value or (
+                side == 'right' and block[0] == value):
+            return start + int(np.searchsorted(block, value, side=side))
+        stop = start
+    return 0
+
+
+def _grid_resolution(xda, resolution):
+    if resolution is None:
+        return np.diff(xda.datetime.values[:2])[0].astype('timedelta64[ns]')
+    return np.timedelta64(int(round(resolution * 3600e9)), 'ns')
+
+
+def _grid_attrs(origin, step):
+    return dict(archive_starttime=str(pd.Timestamp(origin)),
+                resolution=float(step / np.timedelta64(1, 'h')),
+                resolution_units='h')
+
+
+def _grid_indices(times, origin, step):
+    return np.rint((times - origin) / step).astype(int)
+
+
+def _to_grid(xda, origin, step, start, length, fill=None):
+    """
+    Place `xda` onto `length` steps of the regular time grid starting
+    at index `start`. Grid steps without data are taken from `fill` or
+    set to NaN.
+    """
+    axis = xda.get_axis_num('datetime')
+    shape = list(xda.shape)
+    shape[axis] = length
+    dtype = np.result_type(xda.dtype, float)
+    if fill is None:
+        values = np.full(shape, np.nan, dtype=dtype)
+    else:
+        values = np.array(fill, dtype=dtype)
+    idx = _grid_indices(xda.datetime.values, origin, step) - start
+    values[(slice(None),) * axis + (idx,)] = xda.values
+    times = origin + (start + np.arange(length)) * step
+    coords = {dim: xda.coords[dim] for dim in xda.dims
+              if dim != 'datetime' and dim in xda.coords}
+    coords['datetime'] = times
+    return xr.DataArray(values, coords=coords, dims=xda.dims, name=xda.name,
+                        attrs=xda.attrs)
+
+
+def _region(xds):
+    # region writes can only contain variables along the region dimension
+    return xds.drop_vars([name for name in xds.variables
+                          if 'datetime' not in xds[name].dims])
+
+
+def _write_times(times, fout, group, start, stop):
+    # xarray doesn't write index coordinates in region writes
+    arr = zarr.open_array(fout, path=f'{group}/datetime', mode='r+')
+    encoded, _, _ = encode_cf_datetime(times, arr.attrs['units'],
+                                       arr.attrs.get('calendar'),
+                                       dtype=arr.dtype)
+    arr[start:stop] = encoded
+
+
+def _write_region(xda, fout, group, attrs, start, stop, times=False):
+    """
+    Write `xda` to the index range [start, stop) of the existing
+    store, appending the part that extends beyond `stop`. If `times` is
+    True the time coordinate of the range is rewritten as well.
+    """
+    xds = xda.to_dataset()
+    xds.attrs = attrs
+    n_region = stop - start
+    if n_region > 0:
+        _region(xds.isel(datetime=slice(0, n_region))).to_zarr(
+            fout, group=group, mode='r+',
+            region={'datetime': slice(start, stop)})
+        if times:
+            _write_times(xds.datetime.values[:n_region], fout, group,
+                         start, stop)
+    if xds.sizes['datetime'] > n_region:
+        xds.isel(datetime=slice(n_region, None)).to_zarr(
+            fout, group=group, mode='a', append_dim='datetime')
+
+
+def _write_gridded(xda, xds_existing, fout, group):
+    """
+    Write data to a store with a regular time grid touching only the
+    index range covered by the new data.
+    """
+    # the position of the data follows from the grid recorded in the
+    # attributes, the time axis isn't read
+    attrs = dict(xds_existing.attrs)
+    origin = np.datetime64(pd.Timestamp(attrs['archive_starttime']), 'ns')
+    step = np.timedelta64(int(round(attrs['resolution'] * 3600e9)), 'ns')
+    nexisting = xds_existing.sizes['datetime']
+    idx = _grid_indices(xda.datetime.values, origin, step)
+    if idx[0] < 0:
+        return False
+    start = min(idx[0], nexisting)
+    stop = idx[-1] + 1
+    fill = None
+    if start < nexisting and not np.array_equal(idx, np.arange(idx[0], stop)):
+        # keep existing values between new samples
+        xda_existing = xds_existing[xda.name].isel(
+            datetime=slice(start, min(stop, nexisting))).load()
+        fill = _to_grid(xda_existing, origin, step, start,
+                        stop - start).values
+    xda_grid = _to_grid(xda, origin, step, start, stop - start, fill)
+    _write_region(xda_grid, fout, group, attrs, start,
+                  min(stop, nexisting))
+    return True
+
+
+def _write_sparse(xda, xds_existing, fout, group):
+    """
+    Write data to a store that only holds the timestamps of the data.
+
+    Existing data before the start of the new data is left untouched,
+    data after it is merged with the new data and rewritten in place.
+    """
+    attrs = dict(xds_existing.attrs)
+    ntimes = xds_existing.sizes['datetime']
+    start = _search_tail(xds_existing.datetime, xda.datetime.values[0])
+    if start < ntimes:
+        xda_existing = xds_existing[xda.name].isel(
+            datetime=slice(start, None)).load().set_xindex('datetime')
+        new_times = np.union1d(xda_existing.datetime.values,
+                               xda.datetime.values)
+        xda_merged = xda_existing.reindex(datetime=new_times)
+        xda_merged.loc[dict(datetime=xda.datetime.values)] = xda
+        xda = xda_merged
+    _write_region(xda, fout, group, attrs, start, ntimes, times=True)
+
+
+def _to_zarr(xds, fout, group, mode, encoding):
+    encodings = {}
+    if encoding:
+        xds.attrs['encoding'] = dumps(encoding)
+        encodings = {name: zarr_encoding(encoding, xds[name].dims,
+                                         xds[name].shape)
+                     for name in xds.data_vars}
+    if mode != 'w':
+        xds.to_zarr(fout, group=group, mode=mode, encoding=encodings)
+    elif not os.path.exists(fout):
+        # write new stores and groups that replace existing ones next to
+        # their final place, so readers never see a partial store
+        with atomic_dir(fout) as tmp:
+            xds.to_zarr(tmp, group=group, mode='w', encoding=encodings)
+    elif os.path.isdir(os.path.join(fout, group)):
+        # keep the temporary group outside of the store
+        with atomic_dir(os.path.join(fout, group),
+                        os.path.dirname(os.path.abspath(fout))) as tmp:
+            xds.to_zarr(tmp, mode='w', encoding=encodings,
+                        consolidated=False)
+    else:
+        xds.to_zarr(fout, group=group, mode='w', encoding=encodings)
+
+
+def _create(xda, fout, group, mode, archive_starttime, resolution,
+            encoding=None):
+    if encoding is None and mode == 'a':
+        # new groups, e.g. pyramid levels, use the encoding of the data
+        encoding = normalize_encoding(
+            _group_attrs(fout, 'original').get('encoding'))
+    xds = xda.to_dataset()
+    if archive_starttime is not None:
+        step = _grid_resolution(xda, resolution)
+        origin = min(np.datetime64(archive_starttime, 'ns'),
+                     xda.datetime.values[0])
+        length = _grid_indices(xda.datetime.values[-1], origin, step) + 1
+        xds = _to_grid(xda, origin, step, 0, length).to_dataset()
+        xds.attrs = _grid_attrs(origin, step)
+    _to_zarr(xds, fout, group, mode, encoding)
+
+
+def _group_attrs(fout, group):
+    try:
+        return dict(zarr.open_group(fout, path=group, mode='r').attrs)
+    except (PathNotFoundError, FileNotFoundError, KeyError, ValueError):
+        return {}
+
+
+def _rewrite(xda, xds_existing, fout, group):
+    attrs = dict(xds_existing.attrs)
+    if 'datetime' not in xds_existing.indexes:
+        xds_existing = xds_existing.set_xindex('datetime')
+    xda_new = merge_arrays(xds_existing[xda.name], xda)
+    if 'archive_starttime' in attrs:
+        step = np.timedelta64(int(round(attrs['resolution'] * 3600e9)), 'ns')
+        origin = np.datetime64(pd.Timestamp(attrs['archive_starttime']), 'ns')
+        # move the origin back by whole steps to keep the grid
+        nsteps = max(int(np.ceil((origin - xda_new.datetime.values[0]) / step)),
+                     0)
+        origin = origin - nsteps * step
+        length = _grid_indices(xda_new.datetime.values[-1], origin, step) + 1
+        xda_new = _to_grid(xda_new, origin, step, 0, length)
+        attrs.update(_grid_attrs(origin, step))
+    xds = xda_new.to_dataset()
+    xds.attrs = attrs
+    _to_zarr(xds, fout, group, 'w',
+             normalize_encoding(attrs.get('encoding')))
+
+
+def _write_feature(xds, feature, fout, mode, group, archive_starttime=None,
+                   resolution=None, encoding=None):
+    xda = xds[feature].drop_duplicates(
+        'datetime', keep='last').sortby('datetime')
+    if not os.path.exists(fout) or mode == 'w':
+        _create(xda, fout, group, 'w', archive_starttime, resolution,
+                encoding)
+        return
+    try:
+        xds_existing = _open_lazy(fout, group)
+    except (PathNotFoundError, FileNotFoundError, KeyError):
+        _create(xda, fout, group, 'a', archive_starttime, resolution,
+                encoding)
+        return
+    try:
+        if 'archive_starttime' in xds_existing.attrs:
+            if _write_gridded(xda, xds_existing, fout, group):
+                return
+            # data starts before the grid origin
+            _rewrite(xda, xds_existing, fout, group)
+        else:
+            _write_sparse(xda, xds_existing, fout, group)
+    except Exception as e:
+        msg = f"Appending {feature} to {fout} failed: {e}\n"
+        msg += "Attempting to merge the two datasets."
+        logger.error(msg)
+        _rewrite(xda, xds_existing, fout, group)
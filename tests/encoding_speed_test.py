@@ -0,0 +1,63 @@
+import logging
+import os
+import tempfile
+import timeit
+from datetime import datetime
+
+import pytest
+
+from tonik import Storage, generate_test_data
+from tonik.cache import dataset_cache, slice_cache
+
+logger = logging.getLogger(__name__)
+
+tstart = datetime(2023, 1, 1)
+tend = datetime(2023, 12, 31)
+spec = generate_test_data(dim=2, ndays=365, nfreqs=250, tstart=tstart,
+                          feature_names=['ssam'], freq_names=['frequency'])
+
+encodings = {
+    'default': None,
+    'float32': dict(dtype='float32'),
+    'float32-chunked': dict(dtype='float32',
+                            chunks={'datetime': 4096}),
+    'float32-gzip': dict(dtype='float32', chunks={'datetime': 4096},
+                         compression='gzip', compression_level=4,
+                         shuffle=True),
+}
+
+
+def disk_usage(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_encoding_speed(backend):
+    for name, encoding in encodings.items():
+        test_dir = tempfile.mkdtemp()
+        sg = Storage('speed_test', test_dir, starttime=tstart, endtime=tend,
+                     backend=backend)
+        sg.save(spec, encoding=encoding)
+        # read a week of data from the middle of the year
+        sg.starttime = datetime(2023, 6, 1)
+        sg.endtime = datetime(2023, 6, 8)
+
+        def read():
+            # measure reads from disk rather than from the caches
+            slice_cache.clear()
+            dataset_cache.clear()
+            sg('ssam')
+        read_time = timeit.timeit(read, number=5) / 5
+        logger.info('{} {}: {:.1f} MB on disk, one week read in {:.3f} '
+                    'seconds.'.format(backend, name,
+                                      disk_usage(sg.path) / 2**20,
+                                      read_time))
+
+
+if __name__ == '__main__':
+    test_encoding_speed('netcdf')
+    test_encoding_speed('zarr')
@@ -0,0 +1,99 @@
+import logging
+import tempfile
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import h5py
+import pytest
+
+from tonik import Storage, generate_test_data
+from tonik.cache import _open_dataset, invalidate
+from tonik.h5read import read_feature
+
+logger = logging.getLogger(__name__)
+
+tstart = datetime(2023, 1, 1)
+tend = datetime(2023, 12, 31)
+spec = generate_test_data(dim=2, ndays=365, nfreqs=250, tstart=tstart,
+                          feature_names=['ssam'], freq_names=['frequency'])
+
+
+@pytest.mark.slow
+def test_hyperslab_speed():
+    test_dir = tempfile.mkdtemp()
+    sg = Storage('speed_test', test_dir, starttime=tstart, endtime=tend)
+    sg.save(spec, archive_starttime=tstart)
+    filename = sg.feature_path('ssam')
+    # files are kept open by the dataset cache, so only the reads are
+    # compared
+    ds = _open_dataset(filename, 'original', 'h5netcdf')
+    h5f = h5py.File(filename, 'r', locking=False)
+    for days in [1, 30, 365]:
+        start = datetime(2023, 1, 1)
+        end = start + (tend - tstart) * days / 365
+
+        def xarray_read():
+            ds['ssam'].loc[dict(datetime=slice(start, end))].load()
+
+        def hyperslab_read():
+            read_feature(h5f['original'], 'ssam', start, end)
+
+        t_xarray = timeit.timeit(xarray_read, number=10) / 10
+        t_hyperslab = timeit.timeit(hyperslab_read, number=10) / 10
+        logger.info('{} days: xarray {:.4f} s, hyperslab {:.4f} s'.format(
+            days, t_xarray, t_hyperslab))
+
+    # reads of files that are not open yet
+    start = datetime(2023, 1, 1)
+    end = datetime(2023, 1, 2)
+
+    def xarray_open_read():
+        with _open_dataset(filename, 'original', 'h5netcdf') as ds:
+            ds['ssam'].loc[dict(datetime=slice(start, end))].load()
+
+    def hyperslab_open_read():
+        with h5py.File(filename, 'r', locking=False) as h5f:
+            read_feature(h5f['original'], 'ssam', start, end)
+
+    t_xarray = timeit.timeit(xarray_open_read, number=10) / 10
+    t_hyperslab = timeit.timeit(hyperslab_open_read, number=10) / 10
+    logger.info('open and read 1 day: xarray {:.4f} s, '
+                'hyperslab {:.4f} s'.format(t_xarray, t_hyperslab))
+    ds.close()
+    h5f.close()
+
+
+@pytest.mark.slow
+def test_memmap_speed():
+    test_dir = tempfile.mkdtemp()
+    sg = Storage('speed_test', test_dir, starttime=tstart, endtime=tend)
+    sg.save(spec, archive_starttime=tstart)
+    # features written by tonik are chunked, so store a contiguous copy
+    filename = sg.feature_path('ssam')
+    invalidate(filename)
+    contiguous = spec[['ssam']].assign_attrs(resolution=1 / 6.)
+    contiguous.to_netcdf(
+        filename, group='original', engine='h5netcdf',
+        encoding={'datetime': {'units': 'hours since 1970-01-01 00:00:00.0',
+                               'calendar': 'gregorian'}})
+    invalidate(filename)
+    for mmap in [False, True]:
+        def read():
+            # bypass the slice cache for copied reads
+            invalidate(filename)
+            sg('ssam', mmap=mmap).values.sum()
+
+        read()
+        tracemalloc.start()
+        read()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        t = timeit.timeit(read, number=5) / 5
+        logger.info('365 days, mmap={}: {:.4f} s, peak allocation '
+                    '{:.1f} MB'.format(mmap, t, peak / 2**20))
+
+
+if __name__ == '__main__':
+    test_hyperslab_speed()
+    test_memmap_speed()
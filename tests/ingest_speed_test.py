@@ -0,0 +1,104 @@
+import logging
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from tonik import Storage
+from tonik.xarray2netcdf import xarray2netcdf
+from tonik.xarray2zarr import xarray2zarr
+
+logger = logging.getLogger(__name__)
+
+tstart = datetime(2023, 1, 1)
+nfeatures = 20
+
+
+def block(starttime, ntimes):
+    times = pd.date_range(starttime, periods=ntimes, freq='10min')
+    rng = np.random.default_rng(42)
+    return xr.Dataset({f'feature{i}': ('datetime', rng.random(ntimes))
+                       for i in range(nfeatures)},
+                      coords={'datetime': times})
+
+
+@pytest.mark.slow
+def test_ingest_speed():
+    """
+    Append single 10-minute time steps of several features to a year
+    long archive, like a real-time ingest does.
+    """
+    test_dir = tempfile.mkdtemp()
+    xarray2netcdf(block(tstart, 365 * 144), test_dir,
+                  archive_starttime=tstart)
+    starttime = [tstart + timedelta(days=365)]
+
+    def ingest():
+        xarray2netcdf(block(starttime[0], 1), test_dir,
+                      archive_starttime=tstart, resolution=1/6)
+        starttime[0] += timedelta(minutes=10)
+
+    t = timeit.timeit(ingest, number=20) / 20
+    logger.info('Appending one time step to {} features took {:.3f} s.'
+                .format(nfeatures, t))
+
+
+@pytest.mark.slow
+def test_buffered_ingest_speed():
+    """
+    Compare saving every 10-minute time step with collecting a day of
+    time steps in a buffered writer.
+    """
+    g = Storage('ingest', rootdir=tempfile.mkdtemp())
+    kwargs = dict(archive_starttime=tstart, resolution=1/6)
+    g.save(block(tstart, 365 * 144), **kwargs)
+    starttime = [tstart + timedelta(days=365)]
+
+    def ingest(save):
+        for _ in range(144):
+            save(block(starttime[0], 1))
+            starttime[0] += timedelta(minutes=10)
+
+    t_save = timeit.timeit(lambda: ingest(
+        lambda xds: g.save(xds, **kwargs)), number=1) / 144
+    with g.writer(max_rows=144, **kwargs) as w:
+        t_buffered = timeit.timeit(lambda: ingest(w.save), number=1) / 144
+    logger.info('Appending one time step to {} features took {:.3f} s '
+                'with Storage.save and {:.3f} s with a buffered writer.'
+                .format(nfeatures, t_save, t_buffered))
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize('gridded', [False, True])
+def test_zarr_append_speed(gridded):
+    """
+    Append single time steps to zarr stores of different lengths. The
+    time per append shouldn't depend on the length.
+    """
+    kwargs = dict(archive_starttime=tstart) if gridded else {}
+    for nyears in [1, 10]:
+        test_dir = tempfile.mkdtemp()
+        xarray2zarr(block(tstart, nyears * 365 * 144)[['feature0']],
+                    test_dir, **kwargs)
+        starttime = [tstart + timedelta(days=nyears * 365)]
+
+        def ingest():
+            xarray2zarr(block(starttime[0], 1)[['feature0']], test_dir,
+                        resolution=1/6, **kwargs)
+            starttime[0] += timedelta(minutes=10)
+
+        t = timeit.timeit(ingest, number=20) / 20
+        logger.info('Appending one time step to a {}-year {} zarr store '
+                    'took {:.3f} s.'.format(
+                        nyears, 'gridded' if gridded else 'sparse', t))
+
+
+if __name__ == '__main__':
+    test_ingest_speed()
+    test_buffered_ingest_speed()
+    test_zarr_append_speed(False)
+    test_zarr_append_speed(True)
@@ -0,0 +1,41 @@
+import logging
+import timeit
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from tonik import generate_test_data
+from tonik.utils import merge_arrays
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.slow
+def test_merge_speed():
+    """
+    Backfill a day of a 2D feature into a two year archive, like the
+    'rewrite' backfill of the writers does.
+    """
+    xda = generate_test_data(dim=2, ndays=2 * 365, nfreqs=64,
+                             tstart=datetime(2022, 1, 1))['ssam']
+    xda_old = xda.isel(datetime=slice(144, None))
+    xda_new = xda.isel(datetime=slice(0, 288))
+
+    def combine_first():
+        # merge_arrays without the regular grid
+        merged = xda_new.drop_duplicates('datetime', keep='last') \
+            .combine_first(xda_old.drop_duplicates('datetime', keep='last'))
+        return merged.reindex(datetime=pd.date_range(
+            merged.datetime.values[0], merged.datetime.values[-1],
+            freq=f'{1/6}h'))
+
+    t_old = timeit.timeit(combine_first, number=3) / 3
+    t_new = timeit.timeit(lambda: merge_arrays(xda_old, xda_new, 1/6),
+                          number=3) / 3
+    logger.info('Merging took {:.3f} s with combine_first and {:.3f} s '
+                'on the regular grid.'.format(t_old, t_new))
+
+
+if __name__ == '__main__':
+    test_merge_speed()
@@ -0,0 +1,94 @@
+import functools
+import logging
+import tempfile
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tonik import Storage, generate_test_data
+from tonik.cache import invalidate
+from tonik.resample import resample, resample_series
+
+logger = logging.getLogger(__name__)
+
+tstart = datetime(2023, 1, 1)
+tend = datetime(2023, 12, 31)
+spec = generate_test_data(dim=2, ndays=365, nfreqs=250, tstart=tstart,
+                          feature_names=['ssam'], freq_names=['frequency'])
+
+
+def _peak(func):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+@pytest.mark.slow
+def test_downsample_speed():
+    dsh = pytest.importorskip('datashader')
+    test_dir = tempfile.mkdtemp()
+    sg = Storage('speed_test', test_dir, starttime=tstart, endtime=tend)
+    sg.save(spec, archive_starttime=tstart)
+    width, height = 365, 10
+
+    def hours(xda):
+        dates = xda.datetime.values - np.datetime64('1970-01-01')
+        return xda.assign_coords(datetime=dates / np.timedelta64(1, 'h'))
+
+    def datashader_full():
+        invalidate(sg.feature_path('ssam'))
+        feat = hours(sg('ssam'))
+        dsh.Canvas(plot_width=width, plot_height=height).raster(source=feat)
+
+    def chunked(agg):
+        invalidate(sg.feature_path('ssam'))
+        feat = hours(sg('ssam', chunks={'datetime': 2**18 // 250}))
+        resample(feat, width, height, agg)
+
+    # compile datashader's kernels first
+    datashader_full()
+    funcs = [('datashader', datashader_full)]
+    for agg in ['mean', 'median', 'max']:
+        funcs.append((f'chunked {agg}', functools.partial(chunked, agg)))
+    for name, func in funcs:
+        peak = _peak(func)
+        t = timeit.timeit(func, number=3) / 3
+        logger.info('{}: {:.3f} s, peak allocation {:.1f} MB'.format(
+            name, t, peak))
+
+
+@pytest.mark.slow
+def test_resample_series_speed():
+    rsam = generate_test_data(dim=1, ndays=365, tstart=tstart,
+                              feature_names=['rsam'])['rsam']
+    dates = rsam.datetime.values
+    values = rsam.values
+
+    def pandas_median(resolution):
+        df = pd.DataFrame(data=rsam.to_pandas(), columns=['rsam'])
+        df['dates'] = df.index
+        if pd.Timedelta(df['dates'].diff().mean()) < pd.Timedelta(resolution):
+            df = df.resample(pd.Timedelta(resolution)).median()
+        return df['dates'].values, df['rsam'].values
+
+    for resolution in ['1h', '1D']:
+        funcs = [('pandas median', functools.partial(pandas_median,
+                                                     resolution))]
+        for agg in ['median', 'mean', 'max', 'p90']:
+            funcs.append((agg, functools.partial(
+                resample_series, dates, values, resolution, agg)))
+        for name, func in funcs:
+            t = timeit.timeit(func, number=10) / 10
+            logger.info('{} {} samples to {}: {:.4f} s'.format(
+                name, values.size, resolution, t))
+
+
+if __name__ == '__main__':
+    test_downsample_speed()
+    test_resample_series_speed()
@@ -0,0 +1,33 @@
+import logging
+import timeit
+
+import pytest
+
+from tonik import generate_test_data
+from tonik.formats import _csv_rows, _csv_rows_pandas
+
+logger = logging.getLogger(__name__)
+
+spec = generate_test_data(dim=2, nfreqs=250)
+
+
+@pytest.mark.slow
+def test_csv_speed():
+    dates = spec['datetime'].values
+    freqs = spec['frequency'].values
+    values = spec['ssam'].values
+    logger.info('Testing CSV serialisation speed with {} rows.'.format(
+        values.size))
+    execution_time_pandas = timeit.timeit(
+        lambda: _csv_rows_pandas(dates, values, freqs), number=3)
+    logger.info('Serialising with pandas took {} seconds.'.format(
+        execution_time_pandas/3))
+    execution_time_numpy = timeit.timeit(
+        lambda: _csv_rows(dates, values, freqs), number=3)
+    logger.info('Serialising with numpy took {} seconds.'.format(
+        execution_time_numpy/3))
+    assert execution_time_numpy < execution_time_pandas
+
+
+if __name__ == '__main__':
+    test_csv_speed()
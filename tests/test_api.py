@@ -2,6 +2,7 @@ import configparser
 from io import StringIO
 import json
 import os
+from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
@@ -183,6 +184,55 @@ def test_aggregate1DFeature(setup_api):
     assert pd.Timedelta(df.index.diff().mean()) > pd.Timedelta('10min')
     assert pd.Timedelta(df.index.diff().mean()) <= pd.Timedelta('1D')
 
+    # same output as resampling with pandas
+    from tonik.formats import to_csv
+    feat = fq('rsam')
+    expected = pd.DataFrame(data=feat.to_pandas(), columns=['rsam'])
+    expected['dates'] = expected.index
+    expected = expected.resample(pd.Timedelta('1D')).median()
+    assert txt == to_csv(expected['dates'].values, expected['rsam'].values)
+
+    for agg in ['mean', 'max', 'p90']:
+        params['agg'] = agg
+        with client.stream("GET", "/feature", params=params) as r:
+            r.read()
+        assert r.status_code == 200
+        df = pd.read_csv(StringIO(r.text), parse_dates=True, index_col=0)
+        assert len(df) == len(expected)
+    np.testing.assert_array_less(expected['rsam'].values - 1e-6,
+                                 df['feature'].values)
+    params['agg'] = 'p101'
+    with client.stream("GET", "/feature", params=params) as r:
+        r.read()
+    assert r.status_code == 400
+
+
+def test_aggregate_pyramid(tmp_path_factory):
+    from fastapi.testclient import TestClient
+    from tonik import Storage, generate_test_data
+    from tonik.api import TonikAPI
+    rootdir = tmp_path_factory.mktemp('pyramid')
+    tstart = datetime(2023, 1, 1)
+    tend = tstart + timedelta(days=3, minutes=-10)
+    g = Storage('volcanoes', rootdir=rootdir, starttime=tstart, endtime=tend)
+    g.save(generate_test_data(dim=1, ndays=3, tstart=tstart),
+           pyramid=['1h', '1D'])
+    client = TestClient(TonikAPI(str(rootdir)).app)
+    series = g('rsam').to_pandas()
+    # levels of means are only used for means
+    for agg in ['max', 'median', 'mean']:
+        params = dict(name='rsam',
+                      group='volcanoes',
+                      starttime=str(tstart),
+                      endtime=str(tend),
+                      resolution='1D',
+                      agg=agg)
+        with client.stream("GET", "/feature", params=params) as r:
+            r.read()
+        df = pd.read_csv(StringIO(r.text), parse_dates=True, index_col=0)
+        expected = getattr(series.resample('1D'), agg)()
+        np.testing.assert_allclose(df['feature'].values, expected.values)
+
 
 def test_inventory(setup_api):
     client, fq = setup_api
@@ -244,3 +294,372 @@ def test_labels(setup_api):
     assert 'description' in result['dsar'][0]
     assert 'tags' in result['dsar'][0]
     assert 'id' in result['dsar'][0]
+
+
+def test_binary_formats(setup_api):
+    import pyarrow as pa
+    from tonik.formats import read_binary
+    client, l = setup_api
+    for name in ['rsam', 'ssam']:
+        params = dict(name=name,
+                      group='volcanoes',
+                      subdir=['MDR', '00', 'BHZ'],
+                      starttime=str(l.starttime),
+                      endtime=str(l.endtime),
+                      format='binary')
+        with client.stream("GET", "/feature", params=params) as r:
+            r.read()
+            content = r.content
+        assert r.headers['content-type'] == 'application/octet-stream'
+        feat = l(name)
+        dates, values, freqs = read_binary(content)
+        np.testing.assert_array_equal(
+            dates, feat.datetime.values.astype('datetime64[ms]'))
+        np.testing.assert_array_almost_equal(values, feat.values, 4)
+        if name == 'ssam':
+            np.testing.assert_array_equal(freqs, feat.frequency.values)
+        else:
+            assert freqs is None
+
+        params['format'] = 'arrow'
+        with client.stream("GET", "/feature", params=params) as r:
+            r.read()
+            content = r.content
+        df = pa.ipc.open_stream(content).read_pandas()
+        np.testing.assert_array_almost_equal(df['feature'].values,
+                                             feat.values.ravel(order='C'))
+        if name == 'ssam':
+            assert len(np.unique(df['freqs'])) == feat.shape[0]
+
+    params['format'] = 'xml'
+    with client.stream("GET", "/feature", params=params) as r:
+        r.read()
+    assert r.status_code == 400
+
+
+def test_aggregate2DFeature(setup_api):
+    # same result as the datashader based aggregation the API used before
+    dsh = pytest.importorskip('datashader')
+    from cftime import date2num, num2pydate
+    from tonik.formats import read_binary
+    client, l = setup_api
+    units = 'hours since 1970-01-01 00:00:00.0'
+    feat = l('ssam')
+    for resolution in ['1D', '2h', '1min']:
+        params = dict(name='ssam',
+                      group='volcanoes',
+                      subdir=['MDR', '00', 'BHZ'],
+                      starttime=str(l.starttime),
+                      endtime=str(l.endtime),
+                      resolution=resolution,
+                      verticalres=5,
+                      format='binary')
+        with client.stream("GET", "/feature", params=params) as r:
+            r.read()
+            dates, values, freqs = read_binary(r.content)
+        dates_ = feat.datetime.values
+        ndays = np.timedelta64(dates_[-1] - dates_[0], 'ms').astype(float)
+        canvas_x = int(ndays / np.timedelta64(
+            pd.Timedelta(resolution), 'ms').astype(float))
+        hours = date2num(dates_.astype('datetime64[us]').astype(datetime),
+                         units=units, calendar='gregorian')
+        expected = dsh.Canvas(plot_width=canvas_x, plot_height=5).raster(
+            source=feat.assign_coords({'datetime': hours}))
+        expected_dates = pd.to_datetime(num2pydate(
+            expected.datetime.values, units=units,
+            calendar='gregorian')).values
+        np.testing.assert_allclose(values, expected.values, rtol=1e-6)
+        np.testing.assert_array_equal(freqs, expected.frequency.values)
+        assert np.all(np.abs(dates - expected_dates) <=
+                      np.timedelta64(1, 'ms'))
+
+    params.update(resolution='1D', format='csv')
+    for agg in ['median', 'min', 'max']:
+        params['agg'] = agg
+        with client.stream("GET", "/feature", params=params) as r:
+            r.read()
+        assert r.status_code == 200
+        df = pd.read_csv(StringIO(r.text), parse_dates=True, index_col=0)
+        assert len(np.unique(df.index)) == 5
+    params['agg'] = 'mode'
+    with client.stream("GET", "/feature", params=params) as r:
+        r.read()
+    assert r.status_code == 400
+
+
+def test_aggregate_cached(setup, setup_api):
+    from fastapi.testclient import TestClient
+    from tonik.api import TonikAPI
+    from tonik.cache import slice_cache
+    from tonik.formats import read_binary
+    savedir, _ = setup
+    _, l = setup_api
+    params = dict(name='ssam',
+                  group='volcanoes',
+                  subdir=['MDR', '00', 'BHZ'],
+                  starttime=str(l.starttime),
+                  endtime=str(l.endtime),
+                  resolution='2h',
+                  format='binary')
+    results = []
+    # small windows are read through the caches, large ones chunk by
+    # chunk
+    for chunked_nbytes in [2**26, 0]:
+        client = TestClient(TonikAPI(str(savedir),
+                                     chunked_nbytes=chunked_nbytes).app)
+        slice_cache.clear()
+        for _ in range(2):
+            with client.stream("GET", "/feature", params=params) as r:
+                r.read()
+            assert r.status_code == 200
+        info = slice_cache.info()
+        assert (info.hits, info.misses) == ((1, 1) if chunked_nbytes
+                                            else (0, 0))
+        results.append(read_binary(r.content))
+    (dates, values, freqs), (cdates, cvalues, cfreqs) = results
+    np.testing.assert_array_equal(dates, cdates)
+    np.testing.assert_array_equal(freqs, cfreqs)
+    np.testing.assert_allclose(values, cvalues, rtol=1e-6)
+
+
+def test_streaming(setup, setup_api):
+    from fastapi.testclient import TestClient
+    from tonik.api import TonikAPI
+    from tonik.formats import read_binary
+    savedir, _ = setup
+    _, l = setup_api
+    # force the feature to be read and encoded in many small blocks
+    client = TestClient(TonikAPI(str(savedir), block_size=100).app)
+    for name in ['rsam', 'ssam']:
+        feat = l(name)
+        params = dict(name=name,
+                      group='volcanoes',
+                      subdir=['MDR', '00', 'BHZ'],
+                      starttime=str(l.starttime),
+                      endtime=str(l.endtime))
+        with client.stream("GET", "/feature", params=params) as r:
+            r.read()
+            txt = r.text
+        assert 'content-length' not in r.headers
+        df = pd.read_csv(StringIO(txt), parse_dates=True, index_col=0)
+        np.testing.assert_array_almost_equal(df['feature'].values,
+                                             feat.values.ravel(order='C'))
+        params['format'] = 'binary'
+        with client.stream("GET", "/feature", params=params) as r:
+            r.read()
+            content = r.content
+        dates, values, freqs = read_binary(content)
+        np.testing.assert_array_equal(
+            dates, feat.datetime.values.astype('datetime64[ms]'))
+        np.testing.assert_array_almost_equal(values, feat.values, 4)
+
+    params = dict(name='sonogram',
+                  group='volcanoes',
+                  subdir=['MDR', '00', 'BHZ'],
+                  starttime=str(l.starttime),
+                  endtime=str(l.endtime),
+                  log=True,
+                  normalise=True)
+    with client.stream("GET", "/feature", params=params) as r:
+        r.read()
+        txt = r.text
+    df = pd.read_csv(StringIO(txt), parse_dates=True, index_col=0)
+    assert np.nanmax(df['feature'].values) == 1.
+    assert np.nanmin(df['feature'].values) == 0.
+
+
+def test_features(setup_api):
+    import pyarrow as pa
+    client, l = setup_api
+    params = dict(name=['rsam', 'dsar', 'filterbank'],
+                  group='volcanoes',
+                  subdir=['MDR', '00', 'BHZ'],
+                  starttime=str(l.starttime),
+                  endtime=str(l.endtime))
+    with client.stream("GET", "/features", params=params) as r:
+        r.read()
+        txt = r.text
+    df = pd.read_csv(StringIO(txt), parse_dates=True, index_col=0)
+    filterbank = l('filterbank')
+    assert list(df.columns[:2]) == ['rsam', 'dsar']
+    assert len(df.columns) == 2 + filterbank.shape[0]
+    np.testing.assert_array_almost_equal(df['rsam'].values,
+                                         l('rsam').values)
+    np.testing.assert_array_almost_equal(df['filterbank_0.0'].values,
+                                         filterbank.values[0])
+
+    params['format'] = 'arrow'
+    with client.stream("GET", "/features", params=params) as r:
+        r.read()
+        content = r.content
+    df = pa.ipc.open_stream(content).read_pandas()
+    np.testing.assert_array_almost_equal(df['dsar'].values,
+                                         l('dsar').values)
+
+    params['format'] = 'csv'
+    params['resolution'] = '1D'
+    with client.stream("GET", "/features", params=params) as r:
+        r.read()
+        txt = r.text
+    df = pd.read_csv(StringIO(txt), parse_dates=True, index_col=0)
+    assert len(df) == len(l('rsam').resample(datetime='1D').median())
+
+    params['name'] = ['rsam', 'doesnt_exist']
+    with client.stream("GET", "/features", params=params) as r:
+        r.read()
+    assert r.status_code == 404
+
+
+def test_query(setup_api):
+    client, l = setup_api
+    params = dict(name='rsam',
+                  group='volcanoes',
+                  selector='M*',
+                  starttime=str(l.starttime),
+                  endtime=str(l.endtime))
+    with client.stream("GET", "/query", params=params) as r:
+        r.read()
+        txt = r.text
+    df = pd.read_csv(StringIO(txt), parse_dates=True, index_col=0)
+    assert sorted(df.columns) == ['MAVZ.10.EHZ', 'MDR.00.BHZ', 'MMS.66.BHZ']
+    np.testing.assert_array_almost_equal(df['MDR.00.BHZ'].values,
+                                         l('rsam').values)
+
+    params['name'] = 'autoencoder'
+    with client.stream("GET", "/query", params=params) as r:
+        r.read()
+        txt = r.text
+    df = pd.read_csv(StringIO(txt), parse_dates=True, index_col=0)
+    assert len(df.columns) == 5
+
+    params['selector'] = 'XYZ'
+    with client.stream("GET", "/query", params=params) as r:
+        r.read()
+    assert r.status_code == 404
+
+
+def test_nonblocking(setup, setup_api):
+    import asyncio
+    import time
+
+    import httpx
+    from fastapi.testclient import TestClient
+    from tonik.api import TonikAPI
+    savedir, _ = setup
+    _, l = setup_api
+    ta = TonikAPI(str(savedir), timeout=0.5)
+    aggregate_feature = ta.aggregate_feature
+
+    def slow_aggregate(*args):
+        time.sleep(1.)
+        return aggregate_feature(*args)
+
+    ta.aggregate_feature = slow_aggregate
+    params = dict(name='ssam',
+                  group='volcanoes',
+                  subdir=['MDR', '00', 'BHZ'],
+                  starttime=str(l.starttime),
+                  endtime=str(l.endtime),
+                  resolution='1D')
+    with TestClient(ta.app).stream("GET", "/feature", params=params) as r:
+        r.read()
+    assert r.status_code == 504
+
+    # a slow request doesn't hold up other requests
+    ta.timeout = 10.
+    finished = []
+
+    async def get(client, url, params):
+        r = await client.get(url, params=params)
+        finished.append(url)
+        return r
+
+    async def main():
+        transport = httpx.ASGITransport(app=ta.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://test') as client:
+            return await asyncio.gather(
+                get(client, '/feature', params),
+                get(client, '/inventory', dict(group='volcanoes')))
+
+    responses = asyncio.run(main())
+    assert [r.status_code for r in responses] == [200, 200]
+    assert finished == ['/inventory', '/feature']
+
+
+def test_coalescing(setup, setup_api):
+    import asyncio
+    import time
+
+    import httpx
+    from tonik.api import TonikAPI
+    savedir, _ = setup
+    _, l = setup_api
+    ta = TonikAPI(str(savedir))
+    aggregate_feature = ta.aggregate_feature
+    calls = []
+
+    def slow_aggregate(*args):
+        calls.append(args)
+        time.sleep(.5)
+        return aggregate_feature(*args)
+
+    ta.aggregate_feature = slow_aggregate
+    params = dict(name='ssam',
+                  group='volcanoes',
+                  subdir=['MDR', '00', 'BHZ'],
+                  starttime=str(l.starttime),
+                  endtime=str(l.endtime),
+                  resolution='1D')
+
+    async def main():
+        transport = httpx.ASGITransport(app=ta.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://test') as client:
+            responses = await asyncio.gather(
+                *[client.get('/feature', params=params) for _ in range(5)],
+                client.get('/feature', params=dict(params, log=True)))
+            stats = await client.get('/stats')
+            return responses, stats.json()
+
+    responses, stats = asyncio.run(main())
+    assert all(r.status_code == 200 for r in responses)
+    assert len(set(r.text for r in responses[:5])) == 1
+    assert responses[5].text != responses[0].text
+    assert len(calls) == 2
+    assert stats == dict(requests=6, coalesced=4, inflight=0)
+
+    # full resolution windows that fit into one block are shared too
+    feature_blocks = ta.feature_blocks
+
+    def slow_blocks(*args, **kwargs):
+        calls.append(args)
+        time.sleep(.5)
+        yield from feature_blocks(*args, **kwargs)
+
+    ta.feature_blocks = slow_blocks
+    del params['resolution']
+    calls.clear()
+    responses, stats = asyncio.run(main())
+    assert all(r.status_code == 200 for r in responses)
+    assert len(set(r.text for r in responses[:5])) == 1
+    assert len(calls) == 2
+    assert stats == dict(requests=12, coalesced=8, inflight=0)
+
+
+def test_metadata(setup_api):
+    client, l = setup_api
+    params = dict(group='volcanoes', subdir=['MDR', '00', 'BHZ'])
+    with client.stream("GET", "/metadata", params=params) as r:
+        r.read()
+        txt = r.text
+    meta = json.loads(txt)
+    assert 'autoencoder' in meta and 'rsam' in meta
+    assert meta['rsam']['starttime'] == '2023-01-01T00:00:00'
+    assert meta['rsam']['endtime'] == '2023-01-10T23:50:00'
+    assert meta['ssam']['sizes']['frequency'] == 8
+
+    params['name'] = ['rsam', 'doesnt_exist']
+    with client.stream("GET", "/metadata", params=params) as r:
+        r.read()
+    assert r.status_code == 404
@@ -0,0 +1,37 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from tonik import generate_test_data
+from tonik.formats import (_csv_rows, _csv_rows_pandas, read_binary,
+                           to_binary)
+
+
+def test_csv_rows():
+    xdf = generate_test_data(dim=2, nfreqs=5, ndays=2,
+                             tstart=datetime(2023, 1, 1, 0, 0, 7))
+    dates = xdf.datetime.values
+    for values in [xdf.ssam.values, xdf.ssam.values.astype('float32')]:
+        for freqs in [xdf.frequency.values, xdf.frequency.values * 0.1]:
+            assert _csv_rows(dates, values, freqs) == \
+                _csv_rows_pandas(dates, values, freqs)
+    rsam = xdf.ssam.values[0]
+    assert _csv_rows(dates, rsam) == _csv_rows_pandas(dates, rsam)
+    dates = dates.copy()
+    dates[3] = np.datetime64('NaT')
+    assert _csv_rows(dates, rsam) == _csv_rows_pandas(dates, rsam)
+    assert _csv_rows(dates[:0], rsam[:0]) == ''
+
+
+def test_binary():
+    dates = pd.date_range('2023-01-01', periods=20, freq='10min').values
+    values = np.arange(60, dtype=float).reshape(3, 20)
+    freqs = np.array([0.5, 1., 2.])
+    d, v, f = read_binary(to_binary(dates, values, freqs))
+    np.testing.assert_array_equal(d, dates)
+    np.testing.assert_array_equal(v, values)
+    np.testing.assert_array_equal(f, freqs)
+    d, v, f = read_binary(to_binary(dates, values[0]))
+    np.testing.assert_array_equal(v, values[0])
+    assert f is None
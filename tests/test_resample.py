@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from tonik.resample import resample, resample_series, sorted_quantile
+
+
+def _spectrogram(nfreqs, ntimes):
+    rng = np.random.default_rng(42)
+    values = rng.random((nfreqs, ntimes))
+    values[min(3, nfreqs - 1), 10:30] = np.nan
+    values[:, 40:42] = np.nan
+    return xr.DataArray(values, dims=('frequency', 'datetime'),
+                        coords={'frequency': np.linspace(0, 25, nfreqs),
+                                'datetime': 400000. + np.arange(ntimes) / 6.})
+
+
+@pytest.mark.parametrize('nfreqs,ntimes,height,width',
+                         [(37, 5000, 10, 173), (8, 1000, 8, 997),
+                          (250, 4320, 250, 5), (8, 720, 8, 720),
+                          (20, 777, 1, 1), (37, 50, 10, 173),
+                          (8, 100, 8, 250), (3, 10, 1, 100)])
+def test_resample_mean(nfreqs, ntimes, height, width):
+    # same result as datashader's raster aggregation
+    dsh = pytest.importorskip('datashader')
+    xda = _spectrogram(nfreqs, ntimes)
+    expected = dsh.Canvas(plot_width=width,
+                          plot_height=height).raster(source=xda)
+    for source in [xda, xda.chunk(datetime=97)]:
+        spec, freqs, dates = resample(source, width, height, blocksize=1000)
+        np.testing.assert_allclose(spec, expected.values, rtol=1e-12)
+        np.testing.assert_array_equal(freqs, expected.frequency.values)
+        np.testing.assert_array_equal(dates, expected.datetime.values)
+
+
+@pytest.mark.parametrize('agg', ['median', 'min', 'max', 'p90'])
+def test_resample_binned(agg):
+    xda = _spectrogram(37, 1000)
+    height, width = 10, 173
+    func = dict(median=np.nanmedian, min=np.nanmin, max=np.nanmax,
+                p90=lambda x: np.nanpercentile(x, 90))[agg]
+    expected = np.full((height, width), np.nan)
+    rows = np.arange(37) * height // 37
+    cols = np.arange(1000) * width // 1000
+    values = xda.values
+    for i in range(height):
+        for j in range(width):
+            block = values[rows == i][:, cols == j]
+            if np.isfinite(block).any():
+                expected[i, j] = func(block)
+    for source in [xda, xda.chunk(datetime=97)]:
+        spec, _, _ = resample(source, width, height, agg, blocksize=1000)
+        np.testing.assert_allclose(spec, expected)
+    with pytest.raises(ValueError):
+        resample(xda, width, height, 'mode')
+
+
+def test_sorted_quantile():
+    rng = np.random.default_rng(0)
+    values = rng.random((50, 13))
+    values[values < 0.2] = np.nan
+    values[7] = np.nan
+    for q in [0., 0.1, 0.5, 0.9, 1.]:
+        with np.errstate(invalid='ignore'):
+            with pytest.warns(RuntimeWarning):
+                expected = np.nanquantile(values, q, axis=1)
+        np.testing.assert_allclose(sorted_quantile(values, q), expected)
+
+
+@pytest.mark.parametrize('uneven', [False, True])
+@pytest.mark.parametrize('agg', ['mean', 'median', 'min', 'max', 'p10'])
+def test_resample_series(agg, uneven):
+    rng = np.random.default_rng(1)
+    times = pd.date_range('2023-01-01 03:07:13', periods=2000, freq='10min')
+    # a gap, an irregular time step and bins with NaN only
+    times = times.delete(range(300, 450))
+    times = times.insert(601, times[600] + pd.Timedelta('1min'))
+    if uneven:
+        # one bin with many more samples than the others
+        times = times.union(pd.date_range(times[1500], periods=5000,
+                                          freq='100ms'))
+    values = rng.random(times.size).astype(np.float32)
+    values[values < 0.1] = np.nan
+    values[1000:1010] = np.nan
+    df = pd.DataFrame({'rsam': values}, index=times)
+    df['dates'] = df.index
+    resampler = df.resample(pd.Timedelta('1h'))
+    if agg == 'p10':
+        expected = resampler[['rsam']].quantile(0.1)
+    else:
+        expected = getattr(resampler, agg)()
+    dates, vals = resample_series(times.values, values, '1h', agg)
+    assert vals.dtype == np.float32
+    np.testing.assert_allclose(vals, expected['rsam'].values, rtol=1e-6)
+    if agg == 'median':
+        np.testing.assert_array_equal(dates, expected['dates'].values)
+    dates, vals = resample_series(times.values[:0], values[:0], '1h', agg)
+    assert dates.size == vals.size == 0
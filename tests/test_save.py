@@ -1,4 +1,6 @@
+import multiprocessing
 import os
+import random
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -7,7 +9,7 @@ import xarray as xr
 
 from tonik import Storage, generate_test_data
 from tonik.xarray2netcdf import xarray2netcdf
-from tonik.xarray2zarr import xarray2zarr
+from tonik.xarray2zarr import _open_lazy, _search_tail, xarray2zarr
 
 
 def test_xarray2netcdf(tmp_path_factory):
@@ -72,6 +74,40 @@ def test_xarray2netcdf_merge_arrays(tmp_path_factory):
     assert xdf_test.loc['2022-07-20T11:50:00'] == xdf2['rsam'].loc['2022-07-20T11:50:00']
 
 
+def test_xarray2netcdf_backfill(tmp_path_factory, monkeypatch):
+    """
+    Test backfilling a 2D feature by shifting the archive in place.
+    """
+    import tonik.xarray2netcdf
+
+    temp_dir = tmp_path_factory.mktemp('test_xarray2netcdf')
+    start = datetime(2022, 7, 18, 0, 0, 0)
+    xdf = generate_test_data(dim=2, ndays=2, tstart=start, add_nans=False)
+    xarray2netcdf(xdf.isel(datetime=slice(150, None)), temp_dir,
+                  archive_starttime=datetime(2022, 7, 19))
+    # force the data to be moved in several blocks
+    shift = tonik.xarray2netcdf._shift
+    monkeypatch.setattr(
+        tonik.xarray2netcdf, '_shift',
+        lambda *args: shift(*args, blocksize=100))
+    monkeypatch.setattr(tonik.xarray2netcdf, 'merge_arrays', None)
+    xarray2netcdf(xdf.isel(datetime=slice(0, 100)), temp_dir,
+                  archive_starttime=datetime(2022, 7, 19))
+    xdf_test = xr.open_dataset(os.path.join(temp_dir, 'ssam.nc'),
+                               group='original', engine='h5netcdf')
+    np.testing.assert_array_almost_equal(
+        xdf_test['ssam'].values[:, :100], xdf['ssam'].values[:, :100])
+    assert np.all(np.isnan(xdf_test['ssam'].values[:, 100:150]))
+    np.testing.assert_array_almost_equal(
+        xdf_test['ssam'].values[:, 150:], xdf['ssam'].values[:, 150:])
+    assert xdf_test.attrs['archive_starttime'] == str(start)
+    dt = np.abs(xdf_test['datetime'].values - xdf['datetime'].values).max()
+    assert dt < np.timedelta64(1, 'us')
+    xdf_test.close()
+    with pytest.raises(ValueError):
+        xarray2netcdf(xdf, temp_dir, backfill='append')
+
+
 def test_xarray2netcdf_resolution(tmp_path_factory):
     xdf = generate_test_data(dim=1, ndays=1, tstart=datetime(2022, 7, 18, 0, 0, 0),
                              add_nans=False)
@@ -125,6 +161,40 @@ def test_xarray2netcdf_with_gaps(tmp_path_factory):
     assert xdf_test.isnull().sum() == 24
 
 
+def test_xarray2netcdf_incremental(tmp_path_factory):
+    """
+    Test that writing one time step at a time gives the same files as
+    writing all data at once.
+    """
+    start = datetime(2022, 7, 18, 0, 0, 0)
+    xdf = generate_test_data(dim=1, ndays=1, tstart=start,
+                             feature_names=['rsam', 'dsar'])
+    full_dir = tmp_path_factory.mktemp('test_xarray2netcdf')
+    xarray2netcdf(xdf, full_dir, archive_starttime=start)
+    temp_dir = tmp_path_factory.mktemp('test_xarray2netcdf')
+    xarray2netcdf(xdf.isel(datetime=slice(0, 2)), temp_dir,
+                  archive_starttime=start)
+    for i in range(2, 60):
+        xarray2netcdf(xdf.isel(datetime=[i]), temp_dir,
+                      archive_starttime=start, resolution=1/6)
+    # leave a gap and write the rest at once
+    xarray2netcdf(xdf.isel(datetime=slice(70, None)), temp_dir,
+                  archive_starttime=start)
+    xarray2netcdf(xdf.isel(datetime=slice(60, 70)), temp_dir,
+                  archive_starttime=start)
+    for feature in ['rsam', 'dsar']:
+        with xr.open_dataset(os.path.join(full_dir, f'{feature}.nc'),
+                             group='original', engine='h5netcdf') as full, \
+                xr.open_dataset(os.path.join(temp_dir, f'{feature}.nc'),
+                                group='original',
+                                engine='h5netcdf') as xdf_test:
+            np.testing.assert_array_equal(xdf_test['datetime'].values,
+                                          full['datetime'].values)
+            np.testing.assert_array_equal(xdf_test[feature].values,
+                                          full[feature].values)
+            assert xdf_test.attrs['endtime'] == full.attrs['endtime']
+
+
 @pytest.mark.xfail(raises=OSError)
 def test_xarray2netcdf_multi_access(tmp_path_factory):
     """
@@ -313,3 +383,235 @@ def test_xarray2zarr_errors(tmp_path_factory):
         xdf[feature].to_zarr(os.path.join(temp_dir, feature + '.zarr'),
                              mode='w')
     xarray2zarr(xdf, temp_dir, mode='a')
+
+
+def test_xarray2zarr_search_tail(tmp_path_factory):
+    """
+    Test finding positions on the time axis of a store by reading it
+    from the end.
+    """
+    temp_dir = tmp_path_factory.mktemp('test_xarray2zarr')
+    xdf = generate_test_data(dim=1, ndays=1, tstart=datetime(2022, 7, 18))
+    fout = os.path.join(temp_dir, 'rsam.zarr')
+    xdf.to_zarr(fout, group='original',
+                encoding={'datetime': {'chunks': (10,)}})
+    xds = _open_lazy(fout, 'original')
+    assert not xds.indexes
+    assert xds.datetime.encoding['chunks'] == (10,)
+    times = xdf.datetime.values
+    for value in [times[0] - np.timedelta64(1, 'm'), times[0], times[9],
+                  times[10], times[10] + np.timedelta64(1, 'm'), times[95],
+                  times[-1], times[-1] + np.timedelta64(1, 'm')]:
+        for side in ['left', 'right']:
+            assert _search_tail(xds.datetime, value, side) == \
+                np.searchsorted(times, value, side=side)
+
+
+def test_xarray2zarr_region_writes(tmp_path_factory, monkeypatch):
+    """
+    Test that backfills and overlaps are written in place.
+    """
+    import tonik.xarray2zarr
+
+    def no_rewrite(*args, **kwargs):
+        raise AssertionError('store was rewritten')
+
+    temp_dir = tmp_path_factory.mktemp('test_xarray2zarr')
+    start = datetime(2022, 7, 18, 0, 0, 0)
+    xdf = generate_test_data(dim=2, ndays=2, tstart=start, add_nans=False)
+    xdf1 = xdf.isel(datetime=slice(144, None))
+    xdf2 = xdf.isel(datetime=slice(0, 100))
+    xdf3 = xdf.isel(datetime=slice(90, 150))
+    xarray2zarr(xdf1, temp_dir, archive_starttime=start)
+    monkeypatch.setattr(tonik.xarray2zarr, '_rewrite', no_rewrite)
+    monkeypatch.setattr(tonik.xarray2zarr, 'merge_arrays', no_rewrite)
+    # backfill with a gap, then fill the gap
+    xarray2zarr(xdf2, temp_dir)
+    xdf_test = xr.open_zarr(os.path.join(temp_dir, 'ssam.zarr'),
+                            group='original')
+    assert xdf_test.attrs['archive_starttime'] == str(start)
+    np.testing.assert_array_equal(xdf_test.datetime.values,
+                                  xdf.datetime.values)
+    assert np.all(np.isnan(xdf_test['ssam'][:, 100:144].values))
+    xarray2zarr(xdf3, temp_dir)
+    xdf_test = xr.open_zarr(os.path.join(temp_dir, 'ssam.zarr'),
+                            group='original')
+    np.testing.assert_array_almost_equal(xdf_test['ssam'].values,
+                                         xdf['ssam'].values)
+    # sparse stores merge data after the insertion point in place
+    temp_dir = tmp_path_factory.mktemp('test_xarray2zarr')
+    xarray2zarr(xdf1.isel(datetime=slice(0, None, 2)), temp_dir)
+    xarray2zarr(xdf2, temp_dir)
+    xarray2zarr(xdf.isel(datetime=slice(145, None, 2)), temp_dir)
+    xdf_test = xr.open_zarr(os.path.join(temp_dir, 'ssam.zarr'),
+                            group='original')
+    expected = xr.concat([xdf2, xdf1], dim='datetime')
+    np.testing.assert_array_equal(xdf_test.datetime.values,
+                                  expected.datetime.values)
+    np.testing.assert_array_almost_equal(xdf_test['ssam'].values,
+                                         expected['ssam'].values)
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_pyramid(tmp_path_factory, backend):
+    """
+    Test maintaining downsampled copies of a feature.
+    """
+    temp_dir = tmp_path_factory.mktemp('test_pyramid')
+    start = datetime(2022, 7, 18, 0, 0, 0)
+    xdf = generate_test_data(dim=2, ndays=3, tstart=start, add_nans=False)
+    xdf1 = xdf.isel(datetime=slice(0, 200))
+    xdf2 = xdf.isel(datetime=slice(200, None))
+    g = Storage('test_experiment', rootdir=temp_dir, starttime=start,
+                endtime=start + timedelta(days=3), backend=backend)
+    g.save(xdf1, pyramid=['1h', '6h'], pyramid_method='max')
+    # levels are updated on append without passing them again
+    g.save(xdf2)
+    assert g.pyramid_levels('ssam') == ['1h', '6h']
+    for level in ['1h', '6h']:
+        expected = xdf['ssam'].resample(datetime=level).max()
+        xdf_test = g('ssam', group=level)
+        np.testing.assert_array_almost_equal(xdf_test.values,
+                                             expected.values)
+        np.testing.assert_array_equal(xdf_test.datetime.values,
+                                      expected.datetime.values)
+    assert g('ssam', resolution='2h', method='max').sizes['datetime'] == 72
+    assert g('ssam', resolution='1D', method='max').sizes['datetime'] == 12
+    assert g('ssam', resolution='10min',
+             method='max').sizes['datetime'] == 432
+    # levels of another method are never used
+    for method in ['mean', 'median', 'min']:
+        assert g('ssam', resolution='6h',
+                 method=method).sizes['datetime'] == 432
+    with pytest.raises(ValueError):
+        g.save(xdf1, group='modified', pyramid=['1h'])
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_encoding(tmp_path_factory, backend):
+    """
+    Test storing features with a custom dtype, chunking and compression.
+    """
+    temp_dir = tmp_path_factory.mktemp('test_encoding')
+    start = datetime(2022, 7, 18, 0, 0, 0)
+    xdf = generate_test_data(dim=2, ndays=2, tstart=start, add_nans=False)
+    g = Storage('test_experiment', rootdir=temp_dir, starttime=start,
+                endtime=start + timedelta(days=2), backend=backend)
+    encoding = dict(dtype='float32', chunks={'datetime': 64},
+                    compression='gzip', shuffle=True)
+    g.save(xdf.isel(datetime=slice(0, 150)), pyramid=['6h'],
+           encoding={'ssam': encoding})
+    # the encoding is kept for appends and new groups
+    g.save(xdf.isel(datetime=slice(150, None)))
+    xdf_test = g('ssam')
+    assert xdf_test.dtype == np.float32
+    assert g('ssam', group='6h').dtype == np.float32
+    assert g('filterbank').dtype == np.float64
+    np.testing.assert_allclose(xdf_test.values, xdf['ssam'].values,
+                               rtol=1e-6)
+    with pytest.raises(ValueError):
+        g.save(xdf, encoding={'compression': 'snappy'})
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_rewrite_is_atomic(tmp_path_factory, backend):
+    """
+    Test that rewritten files replace the old ones in one step.
+    """
+    temp_dir = tmp_path_factory.mktemp('test_rewrite')
+    start = datetime(2022, 7, 18, 0, 0, 0)
+    xdf1 = generate_test_data(dim=1, ndays=1, tstart=start)
+    xdf2 = xdf1 + 1.
+    xdf2.attrs = xdf1.attrs
+    write = xarray2netcdf if backend == 'netcdf' else xarray2zarr
+    write(xdf1, temp_dir, archive_starttime=start)
+    ending = '.nc' if backend == 'netcdf' else '.zarr'
+    filename = os.path.join(temp_dir, 'rsam' + ending)
+    if backend == 'netcdf':
+        old = xr.open_dataset(filename, group='original',
+                              engine='h5netcdf')
+    write(xdf2, temp_dir, mode='w', archive_starttime=start)
+    if backend == 'netcdf':
+        # readers that opened the old file keep reading it
+        np.testing.assert_array_equal(old['rsam'].values,
+                                      xdf1['rsam'].values)
+        old.close()
+    with xr.open_dataset(filename, group='original',
+                         engine='h5netcdf' if backend == 'netcdf'
+                         else 'zarr') as new:
+        np.testing.assert_array_equal(new['rsam'].values,
+                                      xdf2['rsam'].values)
+    # no temporary files are left behind
+    for path, dirs, files in os.walk(temp_dir):
+        assert not [f for f in dirs + files if f.endswith('.tmp')]
+
+
+def _save_days(rootdir, backend, days, archive_starttime):
+    c = Storage('stress', rootdir=rootdir,
+                backend=backend).get_substore('MDR', '00', 'HHZ')
+    xdf = generate_test_data(dim=1, ndays=9, tstart=datetime(2022, 7, 18))
+    for day in days:
+        c.save(xdf.isel(datetime=slice(day * 144, (day + 1) * 144)),
+               archive_starttime=archive_starttime)
+
+
+def _read_until(rootdir, backend, stop, errors):
+    start = datetime(2022, 7, 18)
+    c = Storage('stress', rootdir=rootdir, starttime=start,
+                endtime=start + timedelta(days=9),
+                backend=backend).get_substore('MDR', '00', 'HHZ')
+    failed = []
+    while not stop.is_set():
+        for feature in ['rsam', 'dsar']:
+            try:
+                c(feature)
+                c.metadata(feature)
+            except Exception as e:
+                failed.append(f"{feature}: {e!r}")
+    errors.put(failed)
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_concurrent_writers(tmp_path_factory, backend):
+    """
+    Test several processes writing to the same features while another
+    process reads them.
+    """
+    rootdir = str(tmp_path_factory.mktemp('test_concurrent'))
+    start = datetime(2022, 7, 18)
+    # writes before the archive start time move the existing data
+    archive_starttime = start + timedelta(days=4)
+    _save_days(rootdir, backend, [4], archive_starttime)
+    days = [d for d in range(9) if d != 4]
+    random.Random(42).shuffle(days)
+    ctx = multiprocessing.get_context('spawn')
+    stop = ctx.Event()
+    errors = ctx.Queue()
+    reader = ctx.Process(target=_read_until,
+                         args=(rootdir, backend, stop, errors), daemon=True)
+    writers = [ctx.Process(target=_save_days,
+                           args=(rootdir, backend, days[i::3],
+                                 archive_starttime), daemon=True)
+               for i in range(3)]
+    try:
+        for p in [reader] + writers:
+            p.start()
+        for w in writers:
+            w.join(timeout=300)
+        assert [w.exitcode for w in writers] == [0, 0, 0]
+    finally:
+        stop.set()
+    assert errors.get(timeout=60) == []
+    reader.join(timeout=60)
+
+    xdf = generate_test_data(dim=1, ndays=9, tstart=start)
+    g = Storage('stress', rootdir=rootdir, starttime=start,
+                endtime=start + timedelta(days=9, minutes=-10),
+                backend=backend)
+    c = g.get_substore('MDR', '00', 'HHZ')
+    for feature in ['rsam', 'dsar']:
+        np.testing.assert_array_equal(c(feature).values, xdf[feature].values)
+        assert c.metadata(feature)['starttime'] == start.isoformat()
+    assert sorted(c.features()) == ['dsar', 'rsam']
+    assert g.to_dict() == {'stress': [{'MDR': [{'00': [{'HHZ': [
+        'dsar', 'rsam']}]}]}]}
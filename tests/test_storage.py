@@ -1,12 +1,19 @@
+import errno
 import json
+import multiprocessing
 import os
+import shutil
+import tempfile
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
 import pytest
+import xarray as xr
 
 from tonik import Storage, generate_test_data, get_labels
+from tonik.xarray2netcdf import xarray2netcdf
+from tonik.xarray2zarr import xarray2zarr
 
 
 def test_group(tmp_path_factory):
@@ -98,6 +105,82 @@ def test_to_dict(tmp_path_factory):
     assert _j['test_experiment'][0]['MDR1'][0]['00'][0]['HHZ'][0] == 'feature'
 
 
+def _read_only(monkeypatch):
+    """
+    Make creating files fail as on a read-only file system.
+    """
+    def fail(*args, **kwargs):
+        raise OSError(errno.EROFS, os.strerror(errno.EROFS))
+
+    os_open = os.open
+
+    def open_(path, flags, *args, **kwargs):
+        if flags & os.O_CREAT:
+            fail()
+        return os_open(path, flags, *args, **kwargs)
+
+    monkeypatch.setattr(tempfile, 'mkstemp', fail)
+    monkeypatch.setattr(os, 'open', open_)
+
+
+def test_inventory(tmp_path_factory, monkeypatch):
+    import tonik.inventory
+    rootdir = tmp_path_factory.mktemp('data')
+    tstart = datetime(2016, 1, 1)
+    g = Storage('volcanoes', rootdir=rootdir)
+    xdf = generate_test_data(dim=1, ndays=1, tstart=tstart)
+    g.get_substore('WIZ', '00', 'HHZ').save(xdf)
+    g.get_substore('MDR', '00', 'BHZ').save(xdf)
+    assert os.path.isfile(os.path.join(g.path, '.tonik_inventory.json'))
+    assert g.inventory() == g.to_dict()
+
+    def scan(root):
+        raise AssertionError('directory tree was scanned')
+
+    monkeypatch.setattr(tonik.inventory, 'scan_inventory', scan)
+    # saving updates the index
+    g.get_substore('MDR', '10', 'BHZ').save(
+        generate_test_data(dim=2, ndays=1, tstart=tstart))
+    assert g.inventory() == g.to_dict()
+    assert g.inventory('MDR', tree=False) == ['00', '10']
+    assert g.inventory('MDR', '10', 'BHZ', tree=False) == [
+        'filterbank', 'ssam']
+    # files written or removed without Path.save are found
+    c = g.get_substore('WIZ', '00', 'HHZ')
+    xarray2netcdf(xdf.rename(rsam='tremor'), c.path)
+    os.remove(os.path.join(c.path, 'dsar.nc'))
+    assert g.inventory('WIZ', '00', 'HHZ', tree=False) == ['rsam', 'tremor']
+    shutil.rmtree(os.path.join(g.path, 'MDR', '10'))
+    os.makedirs(os.path.join(g.path, 'MDR', '20', 'EHZ'))
+    with open(os.path.join(g.path, 'MDR', '20', 'EHZ', 'rsam.nc'), 'w'):
+        pass
+    assert g.inventory() == g.to_dict()
+    assert g.inventory('MDR', tree=False) == ['00', '20']
+    # directories that didn't change aren't listed again
+    monkeypatch.setattr(tonik.inventory, 'RECENT', 0)
+    g.inventory()
+    listed = []
+    monkeypatch.setattr(tonik.inventory, '_list',
+                        lambda root, rel, *args: listed.append(rel))
+    g.inventory()
+    assert listed == []
+    monkeypatch.undo()
+    assert g.inventory(refresh=True) == g.to_dict()
+
+
+def test_inventory_read_only(tmp_path_factory, monkeypatch):
+    rootdir = tmp_path_factory.mktemp('data')
+    g = Storage('volcanoes', rootdir=rootdir)
+    g.get_substore('WIZ', '00', 'HHZ').save(
+        generate_test_data(dim=1, ndays=1, tstart=datetime(2016, 1, 1)))
+    os.remove(os.path.join(g.path, '.tonik_inventory.json'))
+    _read_only(monkeypatch)
+    # the index can't be written, the tree is scanned instead
+    assert g.inventory() == g.to_dict()
+    assert g.inventory(refresh=True) == g.to_dict()
+    assert not os.path.exists(os.path.join(g.path, '.tonik_inventory.json'))
+
+
 def test_call_multiple_days(tmp_path_factory):
     startdate = datetime(2016, 1, 1)
     enddate = datetime(2016, 1, 2, 12)
@@ -181,3 +264,340 @@ def test_labels(tmp_path_factory):
     assert 'description' in labels['rsam'][0]
     assert 'tags' in labels['rsam'][0]
     assert 'id' in labels['rsam'][0]
+
+
+def test_dataset_cache(tmp_path_factory):
+    from tonik.storage import dataset_cache, slice_cache
+    rootdir = tmp_path_factory.mktemp('data')
+    startdate = datetime(2016, 1, 1)
+    for backend in ['netcdf', 'zarr']:
+        dataset_cache.clear()
+        slice_cache.clear()
+        g = Storage('volcanoes', rootdir=rootdir, backend=backend,
+                    starttime=startdate, endtime=datetime(2016, 1, 3))
+        xdf = generate_test_data(dim=1, ndays=2, tstart=startdate)
+        g.save(xdf)
+        g('rsam')
+        g('rsam')
+        g.shape('rsam')
+        info = g.cache_info()['datasets']
+        assert info.misses == 1
+        assert info.hits == 1
+        assert info.currsize == 1
+        # writing through save invalidates the cached handle
+        xdf1 = generate_test_data(dim=1, ndays=2,
+                                  tstart=datetime(2016, 1, 3))
+        g.endtime = datetime(2016, 1, 5)
+        g.save(xdf1)
+        rsam = g('rsam')
+        assert g.cache_info()['datasets'].misses == 2
+        assert pd.to_datetime(rsam.datetime.values[-1]) == \
+            pd.to_datetime(xdf1.datetime.values[-1])
+
+
+def test_dataset_cache_eviction(tmp_path_factory):
+    from tonik.cache import DatasetCache
+    rootdir = tmp_path_factory.mktemp('data')
+    g = Storage('volcanoes', rootdir=rootdir)
+    xdf = generate_test_data(dim=1, ndays=1, tstart=datetime(2016, 1, 1),
+                             feature_names=['rsam', 'dsar', 'central_freq'])
+    g.save(xdf)
+    cache = DatasetCache(maxsize=2)
+    for feature in ['rsam', 'dsar', 'central_freq', 'rsam']:
+        with cache.open(g.feature_path(feature), 'original', 'h5netcdf') as ds:
+            assert feature in ds
+    info = cache.info()
+    assert info.currsize == 2
+    assert info.misses == 4
+    # evicted datasets are closed
+    cache.invalidate()
+    assert cache.info().currsize == 0
+
+
+def test_slice_cache(tmp_path_factory):
+    from tonik.storage import slice_cache
+    from tonik.xarray2netcdf import xarray2netcdf
+    rootdir = tmp_path_factory.mktemp('data')
+    slice_cache.clear()
+    g = Storage('volcanoes', rootdir=rootdir)
+    tstart = datetime(2016, 1, 1)
+    xdf = generate_test_data(dim=2, ndays=2, tstart=tstart)
+    g.save(xdf)
+    g.starttime = datetime(2016, 1, 1, 3)
+    g.endtime = datetime(2016, 1, 2, 23, 59)
+    ssam1 = g('ssam')
+    # windows inside the same buckets are served from the cache
+    g.starttime = datetime(2016, 1, 1, 3, 30)
+    ssam2 = g('ssam')
+    info = g.cache_info()['slices']
+    assert info.misses == 1
+    assert info.hits == 1
+    assert info.currbytes > 0
+    np.testing.assert_array_equal(ssam2.values, ssam1.values[:, 3:])
+    assert pd.to_datetime(ssam2.datetime.values[0]) == g.starttime
+    # modifying the returned array does not alter the cache
+    ssam2.values[:] = -1
+    np.testing.assert_array_equal(g('ssam').values, ssam1.values[:, 3:])
+
+    # data appended by another process only triggers a re-read of the
+    # last bucket
+    xdf1 = generate_test_data(dim=2, ndays=1, tstart=datetime(2016, 1, 3),
+                              seed=1)
+    p = multiprocessing.get_context('spawn').Process(
+        target=xarray2netcdf, args=(xdf1, g.path))
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+    g.endtime = datetime(2016, 1, 3, 0, 0)
+    ssam3 = g('ssam')
+    g.endtime = datetime(2016, 1, 2, 23, 59)
+    assert g.cache_info()['slices'].refreshes == 1
+    np.testing.assert_array_equal(ssam3.values[:, -1],
+                                  xdf1.ssam.values[:, 0])
+    np.testing.assert_array_equal(ssam3.values[:, :-1], ssam1.values[:, 3:])
+
+    # entries beyond their time-to-live are read again in full
+    ttl = slice_cache.ttl
+    slice_cache.ttl = 0.
+    try:
+        g('ssam')
+    finally:
+        slice_cache.ttl = ttl
+    assert g.cache_info()['slices'].misses == 2
+
+
+def test_iter_blocks(tmp_path_factory):
+    rootdir = tmp_path_factory.mktemp('data')
+    tstart = datetime(2016, 1, 1)
+    g = Storage('volcanoes', rootdir=rootdir, starttime=tstart,
+                endtime=datetime(2016, 1, 2))
+    xdf = generate_test_data(dim=2, ndays=2, nfreqs=8, tstart=tstart)
+    g.save(xdf)
+    ssam = g('ssam')
+    blocks = list(g.iter_blocks('ssam', maxvalues=40))
+    assert len(blocks) == 29
+    assert max(b.size for b in blocks) <= 40
+    xr_ssam = xr.concat(blocks, dim='datetime')
+    np.testing.assert_array_equal(xr_ssam.values, ssam.values)
+    np.testing.assert_array_equal(xr_ssam.datetime.values,
+                                  ssam.datetime.values)
+    # frequency rows over the whole window
+    blocks = list(g.iter_blocks('ssam', maxvalues=300, order='frequency'))
+    assert [b.shape[0] for b in blocks] == [2, 2, 2, 2]
+    np.testing.assert_array_equal(
+        np.concatenate([b.values.ravel() for b in blocks]),
+        ssam.values.ravel())
+    # parts of single rows
+    blocks = list(g.iter_blocks('ssam', maxvalues=100, order='frequency'))
+    assert len(blocks) == 16
+    np.testing.assert_array_equal(
+        np.concatenate([b.values.ravel() for b in blocks]),
+        ssam.values.ravel())
+    # small windows are read in one go
+    assert len(list(g.iter_blocks('ssam', maxvalues=10**6))) == 1
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_load_many(tmp_path_factory, backend):
+    rootdir = tmp_path_factory.mktemp('data')
+    tstart = datetime(2016, 1, 1)
+    g = Storage('volcanoes', rootdir=rootdir, starttime=tstart,
+                endtime=datetime(2016, 1, 2), backend=backend)
+    g.save(generate_test_data(dim=1, ndays=2, tstart=tstart))
+    # 2D features only cover the second half of the window
+    g.save(generate_test_data(dim=2, ndays=1, tstart=datetime(2016, 1, 1, 12)))
+    xds = g.load_many(['rsam', 'dsar', 'ssam', 'filterbank'])
+    assert list(xds.data_vars) == ['rsam', 'dsar', 'ssam', 'filterbank']
+    assert xds.sizes['datetime'] == 145
+    np.testing.assert_array_equal(xds['rsam'].values, g('rsam').values)
+    ssam = g('ssam')
+    np.testing.assert_array_equal(xds['ssam'].values[:, 72:],
+                                  ssam.values[:, -73:])
+    assert np.all(np.isnan(xds['ssam'].values[:, :72]))
+    with pytest.raises(FileNotFoundError):
+        g.load_many(['rsam', 'doesnt_exist'])
+
+
+def test_query(tmp_path_factory):
+    rootdir = tmp_path_factory.mktemp('data')
+    tstart = datetime(2016, 1, 1)
+    g = Storage('volcanoes', rootdir=rootdir, starttime=tstart,
+                endtime=datetime(2016, 1, 2))
+    channels = [('WIZ', '00', 'HHZ'), ('WIZ', '10', 'HHZ'),
+                ('WSRZ', '00', 'HHZ'), ('MDR', '00', 'BHZ')]
+    for seed, channel in enumerate(channels):
+        g.get_substore(*channel).save(
+            generate_test_data(dim=1, ndays=2, tstart=tstart, seed=seed))
+    # a channel without the feature
+    g.get_substore('WIZ', '00', 'EHZ').save(
+        generate_test_data(dim=1, ndays=2, tstart=tstart,
+                           feature_names=['dsar']))
+    rsam = g.query('rsam', 'W*.*.HHZ')
+    assert rsam.dims == ('channel', 'datetime')
+    assert list(rsam.channel.values) == ['WIZ.00.HHZ', 'WIZ.10.HHZ',
+                                         'WSRZ.00.HHZ']
+    np.testing.assert_array_equal(
+        rsam.sel(channel='WIZ.10.HHZ').values,
+        g.get_substore('WIZ', '10', 'HHZ')('rsam').values)
+    assert g.query('rsam').sizes['channel'] == 4
+    assert g.query('rsam', 'WIZ.00').sizes['channel'] == 1
+    with pytest.raises(FileNotFoundError):
+        g.query('rsam', 'XYZ.*.*')
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_metadata(tmp_path_factory, monkeypatch, backend):
+    import tonik.catalog
+    rootdir = tmp_path_factory.mktemp('data')
+    tstart = datetime(2016, 1, 1)
+    g = Storage('volcanoes', rootdir=rootdir, backend=backend)
+    c = g.get_substore('WIZ', '00', 'HHZ')
+    c.save(generate_test_data(dim=1, ndays=1, tstart=tstart))
+    c.save(generate_test_data(dim=2, ndays=2, nfreqs=8, tstart=tstart))
+    meta = c.metadata()
+    assert sorted(meta) == ['dsar', 'filterbank', 'rsam', 'ssam']
+    assert meta['ssam']['starttime'] == '2016-01-01T00:00:00'
+    assert meta['ssam']['endtime'] == '2016-01-02T23:50:00'
+    # sizes as stored, netCDF files start at the archive start time
+    assert meta['ssam']['sizes']['frequency'] == 8
+    assert meta['ssam']['sizes']['datetime'] == c.shape('ssam')['datetime']
+    assert meta['ssam']['dtype'] == 'float64'
+    assert meta['rsam']['resolution'] == pytest.approx(1 / 6)
+
+    def read(*args):
+        raise AssertionError('feature file was read')
+
+    monkeypatch.setattr(tonik.catalog, 'feature_metadata', read)
+    assert c.metadata('rsam') == meta['rsam']
+    # saving extends the entries without reading the files
+    c.save(generate_test_data(dim=1, ndays=1,
+                              tstart=datetime(2016, 1, 2)))
+    c.save(generate_test_data(dim=1, ndays=1,
+                              tstart=datetime(2015, 12, 30)))
+    meta = c.metadata(['rsam', 'dsar'])
+    assert meta['rsam']['endtime'] == '2016-01-02T23:50:00'
+    assert meta['rsam']['sizes'] == c.shape('rsam')
+    monkeypatch.undo()
+    assert c.metadata(['rsam', 'dsar'], refresh=True) == meta
+    # files that changed since the catalog was written are read again
+    write = xarray2netcdf if backend == 'netcdf' else xarray2zarr
+    write(generate_test_data(dim=1, ndays=1, tstart=datetime(2016, 1, 3)),
+          c.path)
+    assert c.metadata('rsam')['endtime'] == '2016-01-03T23:50:00'
+    assert c.metadata('rsam')['sizes'] == c.shape('rsam')
+
+
+def test_metadata_read_only(tmp_path_factory, monkeypatch):
+    rootdir = tmp_path_factory.mktemp('data')
+    g = Storage('volcanoes', rootdir=rootdir)
+    c = g.get_substore('WIZ', '00', 'HHZ')
+    c.save(generate_test_data(dim=1, ndays=1, tstart=datetime(2016, 1, 1)))
+    meta = c.metadata()
+    xarray2netcdf(generate_test_data(dim=1, ndays=1,
+                                     tstart=datetime(2016, 1, 2)), c.path)
+    _read_only(monkeypatch)
+    # the catalog can't be written, the entries are returned anyway
+    assert c.metadata('rsam')['starttime'] == meta['rsam']['starttime']
+    assert c.metadata('rsam')['endtime'] == '2016-01-02T23:50:00'
+    assert c.metadata('dsar', refresh=True) == c.metadata('dsar')
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_nbytes(tmp_path_factory, backend):
+    rootdir = tmp_path_factory.mktemp('data')
+    tstart = datetime(2016, 1, 1)
+    g = Storage('volcanoes', rootdir=rootdir, backend=backend,
+                starttime=tstart, endtime=datetime(2016, 1, 2, 5))
+    g.save(generate_test_data(dim=2, ndays=3, nfreqs=8, tstart=tstart),
+           pyramid=['1h'])
+    assert g.nbytes('ssam') == g('ssam').nbytes
+    assert g.nbytes('ssam', resolution='1h') == g(
+        'ssam', resolution='1h').nbytes
+    g.starttime = datetime(2017, 1, 1)
+    g.endtime = datetime(2017, 1, 2)
+    assert g.nbytes('ssam') == 0
+
+
+def test_hyperslab_read(tmp_path_factory):
+    import h5py
+    from tonik.cache import _open_dataset
+    from tonik.h5read import read_feature
+    rootdir = tmp_path_factory.mktemp('data')
+    tstart = datetime(2016, 1, 1)
+    g = Storage('volcanoes', rootdir=rootdir)
+    g.save(generate_test_data(dim=2, ndays=3, nfreqs=8, tstart=tstart),
+           archive_starttime=datetime(2015, 12, 31))
+    windows = [(None, None),
+               (datetime(2016, 1, 1), datetime(2016, 1, 2)),
+               (datetime(2016, 1, 1, 3, 10), datetime(2016, 1, 1, 3, 30)),
+               (datetime(2016, 1, 1, 3, 5, 17), datetime(2016, 1, 2, 7, 1)),
+               (datetime(2015, 1, 1), datetime(2015, 12, 31, 0, 10)),
+               (datetime(2016, 1, 3, 23, 50), datetime(2017, 1, 1)),
+               (datetime(2017, 1, 1), datetime(2017, 1, 2)),
+               (datetime(2016, 1, 2, 0, 5), datetime(2016, 1, 2, 0, 6))]
+    filename = g.feature_path('ssam')
+    with _open_dataset(filename, 'original', 'h5netcdf') as ds:
+        with h5py.File(filename, 'r', locking=False) as h5f:
+            for start, end in windows:
+                expected = ds['ssam'].loc[dict(
+                    datetime=slice(start, end))].load()
+                xda = read_feature(h5f['original'], 'ssam', start, end)
+                assert xda.dims == expected.dims
+                np.testing.assert_array_equal(xda.values, expected.values)
+                np.testing.assert_array_equal(xda.datetime.values,
+                                              expected.datetime.values)
+                np.testing.assert_array_equal(xda.frequency.values,
+                                              expected.frequency.values)
+
+
+def test_memmap_read(tmp_path_factory):
+    from tonik.cache import invalidate
+    rootdir = tmp_path_factory.mktemp('data')
+    g = Storage('volcanoes', rootdir=rootdir,
+                starttime=datetime(2016, 1, 1, 3),
+                endtime=datetime(2016, 1, 2, 7))
+    xdf = generate_test_data(dim=2, ndays=3, nfreqs=8,
+                             tstart=datetime(2016, 1, 1))
+    # features written by tonik are chunked and are read normally
+    g.save(xdf)
+    expected = g('ssam')
+    xda = g('ssam', mmap=True)
+    assert not isinstance(xda.variable._data, np.memmap)
+    xr.testing.assert_identical(xda, expected)
+    # contiguous files written by other tools are mapped
+    filename = g.feature_path('ssam')
+    invalidate(filename)
+    xdf.attrs['resolution'] = 1 / 6.
+    xdf[['ssam']].to_netcdf(
+        filename, group='original', engine='h5netcdf',
+        encoding={'datetime': {'units': 'hours since 1970-01-01 00:00:00.0',
+                               'calendar': 'gregorian'}})
+    invalidate(filename)
+    xda = g('ssam', mmap=True)
+    assert isinstance(xda.variable._data, np.memmap)
+    assert not xda.variable._data.flags.writeable
+    np.testing.assert_array_equal(xda.values, expected.values)
+    # xarray and tonik encode the times with different rounding errors
+    np.testing.assert_array_equal(xda.datetime.dt.round('1ms').values,
+                                  expected.datetime.dt.round('1ms').values)
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_chunked_read(tmp_path_factory, backend):
+    rootdir = tmp_path_factory.mktemp('data')
+    g = Storage('volcanoes', rootdir=rootdir, backend=backend,
+                starttime=datetime(2016, 1, 1, 3),
+                endtime=datetime(2016, 1, 2, 7))
+    xdf = generate_test_data(dim=2, ndays=3, nfreqs=8,
+                             tstart=datetime(2016, 1, 1))
+    g.save(xdf)
+    expected = g('ssam')
+    xda = g('ssam', chunks={'datetime': 50})
+    assert xda.chunks is not None
+    xr.testing.assert_identical(xda.compute(), expected)
+    # the file can be written while the dask-backed array is alive and
+    # the array can be read again afterwards
+    g.save(xdf)
+    xr.testing.assert_identical(xda.compute(), expected)
+    with pytest.raises(ValueError):
+        g('ssam', chunks={'datetime': 50}, mmap=True)
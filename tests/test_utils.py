@@ -1,6 +1,13 @@
+from datetime import datetime
+
 import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
 
-from tonik.utils import extract_consecutive_integers
+from tonik import generate_test_data
+from tonik.utils import (_merge_regular, extract_consecutive_integers,
+                         merge_arrays, select_pyramid_level)
 
 
 def test_extract_consecutive_integers():
@@ -9,3 +16,103 @@ def test_extract_consecutive_integers():
         nums) == [[1, 2, 3], [5, 6, 7, 8], [10]]
     assert extract_consecutive_integers([1]) == [[1]]
     assert extract_consecutive_integers(np.array([1, 2, 4])) == [[1, 2], [4]]
+
+
+def _combine_first(xda_old, xda_new, resolution=None):
+    # merge_arrays before regular grids were merged separately
+    xda_new = xda_new.drop_duplicates('datetime', keep='last').combine_first(
+        xda_old.drop_duplicates('datetime', keep='last'))
+    if resolution is not None:
+        xda_new = xda_new.reindex(datetime=pd.date_range(
+            xda_new.datetime.values[0], xda_new.datetime.values[-1],
+            freq=f'{resolution}h'))
+    return xda_new
+
+
+@pytest.mark.parametrize('dim', [1, 2])
+@pytest.mark.parametrize('resolution', [None, 1/6])
+@pytest.mark.parametrize('old,new,regular', [
+    ((0, 500), (400, 600), True),     # overlap at the end
+    ((100, 500), (0, 150), True),     # backfill
+    ((0, 500), (200, 300), True),     # inside
+    ((0, 300), (300, 400), True),     # adjacent
+    ((0, 300), (350, 400), 'resolution'),  # gap
+    ((0, 1), (1, 2), False),          # single steps, no time step
+    ((0, 300), (0, 300), True),       # same times
+])
+def test_merge_arrays(dim, resolution, old, new, regular):
+    xdf = generate_test_data(dim=dim, ndays=5, tstart=datetime(2022, 7, 18))
+    feature = 'rsam' if dim == 1 else 'ssam'
+    xda = xdf[feature].astype(np.float32)
+    xda_old = xda.isel(datetime=slice(*old))
+    # different values for the new data, including NaNs where the old
+    # values have to be kept
+    xda_new = xda.isel(datetime=slice(*new)) + 1.
+    xda_new = xda_new.where(np.arange(xda_new.sizes['datetime']) % 7 != 3)
+    xda_new.attrs = {'units': 'm/s'}
+    expected = _combine_first(xda_old, xda_new, resolution)
+    if regular == 'resolution':
+        # the gap is only filled if the resolution is given
+        regular = resolution is not None
+    fast = _merge_regular(xda_old, xda_new, resolution, 2**20)
+    assert (fast is not None) == regular
+    for blocksize in [2**20, 7]:
+        for source in [xda_old, xda_old.chunk(datetime=50)]:
+            merged = merge_arrays(source, xda_new, resolution,
+                                  blocksize=blocksize)
+            assert merged.dims == expected.dims
+            assert merged.dtype == expected.dtype
+            assert merged.name == expected.name
+            assert merged.attrs == expected.attrs
+            np.testing.assert_array_equal(
+                merged.datetime.values,
+                expected.datetime.values.astype('datetime64[ns]'))
+            np.testing.assert_array_equal(merged.values, expected.values)
+            if dim == 2:
+                np.testing.assert_array_equal(merged.frequency.values,
+                                              expected.frequency.values)
+
+
+def test_merge_arrays_irregular():
+    """
+    Test that arrays that are not on the same regular grid are merged
+    like before.
+    """
+    times = pd.date_range('2022-07-18', periods=100, freq='10min')
+    rng = np.random.default_rng(0)
+    xda = xr.DataArray(rng.random(100), coords={'datetime': times},
+                       dims='datetime', name='rsam')
+    cases = [
+        # irregular time steps
+        (xda.isel(datetime=np.r_[0:40, 45:60]),
+         xda.isel(datetime=slice(50, 80))),
+        # a grid shifted by half a step
+        (xda.isel(datetime=slice(0, 50)),
+         xda.isel(datetime=slice(40, 60)).assign_coords(
+             datetime=times[40:60] + pd.Timedelta('5min'))),
+        # duplicate times
+        (xda.isel(datetime=np.r_[0:40, 39, 40:50]),
+         xda.isel(datetime=slice(45, 60))),
+        # a different time step
+        (xda.isel(datetime=slice(0, 50)), xda.isel(datetime=slice(40, 60, 2))),
+    ]
+    for xda_old, xda_new in cases:
+        assert _merge_regular(xda_old, xda_new, None, 2**20) is None
+        expected = _combine_first(xda_old, xda_new)
+        merged = merge_arrays(xda_old, xda_new)
+        np.testing.assert_array_equal(merged.values, expected.values)
+        np.testing.assert_array_equal(merged.datetime.values,
+                                      expected.datetime.values)
+
+
+def test_select_pyramid_level():
+    levels = ['1h', '6h', '1D']
+    assert select_pyramid_level(levels, '12h', 'max', 'max') == '6h'
+    assert select_pyramid_level(levels, '30min', 'min', 'min') is None
+    # means and medians of a finer level are not the ones of the data
+    assert select_pyramid_level(levels, '12h', 'mean', 'mean') is None
+    assert select_pyramid_level(levels, '1D', 'mean', 'mean') == '1D'
+    assert select_pyramid_level(levels, '6h', 'median', 'median') == '6h'
+    # levels of another method are never used
+    assert select_pyramid_level(levels, '1D', 'max', 'mean') is None
+    assert select_pyramid_level(levels, '1D', 'median', 'mean') is None
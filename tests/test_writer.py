@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from tonik import Path, Storage, generate_test_data
+from tonik.writer import LOG_FILE
+
+tstart = datetime(2023, 1, 1)
+
+
+def _steps(xdf, start, stop):
+    return [xdf.isel(datetime=[i]) for i in range(start, stop)]
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_buffered_writer(tmp_path_factory, monkeypatch, backend):
+    """
+    Test that buffered appends give the same data as saving every
+    append.
+    """
+    rootdir = tmp_path_factory.mktemp('test_writer')
+    xdf = generate_test_data(dim=2, ndays=1, tstart=tstart)
+    g = Storage('buffered', rootdir=rootdir, starttime=tstart,
+                endtime=tstart + timedelta(hours=23, minutes=50),
+                backend=backend)
+    c = g.get_substore('MDR', '00', 'HHZ')
+    kwargs = dict(archive_starttime=tstart, resolution=1/6)
+    c.save(xdf.isel(datetime=slice(0, 10)), **kwargs)
+    saves = []
+    save = Path.save
+    monkeypatch.setattr(Path, 'save',
+                        lambda self, data, **kwargs: saves.append(
+                            data.sizes['datetime']) or save(self, data,
+                                                            **kwargs))
+    with g.writer(max_rows=50, **kwargs) as w:
+        for xds in _steps(xdf, 10, 100):
+            w.save(xds, 'MDR', '00', 'HHZ')
+        assert saves == [50]
+        # a repeated time step replaces the earlier one
+        w.save(xdf.isel(datetime=[20]), 'MDR', '00', 'HHZ')
+        for xds in _steps(xdf, 100, 144):
+            w.save(xds, 'MDR', '00', 'HHZ')
+    assert saves == [50, 50, 35]
+    assert os.path.getsize(os.path.join(g.path, LOG_FILE)) == 0
+    for feature in ['ssam', 'filterbank']:
+        np.testing.assert_array_equal(c(feature).values,
+                                      xdf[feature].values)
+    assert g.to_dict() == {'buffered': [{'MDR': [{'00': [{'HHZ': [
+        'filterbank', 'ssam']}]}]}]}
+
+
+def test_buffered_writer_max_age(tmp_path_factory):
+    rootdir = tmp_path_factory.mktemp('test_writer')
+    xdf = generate_test_data(dim=1, ndays=1, tstart=tstart)
+    g = Storage('buffered', rootdir=rootdir, starttime=tstart,
+                endtime=tstart + timedelta(hours=1))
+    kwargs = dict(archive_starttime=tstart, resolution=1/6)
+    with g.writer(max_age=0., **kwargs) as w:
+        w.save(xdf.isel(datetime=[0]))
+        assert g('rsam').size == 1
+    w = g.writer(max_age=3600., **kwargs)
+    w.save(xdf.isel(datetime=[1]))
+    assert g('rsam').size == 1
+    w.poll()
+    assert g('rsam').size == 1
+    w.max_age = 0.
+    w.poll()
+    assert g('rsam').size == 2
+    w.close()
+
+
+def _crash(rootdir, nsteps):
+    xdf = generate_test_data(dim=1, ndays=1, tstart=tstart)
+    w = Storage('buffered', rootdir=rootdir).writer(
+        archive_starttime=tstart, resolution=1/6)
+    for xds in _steps(xdf, 0, nsteps):
+        w.save(xds, 'MDR')
+    # leave a partly written record behind
+    w._file.write(b'\x10\x00\x00')
+    w._file.flush()
+    os._exit(1)
+
+
+def test_buffered_writer_replay(tmp_path_factory):
+    """
+    Test that appends of a writer that died are saved by the next
+    writer on the same log.
+    """
+    rootdir = tmp_path_factory.mktemp('test_writer')
+    ctx = multiprocessing.get_context('spawn')
+    p = ctx.Process(target=_crash, args=(rootdir, 5))
+    p.start()
+    p.join(timeout=120)
+    assert p.exitcode == 1
+    g = Storage('buffered', rootdir=rootdir, starttime=tstart,
+                endtime=tstart + timedelta(minutes=40))
+    assert g.to_dict() == {'buffered': []}
+    with g.writer(archive_starttime=tstart, resolution=1/6) as w:
+        assert os.path.getsize(w.log) == 0
+    xdf = generate_test_data(dim=1, ndays=1, tstart=tstart)
+    c = g.get_substore('MDR')
+    np.testing.assert_array_equal(c('rsam').values,
+                                  xdf['rsam'].values[:5])
+    np.testing.assert_array_equal(c('dsar').values,
+                                  xdf['dsar'].values[:5])